@@ -0,0 +1,423 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""
+Microbenchmarks for the per-note hot paths (prompt rendering and field lookup).
+
+Runs headlessly (no Qt, no running Anki) and compares against stored baselines:
+
+    python scripts/benchmark.py                   # compare against baseline, exit 1 on regression or no baseline
+    python scripts/benchmark.py --update-baseline # re-record the baseline
+    python scripts/benchmark.py --threshold 1.5   # allow up to 50% slowdown
+    python scripts/benchmark.py --memory          # peak memory of a batch, by batch size
+
+Timings are normalized against a small pure-python calibration loop, so the
+stored baseline is roughly portable between machines.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import timeit
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, "scripts", "benchmark_baseline.json")
+DEFAULT_THRESHOLD = 1.25
+# Each timing round runs a benchmark for at least this long, so a few us of noise averages out
+MIN_ROUND_SECONDS = 0.5
+# Benchmarks over the threshold are timed again this many times before they count as regressed
+CONFIRM_RUNS = 2
+
+# Batch sizes to compare peak memory across, and notes in flight at once
+MEMORY_BATCH_SIZES = (200, 2000)
+MEMORY_IN_FLIGHT = 32
+# Fail if a batch 10x the size needs more than this many times the working memory
+MEMORY_GROWTH_LIMIT = 2.0
+
+sys.path.insert(0, ROOT)
+
+from src.core import normalize, prompts, similarity  # noqa: E402
+
+# Fixtures
+
+
+NUM_NOTE_TYPES = 10
+FIELDS_PER_NOTE_TYPE = 30
+SMART_FIELDS_PER_NOTE_TYPE = 25  # 250 prompts total
+FIELD_HTML_REPEATS = 40  # ~4kb of html per field
+
+
+def make_html_field(rng: random.Random, i: int) -> str:
+    chunk = (
+        '<div><span style="color: rgb(0, 0, 0); font-family: Arial;">'
+        f"Example {i} sentence with&nbsp;some <b>bold</b> text</span><br></div>"
+    )
+    return chunk * rng.randint(FIELD_HTML_REPEATS // 2, FIELD_HTML_REPEATS)
+
+
+def make_fixtures() -> Dict[str, Any]:
+    rng = random.Random(1234)
+
+    note_types: Dict[str, Dict[str, Any]] = {}
+    prompts_map: Dict[str, Any] = {"note_types": {}}
+
+    for t in range(NUM_NOTE_TYPES):
+        name = f"Vocab Type {t}"
+        field_names = [f"Field {f}" for f in range(FIELDS_PER_NOTE_TYPE)]
+        note_types[name] = {
+            "name": name,
+            "flds": [{"name": n, "ord": i} for i, n in enumerate(field_names)],
+        }
+
+        # First few fields are sources, the rest are smart fields
+        sources = field_names[: FIELDS_PER_NOTE_TYPE - SMART_FIELDS_PER_NOTE_TYPE]
+        fields = {}
+        for target in field_names[len(sources) :]:
+            refs = rng.sample(sources, 3)
+            fields[target] = (
+                "You are a helpful language tutor. "
+                f"Write an example sentence using {{{{{refs[0]}}}}}, "
+                f"which means {{{{{refs[1].upper()}}}}}. "
+                f"Context: {{{{{refs[2]}}}}}. Reply with only the sentence."
+            )
+        prompts_map["note_types"][name] = {"fields": fields}
+
+    note_type = note_types["Vocab Type 0"]
+    # Field name -> value, the same shape the renderer reads off a Note
+    note = {
+        fld["name"]: make_html_field(rng, fld["ord"]) for fld in note_type["flds"]
+    }
+    prompt = next(iter(prompts_map["note_types"]["Vocab Type 0"]["fields"].values()))
+
+    # Short sentences, spread over a few smart fields, as a big translation backfill leaves them
+    words = [
+        "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9)))
+        for _ in range(5000)
+    ]
+    # Filled to the size the add-on and headless runner hold
+    similar = similarity.SimilarResponses()
+    for i in range(similarity.MAX_ENTRIES):
+        sentence = " ".join(rng.choice(words) for _ in range(rng.randint(2, 8)))
+        similar.add(f"field {i % 5}", [sentence], f"response {i}")
+
+    return {
+        "note_types": note_types,
+        "prompts_map": prompts_map,
+        "note_type": note_type,
+        "note": note,
+        "prompt": prompt,
+        "similar": similar,
+        "similar_query": [f"<b>{sentence.upper()}!</b>"],
+    }
+
+
+# Benchmarks
+
+
+def make_benchmarks(fixtures: Dict[str, Any]) -> Dict[str, Callable[[], Any]]:
+    note = fixtures["note"]
+    note_type = fixtures["note_type"]
+    prompt = fixtures["prompt"]
+    prompts_map = fixtures["prompts_map"]
+    field_prompts = prompts_map["note_types"][note_type["name"]]["fields"]
+    field_names = [f["name"] for f in note_type["flds"]]
+    target_field = next(iter(field_prompts))
+    similar = fixtures["similar"]
+    similar_query = fixtures["similar_query"]
+
+    def interpolate_note() -> None:
+        # What the engine does per note: render every smart field of a note not seen before
+        normalize._normalize_field_cached.cache_clear()
+        for field_prompt in field_prompts.values():
+            prompts.interpolate_prompt(field_prompt, note)
+
+    def interpolate_uncached() -> None:
+        # Every call would otherwise be a hit in the cache of recent values; a batch's notes mostly aren't
+        normalize._normalize_field_cached.cache_clear()
+        prompts.interpolate_prompt(prompt, note)
+
+    return {
+        "interpolate_prompt": interpolate_uncached,
+        "interpolate_prompt_raw": lambda: prompts.interpolate_prompt(
+            prompt, note, {"normalize_inputs": False}
+        ),
+        # A whole note's worth of html, bypassing the cache of recent values
+        "normalize_note_fields": lambda: [
+            normalize._normalize_field(value) for value in note.values()
+        ],
+        "interpolate_note_all_fields": interpolate_note,
+        "get_prompt_fields_lower": lambda: prompts.get_prompt_fields_lower(prompt),
+        "prompt_has_error": lambda: prompts.prompt_has_error(
+            prompt, field_names, field_prompts, target_field
+        ),
+        "is_ai_field": lambda: prompts.is_ai_field(
+            FIELDS_PER_NOTE_TYPE - 1, note_type, prompts_map
+        ),
+        # A near-duplicate of the last input added, among 100k
+        "similar_lookup_100k": lambda: similar.find("field 4", similar_query, 0.9),
+        # Too quick to time reliably on its own; 100 notes is a small batch
+        "to_lowercase_dict_x100": lambda: [
+            prompts.to_lowercase_dict(note) for _ in range(100)
+        ],
+    }
+
+
+def measure_batch_memory(
+    fixtures: Dict[str, Any], num_notes: int, max_in_flight: int
+) -> Tuple[int, int]:
+    """Runs num_notes through Engine.process_notes against a client that answers instantly.
+    Returns (peak bytes allocated while it ran, bytes still allocated once it's done)."""
+    import asyncio
+    import tracemalloc
+
+    # Importing anki.notes before anki.collection trips a circular import inside anki
+    import anki.collection  # noqa: F401
+    from anki.notes import NoteId
+
+    from src.core.cache import ResponseCache
+    from src.core.config import StaticConfig
+    from src.core.engine import Engine
+    from src.core.note_records import NoteRecord
+    from src.core.open_ai_client import OpenAIClient
+    from src.core.scheduler import Scheduler
+
+    class InstantClient(OpenAIClient):
+        async def async_get_chat_response(self, *args: Any, **kwargs: Any) -> str:
+            await asyncio.sleep(0)
+            return "response"
+
+    config = StaticConfig("key", prompts_map=fixtures["prompts_map"])
+    engine = Engine(
+        InstantClient(config),
+        config,
+        scheduler=Scheduler(max_in_flight=max_in_flight),
+        # Caching every response would measure the cache, not the batch
+        cache=ResponseCache(max_entries=0),
+    )
+
+    name = fixtures["note_type"]["name"]
+    smart_fields = fixtures["prompts_map"]["note_types"][name]["fields"]
+    # Source fields share their values between notes; smart fields start empty
+    fields = {
+        field: "" if field in smart_fields else value
+        for field, value in fixtures["note"].items()
+    }
+    records = [
+        NoteRecord(NoteId(i), 0, 0, name, dict(fields)) for i in range(num_notes)
+    ]
+
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        updated, _ = asyncio.run(engine.process_notes(records))
+        end, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert len(updated) == num_notes
+    return peak - start, end - start
+
+
+def run_memory() -> int:
+    """Checks that a batch's working memory (peak, less the results it keeps) depends on how many
+    notes are in flight, not on how many notes are in the batch."""
+    fixtures = make_fixtures()
+
+    print(f"{'notes':>8} {'in flight':>10} {'peak KiB':>10} {'kept KiB':>10} {'working KiB':>12}")
+    working = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for num_notes in MEMORY_BATCH_SIZES:
+            peak, kept = measure_batch_memory(fixtures, num_notes, MEMORY_IN_FLIGHT)
+            working.append(peak - kept)
+            with contextlib.redirect_stdout(sys.__stdout__):
+                print(
+                    f"{num_notes:>8} {MEMORY_IN_FLIGHT:>10} {peak / 1024:>10.0f} "
+                    f"{kept / 1024:>10.0f} {(peak - kept) / 1024:>12.0f}"
+                )
+
+    growth = working[-1] / working[0]
+    print(f"\nWorking memory grew {growth:.2f}x for {MEMORY_BATCH_SIZES[-1] // MEMORY_BATCH_SIZES[0]}x the notes")
+    if growth > MEMORY_GROWTH_LIMIT:
+        print(f"Grew more than {MEMORY_GROWTH_LIMIT}x: batch memory depends on batch size")
+        return 1
+    return 0
+
+
+def calibrate() -> None:
+    """Fixed pure-python workload used to normalize timings across machines."""
+    d = {f"Key {i}": str(i) for i in range(50)}
+    for _ in range(20):
+        "".join(k.lower() + v for k, v in d.items())
+
+
+def get_number(timer: timeit.Timer) -> int:
+    """Calls per timing round, enough for it to take MIN_ROUND_SECONDS."""
+    number, seconds = timer.autorange()
+    return max(number, int(number * MIN_ROUND_SECONDS / seconds) + 1)
+
+
+def time_call(fn: Callable[[], Any], repeat: int) -> float:
+    """Returns the best-of-`repeat` time per call, in microseconds."""
+    timer = timeit.Timer(fn)
+    number = get_number(timer)
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e6
+
+
+def time_relative(fn: Callable[[], Any], repeat: int) -> Tuple[float, float]:
+    """Times fn and the calibration loop in alternating rounds so both see the same machine load.
+    Returns (us per call, calibration us per call)."""
+    timers = [timeit.Timer(fn), timeit.Timer(calibrate)]
+    numbers = [get_number(timer) for timer in timers]
+    rounds = [
+        [timer.timeit(number) / number * 1e6 for timer, number in zip(timers, numbers)]
+        for _ in range(repeat)
+    ]
+    return min(r[0] for r in rounds), min(r[1] for r in rounds)
+
+
+def run(
+    benchmarks: Dict[str, Callable[[], Any]],
+    repeat: int,
+    calibration: Union[float, None] = None,
+) -> Tuple[float, Dict[str, float]]:
+    """Returns (calibration us, {benchmark: us per call normalized to that calibration})."""
+    # interpolate_prompt prints the rendered prompt; keep paying for it, but don't show it
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        calibration = calibration or time_call(calibrate, repeat)
+        results = {}
+        for name, fn in benchmarks.items():
+            us, calibration_us = time_relative(fn, repeat)
+            results[name] = us / calibration_us * calibration
+
+    return calibration, results
+
+
+def get_regressed(
+    calibration: float, results: Dict[str, float], threshold: float
+) -> List[str]:
+    baseline = load_baseline()
+    return [
+        name
+        for name, us in results.items()
+        if name in baseline and us / calibration / baseline[name] > threshold
+    ]
+
+
+def load_baseline() -> Dict[str, float]:
+    if not os.path.exists(BASELINE_PATH):
+        return {}
+    with open(BASELINE_PATH, "r") as f:
+        baseline: Dict[str, float] = json.load(f)["relative"]
+    return baseline
+
+
+def write_baseline(calibration: float, results: Dict[str, float]) -> None:
+    baseline = {
+        "calibration_us": round(calibration, 3),
+        "relative": {k: round(v / calibration, 4) for k, v in results.items()},
+    }
+    with open(BASELINE_PATH, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"Wrote baseline to {BASELINE_PATH}")
+
+
+def compare(
+    calibration: float, results: Dict[str, float], threshold: float
+) -> Tuple[List[str], List[str]]:
+    """Returns (benchmarks that regressed, benchmarks with no baseline to compare against)."""
+    baseline = load_baseline()
+    regressions = []
+    missing = []
+
+    print(f"{'benchmark':<30} {'us/call':>12} {'baseline':>12} {'ratio':>8}")
+    for name, us in results.items():
+        relative = us / calibration
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<30} {us:>12.2f} {'-':>12} {'new':>8}  NO BASELINE")
+            missing.append(name)
+            continue
+
+        ratio = relative / base
+        status = "" if ratio <= threshold else "  REGRESSED"
+        print(f"{name:<30} {us:>12.2f} {base * calibration:>12.2f} {ratio:>8.2f}{status}")
+        if ratio > threshold:
+            regressions.append(name)
+
+    return regressions, missing
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Smart Notes microbenchmarks")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Fail if a benchmark is this many times slower than baseline",
+    )
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument(
+        "--memory", action="store_true", help="Measure batch memory instead of timing"
+    )
+    args = parser.parse_args()
+
+    if args.memory:
+        return run_memory()
+
+    benchmarks = make_benchmarks(make_fixtures())
+    calibration, results = run(benchmarks, args.repeat)
+
+    if args.update_baseline:
+        write_baseline(calibration, results)
+        return 0
+
+    # A one-off slow round on a busy machine isn't a regression; one that's still slow after a rerun is
+    for _ in range(CONFIRM_RUNS):
+        suspects = get_regressed(calibration, results, args.threshold)
+        if not suspects:
+            break
+        print(f"Timing again: {', '.join(suspects)}", file=sys.stderr)
+        _, retimed = run(
+            {name: benchmarks[name] for name in suspects}, args.repeat, calibration
+        )
+        for name, us in retimed.items():
+            results[name] = min(results[name], us)
+
+    regressions, missing = compare(calibration, results, args.threshold)
+    if regressions:
+        print(f"\nRegressed beyond {args.threshold}x: {', '.join(regressions)}")
+    if missing:
+        # Ungated until someone records one; commit a baseline with every new benchmark
+        print(f"\nNo baseline for: {', '.join(missing)}; run with --update-baseline")
+    if regressions or missing:
+        return 1
+
+    print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
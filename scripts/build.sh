@@ -84,6 +84,14 @@ test-dev () {
   anki
 }
 
+bench () {
+  python scripts/benchmark.py "$@"
+}
+
+profile-imports () {
+  env/bin/python scripts/import_profile.py "$@"
+}
+
 test-build () {
   clean
   build
@@ -99,6 +107,10 @@ elif [ "$1" == "test-dev" ]; then
   test-dev
 elif [ "$1" == "test-build" ]; then
   test-build
+elif [ "$1" == "bench" ]; then
+  bench "${@:2}"
+elif [ "$1" == "profile-imports" ]; then
+  profile-imports "${@:2}"
 else
   echo "Invalid argument: $1"
 fi
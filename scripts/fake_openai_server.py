@@ -0,0 +1,161 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""
+Local stand-in for OpenAI's chat completions endpoint, for exercising the CLI and
+benchmarks without spending tokens:
+
+    python scripts/fake_openai_server.py --port 8765 --latency 0.2 --error-rate 0.05
+    python -m src.cli collection.anki2 --config cfg.json --api-base http://localhost:8765/v1
+
+Replies echo the last line of the prompt, cut short by max_tokens. --error-rate returns 429s at random, and
+--tail-rate makes that fraction of requests take --tail-latency seconds (a long tail).
+--valid-key rejects any other API key with a 401, like a misconfigured add-on would see.
+Like OpenAI's prompt caching, prompts that start the same way as an earlier one (over 1024
+tokens, in 128 token steps) report the shared part as cached_tokens.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from typing import Set, Union
+
+from aiohttp import web
+
+# In characters, at roughly 4 a token
+MIN_CACHED_PREFIX = 1024 * 4
+CACHED_PREFIX_STEP = 128 * 4
+MAX_CACHED_PREFIXES = 100_000
+
+
+def get_cached_length(text: str, seen_prefixes: Set[int]) -> int:
+    """Characters at the start of text that an earlier prompt started with too, and remembers this one's."""
+    cached = 0
+    for end in range(MIN_CACHED_PREFIX, len(text) + 1, CACHED_PREFIX_STEP):
+        prefix = hash(text[:end])
+        if prefix in seen_prefixes:
+            cached = end
+        elif len(seen_prefixes) < MAX_CACHED_PREFIXES:
+            seen_prefixes.add(prefix)
+    return cached
+
+
+def make_app(
+    latency: float,
+    jitter: float,
+    error_rate: float,
+    tail_rate: float = 0.0,
+    tail_latency: float = 0.0,
+    valid_key: Union[str, None] = None,
+) -> web.Application:
+    stats = {"requests": 0, "errors": 0}
+    seen_prefixes: Set[int] = set()
+
+    async def chat_completions(request: web.Request) -> web.Response:
+        body = await request.json()
+        stats["requests"] += 1
+
+        if valid_key and request.headers.get("Authorization") != f"Bearer {valid_key}":
+            stats["errors"] += 1
+            return web.json_response(
+                {"error": {"message": "Incorrect API key provided", "code": "invalid_api_key"}},
+                status=401,
+            )
+
+        delay = latency + random.uniform(0, jitter)
+        if random.random() < tail_rate:
+            delay = tail_latency
+        await asyncio.sleep(delay)
+
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={"Retry-After": "1"},
+            )
+
+        prompt = body["messages"][-1]["content"]
+        content = f"Generated: {prompt.strip().splitlines()[-1][:200]}"
+        finish_reason = "stop"
+        # Roughly 4 characters a token, like the usage numbers below
+        max_tokens = body.get("max_tokens")
+        if max_tokens and len(content) > max_tokens * 4:
+            content = content[: max_tokens * 4]
+            finish_reason = "length"
+        full_prompt = "".join(message["content"] for message in body["messages"])
+        prompt_tokens = len(full_prompt) // 4
+        cached_tokens = get_cached_length(full_prompt, seen_prefixes) // 4
+        completion_tokens = len(content) // 4
+
+        return web.json_response(
+            {
+                "id": f"chatcmpl-{stats['requests']}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": finish_reason,
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "prompt_tokens_details": {"cached_tokens": cached_tokens},
+                },
+            }
+        )
+
+    async def get_stats(_: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.1, help="Base seconds per request")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Extra random seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--tail-rate", type=float, default=0.0)
+    parser.add_argument("--tail-latency", type=float, default=3.0)
+    parser.add_argument("--valid-key", help="Reject requests with any other API key")
+    args = parser.parse_args()
+
+    web.run_app(
+        make_app(
+            args.latency,
+            args.jitter,
+            args.error_rate,
+            args.tail_rate,
+            args.tail_latency,
+            args.valid_key,
+        ),
+        host="127.0.0.1",
+        port=args.port,
+    )
@@ -0,0 +1,98 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""
+Import-time profile of the add-on, to keep Anki's startup cost measurable:
+
+    python scripts/import_profile.py                          # the whole add-on (needs aqt installed)
+    python scripts/import_profile.py --module src.core.engine # just the headless engine
+
+Runs the import under `python -X importtime` in a fresh interpreter and reports the total,
+the slowest modules, and whether modules that should be lazily imported snuck back into startup.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Should only be imported on first use, never at startup
+LAZY_MODULES = ["aiohttp", "sentry_sdk", "dotenv"]
+
+
+def profile_import(module: str) -> List[Tuple[int, int, str]]:
+    """Returns (self us, cumulative us, name) for every module the import pulled in."""
+    if module:
+        parent, code = ROOT, f"import {module}"
+    else:
+        # The add-on is a package named after its folder (which may contain a hyphen)
+        parent = os.path.dirname(ROOT)
+        code = f"import importlib; importlib.import_module({os.path.basename(ROOT)!r})"
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=parent,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr[-2000:])
+        raise SystemExit(f"Import failed: {code}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Smart Notes import-time profile")
+    parser.add_argument(
+        "--module", default="", help="Profile this module instead of the whole add-on"
+    )
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    rows = profile_import(args.module)
+    names = {name.strip() for _, _, name in rows}
+
+    # The last top-level entry is the module we asked for
+    target = rows[-1]
+    print(f"Total: {target[1] / 1000:.1f}ms to import {target[2].strip()}\n")
+
+    print(f"Slowest {args.top} modules (cumulative ms):")
+    for self_us, cumulative_us, name in sorted(rows, key=lambda r: -r[1])[: args.top]:
+        print(f"  {cumulative_us / 1000:8.1f}  {self_us / 1000:8.1f} self  {name.strip()}")
+
+    print("\nLazily imported modules:")
+    eager = [m for m in LAZY_MODULES if m in names]
+    for module in LAZY_MODULES:
+        print(f"  {module:<12} {'IMPORTED AT STARTUP' if module in eager else 'ok'}")
+
+    return 1 if eager else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
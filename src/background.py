@@ -0,0 +1,317 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Fills in smart fields in the background, without anyone launching a batch.
+
+Notes needing generation sit in a WorkQueue. Newly added and imported notes go in at normal
+priority and are generated straight away, in batches. When Anki is idle, the backfill finds notes
+with empty smart fields (soonest due first) and works through them at backfill_notes_per_minute;
+reviewing or editing pauses it."""
+
+import time
+from typing import List, Sequence, Tuple, Union
+
+from anki.errors import NotFoundError
+from anki.notes import Note, NoteId
+from anki.utils import ids2str
+from anki.collection import OpChanges
+from aqt import QTimer, editor, mw
+
+from .config import config
+from .core.budget import BudgetExceededError, BudgetTracker
+from .core.note_records import NoteRecord, read_note_records
+from .core.prompts import get_missing_fields_search
+from .core.work_queue import PRIORITY_BACKFILL, PRIORITY_NORMAL, WorkQueue
+from .processor import Processor, run_async_in_background
+from .sentry import report_exception
+
+TICK_MS = 2000
+# Seconds without reviewing or editing before Anki counts as idle
+IDLE_SECONDS = 60
+# How often to look for notes that need backfilling, once the queue runs dry
+REFILL_INTERVAL_SECONDS = 10 * 60
+MAX_BACKFILL_CANDIDATES = 5000
+# New notes generated per batch; big imports go through in several
+NEW_NOTES_BATCH_SIZE = 100
+
+# Learning cards are due soonest (due is a timestamp), then reviews and day learning cards (due is
+# a day number for both), then new cards (by position). Each rank's due is in one unit.
+DUE_ORDER = "(case c.queue when 1 then 0 when 2 then 1 when 3 then 1 when 0 then 2 else 3 end), c.due"
+
+
+class BackgroundGenerator:
+    def __init__(self, processor: Processor) -> None:
+        self.processor = processor
+        self.queue = WorkQueue()
+        self.timer: Union[QTimer, None] = None
+        self.is_generating = False
+        self.is_refilling = False
+        self.last_activity = time.monotonic()
+        self.last_refill: Union[float, None] = None
+        self.last_backfill = 0.0
+        # Notes created after this are checked for empty smart fields after an add or import. Note
+        # ids are creation times in epoch milliseconds; mod times change on any edit
+        self.id_watermark = int(time.time() * 1000)
+        self.is_scanning = False
+
+    @property
+    def budget(self) -> BudgetTracker:
+        return self.processor.budget
+
+    def start(self) -> None:
+        if self.timer or not mw:
+            return
+        self.timer = QTimer(mw)
+        self.timer.timeout.connect(self.on_tick)
+        self.timer.start(TICK_MS)
+
+    def stop(self) -> None:
+        if self.timer:
+            self.timer.stop()
+            self.timer = None
+
+    def on_user_activity(self) -> None:
+        """Called on reviews and edits; backfill waits until the user has been idle for a while."""
+        self.last_activity = time.monotonic()
+
+    def on_note_added(self, note: Note) -> None:
+        if config.generate_on_add and self.processor.engine.get_field_prompts(note):
+            self.queue.push(note.id, PRIORITY_NORMAL)
+
+    def on_operation(self, changes: OpChanges, handler: Union[object, None]) -> None:
+        """Picks up notes that arrived some other way than the Add window, e.g. imports.
+
+        Only after adds and imports: edits (find and replace, changing note type, other add-ons)
+        are the user's to generate. Notes an apkg brings in keep their original ids, so only the
+        backfill finds those."""
+        if not changes.note or isinstance(handler, editor.Editor):
+            return
+        if config.generate_on_add and self.is_add_or_import():
+            self.scan_new_notes()
+
+    def is_add_or_import(self) -> bool:
+        """Whether the last op added or imported notes. Ops don't say what they were, but their undo step does."""
+        if not mw or not mw.col:
+            return False
+        tr = mw.col.tr
+        return mw.col.undo_status().undo in (tr.actions_add_note(), tr.actions_import())
+
+    def scan_new_notes(self) -> None:
+        if self.is_scanning or not mw:
+            return
+
+        search = get_missing_fields_search(config.prompts_map)
+        if not search:
+            return
+
+        self.is_scanning = True
+        since = self.id_watermark
+        # A second of overlap so nothing added mid-scan slips through; the queue dedupes
+        self.id_watermark = int(time.time() * 1000) - 1000
+
+        async def find_notes() -> Sequence[NoteId]:
+            if not mw or not mw.col.db:
+                return []
+            created = mw.col.db.list("select id from notes where id >= ?", since)
+            if not created:
+                return []
+            return mw.col.find_notes(f"nid:{','.join(map(str, created))} ({search})")
+
+        def on_success(note_ids: Sequence[NoteId]) -> None:
+            self.is_scanning = False
+            if note_ids:
+                print(f"Smart Notes: queueing {len(note_ids)} new notes")
+            for note_id in note_ids:
+                self.queue.push(note_id, PRIORITY_NORMAL)
+
+        def on_failure(e: Exception) -> None:
+            self.is_scanning = False
+            report_exception(e)
+
+        run_async_in_background(find_notes, on_success, on_failure, report_errors=False)
+
+    def is_idle(self) -> bool:
+        if not mw or mw.state == "review":
+            return False
+        return time.monotonic() - self.last_activity > IDLE_SECONDS
+
+    def on_tick(self) -> None:
+        # One thing at a time: wait for batches and editor requests to finish first
+        if not mw or not mw.col or self.is_generating or self.processor.req_in_progress:
+            return
+
+        if self.queue.peek_priority() == PRIORITY_NORMAL:
+            self.generate_new_notes()
+            return
+
+        # Out of today's budget: nothing more until tomorrow
+        if not config.backfill_enabled or not self.is_idle() or self.budget.get_exceeded():
+            return
+
+        if not self.queue.count(PRIORITY_BACKFILL):
+            self.refill()
+            return
+
+        rate = max(config.backfill_notes_per_minute or 1, 1)
+        if time.monotonic() - self.last_backfill < 60 / rate:
+            return
+
+        note_id = self.queue.pop()
+        if note_id is not None:
+            self.last_backfill = time.monotonic()
+            self.generate(NoteId(note_id))
+
+    def refill(self) -> None:
+        """Queues notes with empty smart fields, soonest due first. Searches in the background."""
+        if self.is_refilling or not mw or not config.openai_api_key:
+            return
+        if self.last_refill and time.monotonic() - self.last_refill < REFILL_INTERVAL_SECONDS:
+            return
+
+        search = get_missing_fields_search(config.prompts_map)
+        if not search:
+            return
+
+        self.is_refilling = True
+        self.last_refill = time.monotonic()
+
+        async def find_candidates() -> List[NoteId]:
+            if not mw or not mw.col.db:
+                return []
+            card_ids = mw.col.find_cards(search, order=DUE_ORDER)
+            note_id_for_card = {
+                card_id: note_id
+                for card_id, note_id in mw.col.db.all(
+                    f"select id, nid from cards where id in {ids2str(card_ids)}"
+                )
+            }
+
+            # Notes a spend limit paused go first, then each note in line by its soonest due card
+            note_ids = [NoteId(note_id) for note_id in self.budget.ledger.get_paused()]
+            seen = set(note_ids)
+            for card_id in card_ids:
+                note_id = note_id_for_card[card_id]
+                if note_id not in seen:
+                    seen.add(note_id)
+                    note_ids.append(note_id)
+                    if len(note_ids) >= MAX_BACKFILL_CANDIDATES:
+                        break
+            return note_ids
+
+        def on_success(note_ids: List[NoteId]) -> None:
+            self.is_refilling = False
+            print(f"Smart Notes: {len(note_ids)} notes to backfill")
+            for i, note_id in enumerate(note_ids):
+                self.queue.push(note_id, PRIORITY_BACKFILL, i)
+
+        def on_failure(e: Exception) -> None:
+            self.is_refilling = False
+            report_exception(e)
+
+        run_async_in_background(
+            find_candidates, on_success, on_failure, report_errors=False
+        )
+
+    def generate_new_notes(self) -> None:
+        """Generates a batch of queued new notes through the batch pipeline (cache, retries, adaptive rate limit)."""
+        note_ids: List[NoteId] = []
+        while len(note_ids) < NEW_NOTES_BATCH_SIZE:
+            note_id = self.queue.pop(max_priority=PRIORITY_NORMAL)
+            if note_id is None:
+                break
+            note_ids.append(NoteId(note_id))
+
+        # Left for the backfill to pick up once there's budget again
+        if self.budget.get_exceeded():
+            self.budget.ledger.pause(note_ids)
+            return
+
+        self.is_generating = True
+        self.processor.refresh_config()
+        prompts_map = self.processor.engine_config.prompts_map
+
+        async def process() -> List[NoteRecord]:
+            if not mw:
+                return []
+            # Deleted notes just aren't read
+            records = [
+                record
+                for record in read_note_records(mw.col, note_ids, prompts_map)
+                if self.processor.engine.get_field_prompts(record)
+            ]
+            if not records:
+                return []
+
+            paused: List[NoteId] = []
+
+            def on_error(note: NoteRecord, e: BaseException) -> None:
+                if isinstance(e, BudgetExceededError):
+                    paused.append(note.id)
+                else:
+                    report_exception(e)
+
+            updated, _ = await self.processor.engine.process_notes(
+                records, on_error=on_error
+            )
+            self.budget.ledger.pause(paused)
+            return updated
+
+        def on_success(updated: List[NoteRecord]) -> None:
+            self.is_generating = False
+            self.processor.writer.write_all(updated)
+
+        def on_failure(e: Exception) -> None:
+            self.is_generating = False
+            print(f"Smart Notes: generating new notes failed: {e}")
+            report_exception(e)
+
+        run_async_in_background(process, on_success, on_failure, report_errors=False)
+
+    def generate(self, note_id: NoteId) -> None:
+        self.is_generating = True
+        self.processor.refresh_config()
+
+        async def process() -> Tuple[Union[Note, None], List[str]]:
+            if not mw:
+                return (None, [])
+            try:
+                note = mw.col.get_note(note_id)
+            except NotFoundError:
+                # Deleted since it was queued
+                self.budget.ledger.unpause([note_id])
+                return (None, [])
+            changed = await self.processor.engine.process_note(note, lane="batch")
+            self.budget.ledger.unpause([note_id])
+            return (note, changed)
+
+        def on_success(res: Tuple[Union[Note, None], List[str]]) -> None:
+            self.is_generating = False
+            note, changed = res
+            if note and changed:
+                self.processor.writer.write(note, changed)
+
+        def on_failure(e: Exception) -> None:
+            self.is_generating = False
+            if isinstance(e, BudgetExceededError):
+                self.budget.ledger.pause([note_id])
+                return
+            print(f"Smart Notes: background generation failed: {e}")
+            report_exception(e)
+
+        run_async_in_background(process, on_success, on_failure, report_errors=False)
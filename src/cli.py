@@ -0,0 +1,305 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""
+Headless batch runner: generates smart fields over a collection file without the Anki GUI.
+
+    python -m src.cli ~/collection.anki2 --query "deck:Japanese" --config smart_fields.json
+
+The config file has the same shape as the add-on's config (openai_api_key, openai_model,
+prompts_map); OPENAI_API_KEY in the environment overrides the key. Progress goes to stderr,
+the final JSON report to stdout (or --report). Close Anki before running this against the
+same collection.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Sequence, Set
+
+from anki.collection import Collection
+from anki.notes import NoteId
+
+from .core.budget import BudgetExceededError, BudgetTracker, SpendLedger
+from .core.cache import ResponseCache
+from .core.config import StaticConfig
+from .core.engine import Engine
+from .core.field_status import (
+    FingerprintStore,
+    get_fingerprints_path,
+    record_fingerprints,
+)
+from .core.jobs import FieldJob
+from .core.note_records import NoteRecord, materialize_notes, read_note_records
+from .core.open_ai_client import OPENAI_API_BASE, OpenAIClient
+from .core.prompts import get_smart_fields_search
+from .core.retry import RetryPolicy
+from .core.scheduler import Scheduler
+from .core.similarity import SimilarResponses
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_CONCURRENCY = 32
+MAX_REPORTED_FAILURES = 1000
+# A spend limit stopped the run; what's left is saved for --resume
+EXIT_PAUSED = 3
+
+
+def parse_args(argv: Sequence[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="smart-notes", description="Generate Smart Notes fields headlessly."
+    )
+    parser.add_argument("collection", help="Path to a .anki2 collection file")
+    parser.add_argument("--query", default="", help="Anki search to select notes")
+    parser.add_argument(
+        "--config", required=True, help="JSON file with openai_model and prompts_map"
+    )
+    parser.add_argument("--api-base", default=OPENAI_API_BASE)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Most requests in flight; the actual limit adapts to rate limits and latency",
+    )
+    parser.add_argument("--max-attempts", type=int, default=4)
+    parser.add_argument(
+        "--cache", help="sqlite file to persist responses in, so reruns don't re-buy them"
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="Regenerate fields that already have a value"
+    )
+    parser.add_argument(
+        "--max-tokens", type=int, help="Stop the run once it has used this many tokens"
+    )
+    parser.add_argument(
+        "--max-dollars", type=float, help="Stop the run once it has spent this much"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Only generate the notes a spend limit left for later (that match --query)",
+    )
+    parser.add_argument("--report", help="Write the JSON report here instead of stdout")
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show the engine's per-note logging"
+    )
+    return parser.parse_args(argv)
+
+
+def load_config(path: str) -> StaticConfig:
+    with open(path, "r") as f:
+        config = StaticConfig.from_dict(json.load(f))
+
+    config.openai_api_key = os.getenv("OPENAI_API_KEY") or config.openai_api_key
+    if not config.openai_api_key:
+        raise SystemExit("No OpenAI API key: set openai_api_key in the config or OPENAI_API_KEY")
+    if not config.prompts_map["note_types"]:
+        raise SystemExit("No smart fields in config's prompts_map")
+
+    return config
+
+
+def print_progress(done: int, total: int, updated: int, failed: int, start: float) -> None:
+    elapsed = time.monotonic() - start
+    rate = done / elapsed if elapsed else 0.0
+    eta = (total - done) / rate if rate else 0.0
+    percent = done / total * 100 if total else 100.0
+    sys.stderr.write(
+        f"\r[{done}/{total}] {percent:5.1f}% updated={updated} failed={failed} "
+        f"{rate:.1f} notes/s eta={eta:.0f}s"
+    )
+    sys.stderr.flush()
+
+
+async def run(
+    col: Collection,
+    engine: Engine,
+    fingerprints: FingerprintStore,
+    budget: BudgetTracker,
+    args: argparse.Namespace,
+) -> Dict[str, Any]:
+    config = engine.config
+    search = get_smart_fields_search(args.query, config.prompts_map)
+    if not search:
+        raise SystemExit("No smart fields in config's prompts_map")
+    if args.resume:
+        resumable = budget.ledger.get_paused()
+        search = f"nid:{','.join(map(str, resumable))} ({search})" if resumable else ""
+    note_ids = col.find_notes(search) if search else []
+    total = len(note_ids)
+    start = time.monotonic()
+
+    updated = 0
+    failed_ids: List[NoteId] = []
+    paused_ids: List[NoteId] = []
+    budget.start_run()
+    # note type -> field -> status (and requests made) -> count
+    field_stats: Dict[str, Dict[str, Dict[str, int]]] = {}
+
+    def on_field_done(note: NoteRecord, job: FieldJob) -> None:
+        counts = field_stats.setdefault(note.note_type_name, {})
+        field_counts = counts.setdefault(
+            job.field, {"generated": 0, "unchanged": 0, "failed": 0, "skipped": 0, "requests": 0}
+        )
+        field_counts[job.status] += 1
+        field_counts["requests"] += job.attempts
+
+    print_progress(0, total, 0, 0, start)
+
+    for i in range(0, total, args.chunk_size):
+        # Out of budget: save the rest for --resume rather than failing every one
+        if budget.get_exceeded():
+            paused_ids.extend(note_ids[i:])
+            break
+        # The API key or quota is bad: the rest would fail one at a time
+        if engine.client.circuit_breaker.is_open():
+            failed_ids.extend(note_ids[i:])
+            break
+
+        chunk = note_ids[i : i + args.chunk_size]
+        notes = read_note_records(col, chunk, config.prompts_map)
+        paused: Set[NoteId] = set()
+
+        def on_error(note: NoteRecord, e: BaseException) -> None:
+            if isinstance(e, BudgetExceededError):
+                paused.add(note.id)
+
+        with contextlib.ExitStack() as stack:
+            if not args.verbose:
+                devnull = stack.enter_context(open(os.devnull, "w"))
+                stack.enter_context(contextlib.redirect_stdout(devnull))
+            notes_to_update, failed = await engine.process_notes(
+                notes,
+                overwrite_fields=args.overwrite,
+                on_error=on_error,
+                on_field_done=on_field_done,
+            )
+
+            # Write as we go so an interrupted run keeps what it paid for
+            if notes_to_update:
+                col.update_notes(materialize_notes(col, notes_to_update))
+                # Shared with the add-on, so smart:stale knows what these were generated from
+                record_fingerprints(
+                    col,
+                    engine,
+                    fingerprints,
+                    [(note, list(note.changed)) for note in notes_to_update],
+                )
+        updated += len(notes_to_update)
+        failed_ids.extend(note.id for note in failed if note.id not in paused)
+        paused_ids.extend(paused)
+        budget.ledger.unpause([note_id for note_id in chunk if note_id not in paused])
+        print_progress(i + len(chunk), total, updated, len(failed_ids), start)
+
+    sys.stderr.write("\n")
+    budget.ledger.pause(paused_ids)
+    tokens, dollars = budget.end_run()
+    # A bad API key or quota, or a spend limit
+    stopped_by = engine.client.circuit_breaker.get_open_error() or budget.last_error
+
+    return {
+        "collection": args.collection,
+        "query": args.query,
+        "model": config.openai_model,
+        "total": total,
+        "updated": updated,
+        "failed": len(failed_ids),
+        "failed_note_ids": failed_ids[:MAX_REPORTED_FAILURES],
+        # Left for --resume because a spend limit was reached
+        "paused": len(paused_ids),
+        "stopped_by": stopped_by.args[0] if stopped_by else None,
+        "spent": {"tokens": tokens, "dollars": round(dollars, 4)},
+        # Notes regenerated with exactly what they already had, so not rewritten
+        "unchanged": int(engine.client.metrics.count("writes.elided")),
+        "fields": field_stats,
+        # Fields not generated because a field their prompt requires is empty
+        "skipped_empty_inputs": int(engine.client.metrics.count("skipped.empty_inputs")),
+        "tokens": {
+            "prompt": int(engine.client.metrics.count("tokens.prompt")),
+            # Of the prompt tokens, those OpenAI reused from an earlier request's prefix
+            "cached": int(engine.client.metrics.count("tokens.cached")),
+            "completion": int(engine.client.metrics.count("tokens.completion")),
+        },
+        "cache_hits": engine.cache.hits,
+        "cache_misses": engine.cache.misses,
+        # Responses reused for nearly the same inputs, on fields with a similarity_threshold
+        "similar_hits": int(engine.client.metrics.count("similar.hits")),
+        # Seed concurrency_limits in the config with this to start the next run here
+        "concurrency_limits": engine.scheduler.learned_limits(),
+        "elapsed_seconds": round(time.monotonic() - start, 2),
+    }
+
+
+def main(argv: Sequence[str]) -> int:
+    args = parse_args(argv)
+    config = load_config(args.config)
+    if args.max_tokens is not None or args.max_dollars is not None:
+        run_budget = dict(config.budgets.get("run") or {})
+        if args.max_tokens is not None:
+            run_budget["hard_tokens"] = args.max_tokens
+        if args.max_dollars is not None:
+            run_budget["hard_dollars"] = args.max_dollars
+        config.budgets = {**config.budgets, "run": run_budget}  # type: ignore[typeddict-item]
+
+    # Shares the add-on's ledger, so the daily budgets count both
+    budget = BudgetTracker(
+        config, SpendLedger(get_fingerprints_path(args.collection))
+    )
+    engine = Engine(
+        OpenAIClient(config, api_base=args.api_base),
+        config,
+        scheduler=Scheduler(
+            max_in_flight=args.concurrency,
+            max_concurrency=args.concurrency,
+            budget=budget,
+        ),
+        cache=ResponseCache(path=args.cache),
+        retry_policy=RetryPolicy(max_attempts=args.max_attempts),
+        similar=SimilarResponses(path=args.cache),
+    )
+
+    col = Collection(args.collection)
+    fingerprints = FingerprintStore(get_fingerprints_path(args.collection))
+    try:
+        report = asyncio.run(run(col, engine, fingerprints, budget, args))
+    finally:
+        engine.cache.close()
+        engine.similar.close()
+        budget.close()
+        fingerprints.close()
+        col.close()
+
+    output = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if report["failed"]:
+        return 1
+    return EXIT_PAUSED if report["paused"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -17,19 +17,17 @@
  along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from typing import Dict, TypedDict, Literal, Any, Union
+from typing import Dict, Any, Union
 from aqt import mw, addons
 
-
-class NoteTypeMap(TypedDict):
-    fields: Dict[str, str]
-
-
-class PromptMap(TypedDict):
-    note_types: Dict[str, NoteTypeMap]
-
-
-OpenAIModels = Literal["gpt-3.5-turbo", "gpt-4o", "gpt-4-turbo", "gpt-4"]
+from .core.config import (
+    Budgets,
+    LaneTimeouts,
+    ModelPrice,
+    OpenAIModels,
+    PromptMap,
+    StaticConfig,
+)
 
 
 class Config:
@@ -43,6 +41,20 @@ class Config:
     did_show_rate_dialog: bool
     last_seen_version: Union[str, None]
     uuid: Union[str, None]
+    sentry_sample_rate: float
+    hedge_interactive_requests: bool
+    hedge_percentile: float
+    hedge_max_rate: float
+    lane_timeouts: Dict[str, LaneTimeouts]
+    concurrency_limits: Dict[str, int]
+    circuit_breaker_threshold: int
+    circuit_breaker_cool_down: float
+    budgets: Budgets
+    model_prices: Dict[str, ModelPrice]
+    generate_on_add: bool
+    speculative_generation: bool
+    backfill_enabled: bool
+    backfill_notes_per_minute: float
 
     def __getattr__(self, key: str) -> object:
         if not mw:
@@ -64,6 +76,13 @@ class Config:
         old_config[name] = value
         mw.addonManager.writeConfig(__name__, old_config)
 
+    def snapshot(self) -> StaticConfig:
+        """The engine's settings as they are now. Every attribute read above goes to disk, so
+        the engine works off a snapshot instead."""
+        if not mw:
+            raise Exception("Error: mw not found")
+        return StaticConfig.from_dict(mw.addonManager.getConfig(__name__) or {})
+
     def get_prompt(self, note_type: str, field: str):
         return (
             self.prompts_map.get("note_types", {})
@@ -0,0 +1,304 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+"""Spend budgets: tallies the tokens and dollars batch requests actually used (from each response's
+usage), per run, per day and per note type, and says when to slow down or stop.
+
+Daily spend and notes paused by a hard limit are kept in a ledger next to the collection, shared
+by the add-on and the headless runner, so a limit holds across sessions."""
+
+import asyncio
+import datetime
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Sequence, Tuple, Union
+
+from .config import Budget, EngineConfig, ModelPrice
+
+# Dollars per million tokens. Approximate: configure model_prices to match your plan.
+DEFAULT_MODEL_PRICES: Dict[str, ModelPrice] = {
+    "gpt-3.5-turbo": {"input": 0.5, "cached_input": 0.5, "output": 1.5},
+    "gpt-4o": {"input": 2.5, "cached_input": 1.25, "output": 10.0},
+    "gpt-4-turbo": {"input": 10.0, "cached_input": 10.0, "output": 30.0},
+    "gpt-4": {"input": 30.0, "cached_input": 30.0, "output": 60.0},
+}
+# Models without a price are counted at the dearest, so a dollar limit errs on stopping early
+FALLBACK_MODEL = "gpt-4"
+
+# Seconds between requests once a soft limit is passed
+SOFT_LIMIT_INTERVAL = 2.0
+
+# The client adds each response's usage here when set, so whoever set it can tally what it spent
+usage_sink: ContextVar[Union[List[Dict[str, Any]], None]] = ContextVar(
+    "usage_sink", default=None
+)
+
+
+class RunSpend:
+    """What one run has spent so far, and what stopped it."""
+
+    __slots__ = ("tokens", "dollars", "error")
+
+    def __init__(self) -> None:
+        self.tokens = 0
+        self.dollars = 0.0
+        self.error: Union["BudgetExceededError", None] = None
+
+
+# The run the current task belongs to. A batch and background generation can go at the same
+# time, on different threads; each only counts against its own run.
+current_run: ContextVar[Union[RunSpend, None]] = ContextVar("current_run", default=None)
+
+
+class BudgetExceededError(Exception):
+    """Raised instead of sending a request once a hard limit is reached."""
+
+    def __init__(self, scope: str) -> None:
+        super().__init__(f"the {scope} spend limit was reached")
+        self.scope = scope
+
+
+def get_today() -> str:
+    return datetime.date.today().isoformat()
+
+
+def get_cost(
+    model: str, usage: Dict[str, Any], prices: Union[Dict[str, ModelPrice], None] = None
+) -> float:
+    """Dollars a response's usage cost."""
+    price = (prices or {}).get(model) or DEFAULT_MODEL_PRICES.get(
+        model, DEFAULT_MODEL_PRICES[FALLBACK_MODEL]
+    )
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+    uncached = usage.get("prompt_tokens", 0) - cached
+    cost: float = (
+        uncached * price["input"]
+        + cached * price["cached_input"]
+        + usage.get("completion_tokens", 0) * price["output"]
+    ) / 1_000_000
+    return cost
+
+
+class SpendLedger:
+    """Tokens and dollars spent per day and note type, and the notes a hard limit left for later.
+    In memory without a path."""
+
+    def __init__(self, path: Union[str, None] = None) -> None:
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._db.execute(
+            "create table if not exists spend (day text not null, note_type text not null, "
+            "tokens integer not null, dollars real not null, primary key (day, note_type))"
+        )
+        self._db.execute(
+            "create table if not exists paused_notes (note_id integer primary key)"
+        )
+        # (day, note type) -> [tokens, dollars], so checking a budget doesn't hit the database
+        self._totals: Dict[Tuple[str, str], List[float]] = {}
+        self._loaded_day: Union[str, None] = None
+
+    def add(self, day: str, note_type: str, tokens: int, dollars: float) -> None:
+        with self._lock:
+            self._load(day)
+            totals = self._totals.setdefault((day, note_type), [0, 0.0])
+            totals[0] += tokens
+            totals[1] += dollars
+            self._db.execute(
+                "insert or replace into spend values (?, ?, ?, ?)",
+                (day, note_type, int(totals[0]), totals[1]),
+            )
+            self._db.commit()
+
+    def get(self, day: str, note_type: Union[str, None] = None) -> Tuple[int, float]:
+        """(tokens, dollars) spent on the day, on one note type or all of them."""
+        with self._lock:
+            self._load(day)
+            rows = [
+                totals
+                for (d, t), totals in self._totals.items()
+                if d == day and (note_type is None or t == note_type)
+            ]
+        return (int(sum(row[0] for row in rows)), sum(row[1] for row in rows))
+
+    def pause(self, note_ids: Sequence[int]) -> None:
+        with self._lock:
+            self._db.executemany(
+                "insert or ignore into paused_notes values (?)",
+                [(note_id,) for note_id in note_ids],
+            )
+            self._db.commit()
+
+    def unpause(self, note_ids: Sequence[int]) -> None:
+        with self._lock:
+            self._db.executemany(
+                "delete from paused_notes where note_id = ?",
+                [(note_id,) for note_id in note_ids],
+            )
+            self._db.commit()
+
+    def get_paused(self) -> List[int]:
+        with self._lock:
+            return [
+                row[0]
+                for row in self._db.execute(
+                    "select note_id from paused_notes order by rowid"
+                ).fetchall()
+            ]
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _load(self, day: str) -> None:
+        if self._loaded_day == day:
+            return
+        # Only today's totals are ever checked; drop the rest
+        self._totals = {
+            (day, note_type): [tokens, dollars]
+            for note_type, tokens, dollars in self._db.execute(
+                "select note_type, tokens, dollars from spend where day = ?", (day,)
+            ).fetchall()
+        }
+        self._loaded_day = day
+
+
+class BudgetTracker:
+    """Checks requests against the configured budgets and tallies what they spent.
+
+    The run budget only counts between start_run and end_run, for requests made from the task
+    that started the run (and tasks it starts). A hard limit can be overshot by the requests
+    already in flight when it's reached, but no more."""
+
+    def __init__(
+        self, config: EngineConfig, ledger: Union[SpendLedger, None] = None
+    ) -> None:
+        self.config = config
+        self.ledger = ledger or SpendLedger()
+        # What stopped the last run
+        self.last_error: Union[BudgetExceededError, None] = None
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def open(self, path: str) -> None:
+        """Switches to a ledger persisted at path."""
+        self.ledger.close()
+        self.ledger = SpendLedger(path)
+
+    def close(self) -> None:
+        self.ledger.close()
+        self.ledger = SpendLedger()
+
+    def start_run(self) -> None:
+        """Starts a run for the current task. Call from the coroutine the run's requests are made from."""
+        current_run.set(RunSpend())
+        self.last_error = None
+
+    def end_run(self) -> Tuple[int, float]:
+        """Ends the current task's run, returning (tokens, dollars) it spent."""
+        run = current_run.get()
+        current_run.set(None)
+        if not run:
+            return (0, 0.0)
+        self.last_error = run.error
+        return (run.tokens, run.dollars)
+
+    def get_exceeded(
+        self, note_type: Union[str, None] = None, soft: bool = False
+    ) -> Union[str, None]:
+        """The first budget whose hard limit (or soft, with soft) is reached: "run", "daily" or
+        the note type's daily one. Without a note type, only budgets shared by every note type."""
+        budgets = self.config.budgets or {}
+        today = get_today()
+        scopes: List[Tuple[str, Budget, Tuple[float, float]]] = []
+
+        run = current_run.get()
+        if run and budgets.get("run"):
+            scopes.append(("run", budgets["run"], (run.tokens, run.dollars)))
+        if budgets.get("day"):
+            scopes.append(("daily", budgets["day"], self.ledger.get(today)))
+        note_type_budget = (budgets.get("note_types") or {}).get(note_type or "")
+        if note_type and note_type_budget:
+            scopes.append(
+                (f"{note_type} daily", note_type_budget, self.ledger.get(today, note_type))
+            )
+
+        for scope, budget, (tokens, dollars) in scopes:
+            if soft:
+                max_tokens, max_dollars = budget.get("soft_tokens"), budget.get("soft_dollars")
+            else:
+                max_tokens, max_dollars = budget.get("hard_tokens"), budget.get("hard_dollars")
+            if (max_tokens is not None and tokens >= max_tokens) or (
+                max_dollars is not None and dollars >= max_dollars
+            ):
+                return scope
+        return None
+
+    def check(self, note_type: Union[str, None] = None) -> None:
+        """Raises BudgetExceededError if a hard limit is reached."""
+        scope = self.get_exceeded(note_type)
+        if scope:
+            error = BudgetExceededError(scope)
+            run = current_run.get()
+            if run:
+                run.error = error
+            raise error
+
+    async def wait(self, note_type: Union[str, None] = None) -> None:
+        """Waits for the request's turn: straight away under the soft limits, one every
+        SOFT_LIMIT_INTERVAL seconds past them. Raises BudgetExceededError at a hard limit."""
+        self.check(note_type)
+        if not self.get_exceeded(note_type, soft=True):
+            return
+
+        # Take the next free slot, so concurrent requests queue up rather than all going at once
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + SOFT_LIMIT_INTERVAL
+        # Others may spend the rest meanwhile; don't sleep on past a hard limit
+        while slot > time.monotonic():
+            await asyncio.sleep(min(slot - time.monotonic(), SOFT_LIMIT_INTERVAL))
+            self.check(note_type)
+
+    @contextmanager
+    def track(self, model: str, note_type: Union[str, None]) -> Iterator[None]:
+        """Records what the requests made inside spent, towards note_type's budget."""
+        usage: List[Dict[str, Any]] = []
+        token = usage_sink.set(usage)
+        try:
+            yield
+        finally:
+            usage_sink.reset(token)
+            for u in usage:
+                self.record(model, note_type, u)
+
+    def record(
+        self, model: str, note_type: Union[str, None], usage: Dict[str, Any]
+    ) -> None:
+        tokens = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+        dollars = get_cost(model, usage, self.config.model_prices)
+        run = current_run.get()
+        if run:
+            with self._lock:
+                run.tokens += tokens
+                run.dollars += dollars
+        self.ledger.add(get_today(), note_type or "", tokens, dollars)
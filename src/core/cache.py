@@ -0,0 +1,135 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Union
+
+
+class ResponseCache:
+    """Exact-match cache of chat responses, keyed on model + prompt + generation params.
+
+    Identical prompts in flight at the same time share a single request. Optionally
+    persists to a sqlite file so long backfills can be resumed without re-buying responses.
+    """
+
+    def __init__(self, max_entries: int = 10_000, path: Union[str, None] = None):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        # Thread safe futures: batches, background generation and the editor run their own event loops
+        self._in_flight: Dict[str, "Future[str]"] = {}
+        self._lock = threading.Lock()
+        self._db: Union[sqlite3.Connection, None] = None
+
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "create table if not exists responses (key text primary key, response text not null)"
+            )
+
+    @staticmethod
+    def make_key(
+        model: str, prompt: str, params: Union[Mapping[str, Any], None] = None
+    ) -> str:
+        """Generation params (max_tokens etc) are part of the key; without any, keys match older caches."""
+        key: List[Any] = [model, prompt]
+        if params:
+            key.append(params)
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> Union[str, None]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+            if self._db:
+                row = self._db.execute(
+                    "select response from responses where key = ?", (key,)
+                ).fetchone()
+                if row:
+                    self._remember(key, row[0])
+                    return str(row[0])
+
+        return None
+
+    def set(self, key: str, response: str) -> None:
+        with self._lock:
+            self._remember(key, response)
+            if self._db:
+                self._db.execute(
+                    "insert or replace into responses (key, response) values (?, ?)",
+                    (key, response),
+                )
+                self._db.commit()
+
+    async def get_or_fetch(
+        self, key: str, fetch: Callable[[], Awaitable[str]]
+    ) -> str:
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                future: "Future[str]" = Future()
+                self._in_flight[key] = future
+
+        # Someone else is already asking the same question, maybe from another event loop
+        if in_flight is not None:
+            self.hits += 1
+            return await asyncio.shield(asyncio.wrap_future(in_flight))
+
+        self.misses += 1
+        try:
+            response = await fetch()
+            self.set(key, response)
+            future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def close(self) -> None:
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    def _remember(self, key: str, response: str) -> None:
+        self._entries[key] = response
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
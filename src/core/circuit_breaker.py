@@ -0,0 +1,136 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+from typing import Union
+
+# Errors that will fail every request the same way until the user does something
+FATAL_ERROR_CLASSES = {
+    "auth": "OpenAI rejected the API key",
+    "quota": "Your OpenAI quota is exhausted",
+    "model": "Your API key doesn't have access to this model",
+}
+
+
+def get_fatal_error_class(e: BaseException) -> Union[str, None]:
+    """Which class of systemic error this is, if any. Transient errors (rate limits, 5xx, timeouts) return None.
+
+    Relies on the client putting OpenAI's error code in the response error's message."""
+    import aiohttp
+
+    if not isinstance(e, aiohttp.ClientResponseError):
+        return None
+    if e.status in (401, 403):
+        return "auth"
+    if e.status == 429 and e.message == "insufficient_quota":
+        return "quota"
+    if e.status == 404 and e.message == "model_not_found":
+        return "model"
+    return None
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while the circuit is open."""
+
+    def __init__(self, error_class: str, cause: Union[BaseException, None]) -> None:
+        super().__init__(
+            f"{FATAL_ERROR_CLASSES[error_class]}; not sending more requests for now"
+        )
+        self.error_class = error_class
+        self.cause = cause
+
+
+class CircuitBreaker:
+    """Stops sending requests after `threshold` consecutive fatal errors of one class.
+
+    Once open, requests fail immediately with CircuitOpenError. After `cool_down` seconds a
+    single probe request is let through (half-open): success closes the circuit, another
+    fatal error re-opens it. Changing the API key closes it straight away."""
+
+    def __init__(self, threshold: int = 5, cool_down: float = 30.0) -> None:
+        self.threshold = threshold
+        self.cool_down = cool_down
+
+        self._lock = threading.Lock()
+        self._error_class: Union[str, None] = None
+        self._consecutive = 0
+        self._last_error: Union[BaseException, None] = None
+        self._opened_at: Union[float, None] = None
+        self._probing = False
+        self._api_key: Union[str, None] = None
+
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def get_open_error(self) -> Union[CircuitOpenError, None]:
+        """The error requests are failing with while open, for explaining a failed batch."""
+        with self._lock:
+            if self._opened_at is None or not self._error_class:
+                return None
+            return CircuitOpenError(self._error_class, self._last_error)
+
+    def before_request(self, api_key: str) -> None:
+        """Raises CircuitOpenError if the request shouldn't be sent."""
+        with self._lock:
+            if api_key != self._api_key:
+                # A new key deserves a fresh chance
+                self._api_key = api_key
+                self._reset()
+                return
+
+            if self._opened_at is None or not self._error_class:
+                return
+
+            if self._probing or time.monotonic() - self._opened_at < self.cool_down:
+                raise CircuitOpenError(self._error_class, self._last_error)
+
+            print("Circuit half-open: sending a probe request")
+            self._probing = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                print("Circuit closed")
+            self._reset()
+
+    def record_failure(self, e: BaseException) -> None:
+        error_class = get_fatal_error_class(e)
+        with self._lock:
+            self._probing = False
+            if not error_class:
+                return
+
+            if error_class != self._error_class:
+                self._error_class = error_class
+                self._consecutive = 0
+            self._consecutive += 1
+            self._last_error = e
+
+            if self._consecutive >= self.threshold or self._opened_at is not None:
+                if self._opened_at is None:
+                    print(f"Circuit opened after {self._consecutive} {error_class} errors")
+                self._opened_at = time.monotonic()
+
+    def _reset(self) -> None:
+        self._error_class = None
+        self._consecutive = 0
+        self._last_error = None
+        self._opened_at = None
+        self._probing = False
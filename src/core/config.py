@@ -0,0 +1,193 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Config types shared by the engine and the add-on. Nothing in here may import aqt."""
+
+from typing import Any, Dict, List, Literal, Protocol, TypedDict, Union
+
+OpenAIModels = Literal["gpt-3.5-turbo", "gpt-4o", "gpt-4-turbo", "gpt-4"]
+# inline: field values are filled in where the prompt references them.
+# static_prefix: the prompt goes first as written, then the values, so every note's request
+# starts the same way and OpenAI can reuse its cached prefix.
+PromptLayout = Literal["inline", "static_prefix"]
+
+
+class FieldOptions(TypedDict, total=False):
+    """Per smart field generation parameters. Anything left out uses the API's default."""
+
+    # Overrides openai_model for this field
+    model: OpenAIModels
+    max_tokens: int
+    temperature: float
+    stop: List[str]
+    # Strip HTML and media from the fields the prompt references. On unless set to False.
+    normalize_inputs: bool
+    # Cut each field the prompt references to about this many tokens, after normalizing
+    max_input_tokens: int
+    # Defaults to inline
+    prompt_layout: PromptLayout
+    # In batches, reuse the response to earlier inputs at least this similar (0 to 1) instead
+    # of asking again. 1 only reuses inputs that differ in case, punctuation, spacing or markup.
+    similarity_threshold: float
+
+
+# Options sent with the request. The rest change the prompt before it's sent.
+REQUEST_OPTIONS = ("max_tokens", "temperature", "stop")
+
+
+class _NoteTypeMapOptions(TypedDict, total=False):
+    # Field -> options, only for fields that have any
+    options: Dict[str, FieldOptions]
+    # Sent as the system message ahead of every smart field's prompt on this note type
+    system_prompt: str
+
+
+class NoteTypeMap(_NoteTypeMapOptions):
+    fields: Dict[str, str]
+
+
+class PromptMap(TypedDict):
+    note_types: Dict[str, NoteTypeMap]
+
+# Where a generation request comes from. Editor and review requests have a user waiting on them.
+Lane = Literal["editor", "review", "batch"]
+
+
+class Budget(TypedDict, total=False):
+    """Spend limits. Past a soft limit requests are slowed down; at a hard limit they stop."""
+
+    soft_tokens: int
+    hard_tokens: int
+    soft_dollars: float
+    hard_dollars: float
+
+
+class Budgets(TypedDict, total=False):
+    # Each batch run (a browser batch or a headless run)
+    run: Budget
+    # Each calendar day, across runs and background generation
+    day: Budget
+    # Note type -> its own daily budget
+    note_types: Dict[str, Budget]
+
+
+class ModelPrice(TypedDict):
+    """Dollars per million tokens."""
+
+    input: float
+    cached_input: float
+    output: float
+
+
+class LaneTimeouts(TypedDict):
+    # Seconds to establish a connection
+    connect: float
+    # Seconds to wait between bytes of a response
+    read: float
+    # Seconds for the whole operation, including retries
+    deadline: float
+
+
+DEFAULT_LANE_TIMEOUTS: Dict[str, LaneTimeouts] = {
+    "editor": {"connect": 5, "read": 30, "deadline": 45},
+    "review": {"connect": 5, "read": 20, "deadline": 30},
+    "batch": {"connect": 10, "read": 60, "deadline": 180},
+}
+
+
+class EngineConfig(Protocol):
+    """The subset of config the engine reads. Satisfied by the add-on's Config and by StaticConfig."""
+
+    openai_api_key: str
+    openai_model: OpenAIModels
+    prompts_map: PromptMap
+    hedge_interactive_requests: bool
+    hedge_percentile: float
+    hedge_max_rate: float
+    lane_timeouts: Dict[str, LaneTimeouts]
+    # Model -> the batch concurrency limit learned last session
+    concurrency_limits: Dict[str, int]
+    # Consecutive auth/quota errors before giving up on the rest of a batch
+    circuit_breaker_threshold: int
+    circuit_breaker_cool_down: float
+    # Batch and background spend limits
+    budgets: Budgets
+    # Model -> price, overriding the built in prices (or adding a model's)
+    model_prices: Dict[str, ModelPrice]
+
+
+class StaticConfig:
+    """Plain in-memory config for running the engine outside of Anki's add-on manager.
+    Defaults match config.json."""
+
+    openai_api_key: str = ""
+    openai_model: OpenAIModels = "gpt-3.5-turbo"
+    prompts_map: PromptMap
+    hedge_interactive_requests: bool = False
+    hedge_percentile: float = 0.95
+    hedge_max_rate: float = 0.1
+    lane_timeouts: Dict[str, LaneTimeouts] = DEFAULT_LANE_TIMEOUTS
+    concurrency_limits: Dict[str, int] = {}
+    circuit_breaker_threshold: int = 5
+    circuit_breaker_cool_down: float = 30.0
+    budgets: Budgets = {}
+    model_prices: Dict[str, ModelPrice] = {}
+
+    def __init__(
+        self,
+        openai_api_key: str,
+        openai_model: OpenAIModels = "gpt-3.5-turbo",
+        prompts_map: Union[PromptMap, None] = None,
+        **options: Any,
+    ) -> None:
+        self.openai_api_key = openai_api_key
+        self.openai_model = openai_model
+        self.prompts_map = prompts_map or {"note_types": {}}
+        for key, value in options.items():
+            if key not in StaticConfig.__annotations__:
+                raise ValueError(f"Unknown config option: {key}")
+            setattr(self, key, value)
+
+    def refresh_from(self, other: "StaticConfig") -> None:
+        """Takes on other's values in place, so everything holding this config sees them. All at
+        once, so another thread reading it never sees half of each."""
+        self.__dict__ = dict(other.__dict__)
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "StaticConfig":
+        """Builds a config from a dict shaped like the add-on's config.json. Keys the engine doesn't use are ignored."""
+        options = {
+            k: v
+            for k, v in d.items()
+            if k in StaticConfig.__annotations__
+            and k not in ("openai_api_key", "openai_model", "prompts_map")
+        }
+        return cls(
+            openai_api_key=d.get("openai_api_key", ""),
+            openai_model=d.get("openai_model", "gpt-3.5-turbo"),
+            prompts_map=d.get("prompts_map"),
+            **options,
+        )
+
+
+def get_lane_timeouts(config: EngineConfig, lane: Lane) -> LaneTimeouts:
+    """Timeouts for a lane, falling back to the defaults for anything not configured."""
+    timeouts = DEFAULT_LANE_TIMEOUTS[lane].copy()
+    timeouts.update((config.lane_timeouts or {}).get(lane, {}))
+    return timeouts
@@ -0,0 +1,546 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""The generation engine: renders prompts, calls the client and applies responses to notes.
+
+Only depends on anki and aiohttp so it can run headlessly. Writing notes back to the
+collection and all UI concerns are left to the caller."""
+
+import asyncio
+import functools
+from contextlib import contextmanager, nullcontext
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+# Importing anki.notes before anki.collection trips a circular import inside anki
+import anki.collection  # noqa: F401
+from anki.notes import Note
+
+from .cache import ResponseCache
+from .config import (
+    REQUEST_OPTIONS,
+    EngineConfig,
+    FieldOptions,
+    Lane,
+    get_lane_timeouts,
+)
+from .deadline import Deadline
+from .jobs import FieldJob
+from .note_records import NoteRecord
+from .open_ai_client import OpenAIClient, on_request_sent
+from .prompts import (
+    get_field_options,
+    get_missing_required_fields,
+    get_prompt_fields_lower,
+    get_required_fields_lower,
+    get_system_prompt,
+    interpolate_prompt,
+    is_empty,
+    to_lowercase_dict,
+)
+from .retry import RetryPolicy
+from .scheduler import Scheduler
+from .similarity import SimilarResponses
+from .speculation import SpeculationStore
+
+# Batches run on NoteRecords read in bulk; interactive paths on real notes
+NoteLike = Union[Note, NoteRecord]
+N = TypeVar("N", Note, NoteRecord)
+
+
+@contextmanager
+def count_requests_sent(job: FieldJob) -> Iterator[None]:
+    """Counts requests sent inside towards the job's attempts."""
+
+    def on_sent() -> None:
+        job.attempts += 1
+
+    token = on_request_sent.set(on_sent)
+    try:
+        yield
+    finally:
+        on_request_sent.reset(token)
+
+
+class Engine:
+    def __init__(
+        self,
+        client: OpenAIClient,
+        config: EngineConfig,
+        scheduler: Union[Scheduler, None] = None,
+        cache: Union[ResponseCache, None] = None,
+        retry_policy: Union[RetryPolicy, None] = None,
+        similar: Union[SimilarResponses, None] = None,
+    ):
+        self.client = client
+        self.config = config
+        self.scheduler = scheduler or Scheduler()
+        # Cache and retries only apply to batch work; interactive requests should fail fast and always be fresh
+        self.cache = cache or ResponseCache()
+        self.retry_policy = retry_policy or RetryPolicy()
+        # Batch only too, and only for fields with a similarity_threshold
+        self.similar = similar or SimilarResponses()
+        self.speculations = SpeculationStore()
+
+    def get_field_prompts(self, note: NoteLike) -> Union[Dict[str, str], None]:
+        """Returns the target field -> prompt map for the note's type, if it has smart fields."""
+        note_type = note.note_type()
+        if not note_type:
+            print("Error: no note type")
+            return None
+
+        note_type_map = self.config.prompts_map.get("note_types", {}).get(
+            note_type["name"], None
+        )
+        return note_type_map["fields"] if note_type_map else None
+
+    def get_options_for_field(self, note: NoteLike, field: str) -> FieldOptions:
+        note_type = note.note_type()
+        if not note_type:
+            return {}
+        return get_field_options(self.config.prompts_map, note_type["name"], field)
+
+    def get_system_prompt(self, note: NoteLike) -> Union[str, None]:
+        note_type = note.note_type()
+        if not note_type:
+            return None
+        return get_system_prompt(self.config.prompts_map, note_type["name"])
+
+    def check_notes_have_prompts(self, notes: Sequence[NoteLike]) -> None:
+        """Sanity check that we actually have prompts for these note types. Raises if not."""
+        has_prompts = True
+        for note in notes:
+            note_type = note.note_type()
+            if not note_type:
+                # Should never happen
+                raise Exception("Error: no note type")
+
+            if note_type["name"] not in self.config.prompts_map.get("note_types", {}):
+                print("Error: no prompts found for note type")
+                has_prompts = False
+        if not has_prompts:
+            raise Exception("Not all selected note types have smart fields.")
+
+    async def process_notes(
+        self,
+        notes: Sequence[N],
+        overwrite_fields: bool = False,
+        on_error: Union[Callable[[N, BaseException], None], None] = None,
+        on_field_done: Union[Callable[[N, FieldJob], None], None] = None,
+    ) -> Tuple[List[N], List[N]]:
+        """Processes notes through the scheduler. Returns (updated, failed); doesn't write to the collection.
+
+        A note with some fields generated and others failed is in both lists: what succeeded is
+        kept, and a rerun only generates the fields that are still empty. Each note's field jobs
+        are tallied as soon as the note finishes, so only notes in flight hold any job state.
+        Once the circuit breaker opens, notes not yet started fail without being tried."""
+        self.check_notes_have_prompts(notes)
+
+        notes_to_update: List[N] = []
+        failed: List[N] = []
+
+        def on_note_failed(note: N, errors: List[BaseException]) -> None:
+            print(f"Error processing note {note.id}: {errors[0]}")
+            failed.append(note)
+            for error in errors:
+                if on_error:
+                    on_error(note, error)
+
+        async def process(note: N) -> None:
+            # Every request would be turned away; leave the rest of the batch unprocessed
+            if self.client.circuit_breaker.is_open():
+                failed.append(note)
+                return
+
+            jobs = await self.generate_fields(note, overwrite_fields, "batch")
+            if on_field_done:
+                for job in jobs:
+                    on_field_done(note, job)
+
+            if self.needs_write(note, jobs):
+                notes_to_update.append(note)
+            errors = [job.error for job in jobs if job.error]
+            if errors:
+                on_note_failed(note, errors)
+
+        results = await self.scheduler.run(
+            [functools.partial(process, note) for note in notes]
+        )
+
+        # Only notes that failed outside of their fields' jobs, e.g. rendering a prompt
+        for note, result in zip(notes, results):
+            if isinstance(result, BaseException):
+                on_note_failed(note, [result])
+
+        return (notes_to_update, failed)
+
+    async def process_note(
+        self, note: NoteLike, overwrite_fields: bool = False, lane: Lane = "review"
+    ) -> List[str]:
+        """Process a single note, returns the fields that changed. Caller responsible for handling any exceptions.
+
+        Raises only if every field failed; otherwise the fields that succeeded are kept."""
+        print("Processing note")
+        jobs = await self.generate_fields(note, overwrite_fields, lane)
+
+        errors = [job.error for job in jobs if job.error]
+        updated = self.needs_write(note, jobs)
+        if errors and not updated:
+            raise errors[0]
+        for error in errors:
+            print(f"Error generating field: {error}")
+
+        return [job.field for job in jobs if job.status == "generated"]
+
+    async def generate_fields(
+        self, note: NoteLike, overwrite_fields: bool = False, lane: Lane = "review"
+    ) -> List[FieldJob]:
+        """Generates the note's smart fields concurrently, setting each one that succeeds.
+
+        Returns a job per smart field, saying whether it was generated, failed (and with what) or skipped."""
+        field_prompts = self.get_field_prompts(note)
+
+        if not field_prompts:
+            print("Error: no prompts found for note type")
+            return []
+
+        jobs = []
+        tasks = []
+        # All of the note's fields share one deadline
+        deadline = self.make_deadline(lane)
+        system_prompt = self.get_system_prompt(note)
+        note_type = (note.note_type() or {}).get("name")
+
+        for field, prompt in field_prompts.items():
+            job = FieldJob(note.id, field)
+            jobs.append(job)
+
+            # Don't overwrite fields that already exist
+            if (not overwrite_fields) and note[field]:
+                print(f"Skipping field: {field}")
+                job.skip()
+                continue
+
+            if self.is_missing_inputs(note, field, prompt):
+                job.skip()
+                continue
+
+            print(f"Processing field: {field}, prompt: {prompt}")
+            options = self.get_options_for_field(note, field)
+            tasks.append(
+                self._generate_field(
+                    note, job, prompt, lane, deadline, options, system_prompt, note_type
+                )
+            )
+
+        await asyncio.gather(*tasks)
+        print("Responses: ", [job.result or job.error for job in jobs])
+
+        return jobs
+
+    async def _generate_field(
+        self,
+        note: NoteLike,
+        job: FieldJob,
+        prompt: str,
+        lane: Lane,
+        deadline: Deadline,
+        options: FieldOptions,
+        system_prompt: Union[str, None],
+        note_type: Union[str, None] = None,
+    ) -> None:
+        threshold = options.get("similarity_threshold")
+        # Reusing responses only saves requests; if the index fails, ask OpenAI as usual
+        use_similar = False
+        if threshold and lane == "batch":
+            try:
+                scope = self.make_fingerprint(prompt, options, system_prompt)
+                inputs = self.get_inputs(note, prompt)
+                similar = self.similar.find(scope, inputs, threshold)
+                use_similar = True
+            except Exception as e:
+                print(f"Error finding a similar response: {e}")
+                similar = None
+            if similar is not None:
+                self.client.metrics.incr("similar.hits")
+                self.apply_response(note, job, similar)
+                return
+
+        # One failed field shouldn't throw away the responses we've already paid for
+        try:
+            rendered = interpolate_prompt(prompt, note, options)  # type: ignore[arg-type]
+            response = await self.get_response(
+                rendered, lane, deadline, options, job, system_prompt, note_type
+            )
+        except Exception as e:
+            job.fail(e)
+            return
+
+        if use_similar:
+            try:
+                self.similar.add(scope, inputs, response)
+            except Exception as e:
+                print(f"Error saving a response for reuse: {e}")
+        self.apply_response(note, job, response)
+
+    def get_inputs(self, note: NoteLike, prompt: str) -> List[str]:
+        """The values of the fields the prompt references, in order."""
+        note_fields = to_lowercase_dict(dict(note.items()))
+        return [
+            note_fields.get(field, "")
+            for field in dict.fromkeys(get_prompt_fields_lower(prompt))
+        ]
+
+    def is_missing_inputs(self, note: NoteLike, field: str, prompt: str) -> bool:
+        """Whether a field the prompt requires is empty. Counts them, as requests saved."""
+        missing = get_missing_required_fields(prompt, note)  # type: ignore[arg-type]
+        if missing:
+            print(f"Skipping field: {field}, {missing[0]} is empty")
+            self.client.metrics.incr("skipped.empty_inputs")
+        return bool(missing)
+
+    def apply_response(self, note: NoteLike, job: FieldJob, response: str) -> None:
+        # Rewriting a field with what it already has bumps the note's mod and syncs it for nothing
+        changed = note[job.field] != response
+        if changed:
+            note[job.field] = response
+        job.succeed(response, changed)
+
+    def needs_write(self, note: NoteLike, jobs: Sequence[FieldJob]) -> bool:
+        """Whether any of the note's fields changed. Counts notes whose responses all matched what
+        they already had, as writes skipped."""
+        if any(job.status == "generated" for job in jobs):
+            return True
+        if any(job.status == "unchanged" for job in jobs):
+            print(f"Note {note.id} unchanged, not writing it")
+            self.client.metrics.incr("writes.elided")
+        return False
+
+    async def process_field(
+        self, note: NoteLike, target_field: str, lane: Lane = "editor"
+    ) -> List[str]:
+        """Generates a single smart field and sets it on the note. Returns it if it changed, which it
+        doesn't if a field its prompt requires is empty; otherwise nothing."""
+        field_prompts = self.get_field_prompts(note) or {}
+        if self.is_missing_inputs(note, target_field, field_prompts[target_field]):
+            return []
+        options = self.get_options_for_field(note, target_field)
+        prompt = interpolate_prompt(field_prompts[target_field], note, options)  # type: ignore[arg-type]
+        response = await self.get_response(
+            prompt, lane, options=options, system_prompt=self.get_system_prompt(note)
+        )
+
+        job = FieldJob(note.id, target_field)
+        self.apply_response(note, job, response)
+        return [target_field] if self.needs_write(note, [job]) else []
+
+    async def get_response(
+        self,
+        prompt: str,
+        lane: Lane,
+        deadline: Union[Deadline, None] = None,
+        options: Union[FieldOptions, None] = None,
+        job: Union[FieldJob, None] = None,
+        system_prompt: Union[str, None] = None,
+        note_type: Union[str, None] = None,
+    ) -> str:
+        """note_type is whose budget a batch request is spent from."""
+        deadline = deadline or self.make_deadline(lane)
+        options = options or {}
+        model, key = self.make_cache_key(prompt, options, system_prompt)
+
+        speculation = await self._take_speculation(key)
+        if speculation is not None:
+            return speculation
+
+        # Only requests the circuit breaker let through were sent; the rest aren't attempts
+        with count_requests_sent(job) if job else nullcontext():
+            if lane != "batch":
+                return await self.client.async_get_chat_response(
+                    prompt, lane, deadline, options, system_prompt
+                )
+
+            # Each attempt (not each note) takes a slot, so retries back off the limit too
+            def attempt() -> Awaitable[str]:
+                return self.scheduler.run_request(
+                    model,
+                    (self.config.concurrency_limits or {}).get(model),
+                    lambda: self.client.async_get_chat_response(
+                        prompt, lane, deadline, options, system_prompt
+                    ),
+                    note_type,
+                )
+
+            return await self.cache.get_or_fetch(
+                key,
+                lambda: self.retry_policy.run(
+                    attempt, deadline, self.expected_request_seconds(model, lane)
+                ),
+            )
+
+    def make_cache_key(
+        self,
+        prompt: str,
+        options: FieldOptions,
+        system_prompt: Union[str, None] = None,
+    ) -> Tuple[str, str]:
+        """Returns (model, key) for a request. prompt is as sent, so options that only shape it aren't part of the key."""
+        model = self.client.get_model(options)
+        params: Dict[str, Any] = {k: options[k] for k in REQUEST_OPTIONS if k in options}  # type: ignore[literal-required]
+        # Only when set, so keys without one match older caches
+        if system_prompt:
+            params["system_prompt"] = system_prompt
+        return model, ResponseCache.make_key(model, prompt, params)
+
+    def make_fingerprint(
+        self,
+        prompt: str,
+        options: FieldOptions,
+        system_prompt: Union[str, None] = None,
+    ) -> str:
+        model = self.client.get_model(options)
+        # Reusing similar responses or not, a field is generated from the same thing
+        params: Dict[str, Any] = {
+            k: v
+            for k, v in options.items()
+            if k not in ("model", "similarity_threshold")
+        }
+        if system_prompt:
+            params["system_prompt"] = system_prompt
+        return ResponseCache.make_key(model, prompt, params)
+
+    def get_fingerprint(self, note: NoteLike, field: str) -> str:
+        """Identifies what the field's response is generated from: its prompt filled in with the
+        fields as they are (so editing a field's formatting counts too), model and options."""
+        field_prompts = self.get_field_prompts(note) or {}
+        prompt = interpolate_prompt(field_prompts[field], note, {"normalize_inputs": False})  # type: ignore[arg-type]
+        return self.make_fingerprint(
+            prompt, self.get_options_for_field(note, field), self.get_system_prompt(note)
+        )
+
+    def get_prompt_fingerprint(self, note_type: str, field: str) -> Union[str, None]:
+        """Like get_fingerprint, for the field's prompt before it's filled in. None if it's not a smart field."""
+        note_type_map = self.config.prompts_map["note_types"].get(note_type)
+        if not note_type_map or field not in note_type_map["fields"]:
+            return None
+        options = get_field_options(self.config.prompts_map, note_type, field)
+        return self.make_fingerprint(
+            note_type_map["fields"][field],
+            options,
+            get_system_prompt(self.config.prompts_map, note_type),
+        )
+
+    def get_dependent_fields(self, note: NoteLike, source_field: str) -> List[str]:
+        """Empty smart fields whose prompt references source_field and whose required inputs are all filled in."""
+        field_prompts = self.get_field_prompts(note) or {}
+        note_fields = to_lowercase_dict(dict(note.items()))
+        source_field = source_field.lower()
+
+        dependent = []
+        for field, prompt in field_prompts.items():
+            # Filled in already: nothing to have ready, unless asked to regenerate it
+            if not is_empty(note_fields.get(field.lower(), "")):
+                continue
+            if source_field in get_prompt_fields_lower(prompt) and all(
+                not is_empty(note_fields.get(f, ""))
+                for f in get_required_fields_lower(prompt)
+            ):
+                dependent.append(field)
+        return dependent
+
+    async def speculate(self, note: NoteLike, source_field: str) -> None:
+        """Generates the smart fields that depend on source_field ahead of time, without touching the note.
+        A later request with the same prompt (✨, Add, review) picks the response up instead of waiting."""
+        await asyncio.gather(
+            *[
+                self._speculate_field(note, field)
+                for field in self.get_dependent_fields(note, source_field)
+            ],
+            return_exceptions=True,
+        )
+
+    async def _speculate_field(self, note: NoteLike, field: str) -> None:
+        field_prompts = self.get_field_prompts(note) or {}
+        options = self.get_options_for_field(note, field)
+        prompt = interpolate_prompt(field_prompts[field], note, options)  # type: ignore[arg-type]
+        system_prompt = self.get_system_prompt(note)
+        model, key = self.make_cache_key(prompt, options, system_prompt)
+
+        # Nobody has asked for it yet, so only while there's budget to spare, and it counts
+        budget = self.scheduler.budget
+        note_type = (note.note_type() or {}).get("name")
+        if budget and (
+            budget.get_exceeded(note_type) or budget.get_exceeded(note_type, soft=True)
+        ):
+            print("Not speculating: over budget")
+            return
+
+        # One speculation per field of this note object; a newer one replaces it
+        slot = (id(note), field)
+        future = self.speculations.begin(slot, key)
+        if not future:
+            return
+
+        try:
+            with budget.track(model, note_type) if budget else nullcontext():
+                response = await self.client.async_get_chat_response(
+                    prompt, "editor", options=options, system_prompt=system_prompt
+                )
+            if not future.done():
+                future.set_result(response)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self.speculations.finish(slot, key)
+
+    async def _take_speculation(self, key: str) -> Union[str, None]:
+        """The speculative response for key, waiting for it if it's still running. None if there's no usable one."""
+        future = self.speculations.take(key)
+        if not future:
+            return None
+
+        print("Using speculative response")
+        wrapped = asyncio.wrap_future(future)
+        # wait() rather than await, so a cancelled speculation doesn't look like we were cancelled
+        await asyncio.wait([wrapped])
+        if wrapped.cancelled() or wrapped.exception():
+            return None
+        return wrapped.result()
+
+    def make_deadline(self, lane: Lane) -> Deadline:
+        return Deadline(get_lane_timeouts(self.config, lane)["deadline"])
+
+    def expected_request_seconds(self, model: str, lane: Lane) -> float:
+        """Typical latency for the model in a lane, for deciding whether a retry can still finish in time."""
+        p50 = self.client.metrics.percentile(f"latency.{lane}.{model}", 0.5)
+        return p50 if p50 is not None else 1.0
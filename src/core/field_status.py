@@ -0,0 +1,276 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+"""Which notes have smart fields that are missing or stale, for smart:missing / smart:stale searches
+and the browser's Smart Fields column.
+
+Missing fields are found straight from the notes table, by field ordinal. Stale needs to know what
+each field was generated from, so every write records a fingerprint of the field's rendered prompt,
+model and options in a small sqlite file next to the collection (it isn't synced). A field is stale
+once its fingerprint would come out differently now, because an input field or the prompt changed."""
+
+import os
+import re
+import sqlite3
+from typing import Dict, List, Sequence, Set, Tuple, Union
+
+from anki.collection import Collection
+from anki.notes import NoteId
+from anki.utils import ids2str
+
+from .config import PromptMap
+from .engine import Engine, NoteLike
+from .note_records import read_note_records
+
+FINGERPRINTS_FILENAME = "smart_notes.db"
+# Hex digits of the request key kept per field; plenty to notice a change
+FINGERPRINT_LENGTH = 16
+
+# A whole term, so it can be negated (-smart:stale), grouped, or OR-ed like any other
+SEARCH_TERM = re.compile(r"(?<![^\s(-])smart:(missing|stale)(?![^\s)])", re.IGNORECASE)
+
+
+def get_fingerprints_path(collection_path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(collection_path)), FINGERPRINTS_FILENAME)
+
+
+def get_search_terms(search: str) -> Set[str]:
+    """Which of smart:missing and smart:stale an Anki search uses."""
+    return {match.lower() for match in SEARCH_TERM.findall(search)}
+
+
+def replace_search_terms(search: str, matches: Dict[str, Sequence[NoteId]]) -> str:
+    """Swaps each smart: term for the notes it matches, so Anki evaluates the rest of the search,
+    negation, grouping and OR included, as usual. matches is term -> note ids."""
+
+    def replace(match: "re.Match[str]") -> str:
+        note_ids = matches.get(match.group(1).lower())
+        # nid:0 matches nothing
+        return f"nid:{','.join(map(str, note_ids))}" if note_ids else "nid:0"
+
+    return SEARCH_TERM.sub(replace, search)
+
+
+class FingerprintStore:
+    """Per note and field: the fingerprint it was generated with, its prompt's fingerprint, and the
+    note's mod once written. A note whose mod and prompt are unchanged can't have gone stale."""
+
+    def __init__(self, path: str) -> None:
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "create table if not exists fingerprints (note_id integer not null, field text not null, "
+            "fingerprint text not null, prompt text not null, mod integer not null, primary key (note_id, field))"
+        )
+
+    def record(self, rows: Sequence[Tuple[int, str, str, str, int]]) -> None:
+        """Rows of (note id, field, fingerprint, prompt fingerprint, mod)."""
+        self._db.executemany(
+            "insert or replace into fingerprints values (?, ?, ?, ?, ?)", rows
+        )
+        self._db.commit()
+
+    def get_for_note(self, note_id: int) -> Dict[str, str]:
+        """Field -> the fingerprint it was generated with."""
+        return dict(
+            self._db.execute(
+                "select field, fingerprint from fingerprints where note_id = ?",
+                (note_id,),
+            ).fetchall()
+        )
+
+    def get_candidates(
+        self,
+        notes: Sequence[Tuple[int, int, int]],
+        prompts: Sequence[Tuple[int, str, str]],
+    ) -> List[Tuple[int, str, str, bool]]:
+        """Fields that might be stale: the note was modified or the prompt changed since generating them.
+
+        Takes the collection's (note id, mid, mod) and the current (mid, field, prompt fingerprint).
+        Returns (note id, field, fingerprint, whether the prompt changed)."""
+        self._db.execute("create temp table if not exists notes (id integer primary key, mid integer, mod integer)")
+        self._db.execute("create temp table if not exists prompts (mid integer, field text, prompt text)")
+        try:
+            self._db.executemany("insert into temp.notes values (?, ?, ?)", notes)
+            self._db.executemany("insert into temp.prompts values (?, ?, ?)", prompts)
+            rows = self._db.execute(
+                "select f.note_id, f.field, f.fingerprint, f.prompt != p.prompt from fingerprints f "
+                "join temp.notes n on n.id = f.note_id "
+                "join temp.prompts p on p.mid = n.mid and p.field = f.field "
+                "where f.mod != n.mod or f.prompt != p.prompt"
+            ).fetchall()
+        finally:
+            self._db.execute("delete from temp.notes")
+            self._db.execute("delete from temp.prompts")
+        return [(note_id, field, fingerprint, bool(changed)) for note_id, field, fingerprint, changed in rows]
+
+    def touch(self, rows: Sequence[Tuple[int, int, str]]) -> None:
+        """Rows of (mod, note id, field), for fields checked and found fresh after an unrelated edit."""
+        self._db.executemany(
+            "update fingerprints set mod = ? where note_id = ? and field = ?", rows
+        )
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def record_fingerprints(
+    col: Collection,
+    engine: Engine,
+    store: FingerprintStore,
+    written: Sequence[Tuple[NoteLike, Sequence[str]]],
+) -> None:
+    """Records what the generated fields of notes just written were generated from."""
+    mods = {
+        note_id: mod
+        for note_id, mod in col.db.all(  # type: ignore[union-attr]
+            f"select id, mod from notes where id in {ids2str([note.id for note, _ in written])}"
+        )
+    }
+
+    rows = []
+    for note, fields in written:
+        note_type = note.note_type()
+        if not note_type:
+            continue
+        for field in fields:
+            prompt = engine.get_prompt_fingerprint(note_type["name"], field)
+            if prompt is None:
+                continue
+            fingerprint = engine.get_fingerprint(note, field)
+            rows.append(
+                (
+                    note.id,
+                    field,
+                    fingerprint[:FINGERPRINT_LENGTH],
+                    prompt[:FINGERPRINT_LENGTH],
+                    mods.get(note.id, 0),
+                )
+            )
+    store.record(rows)
+
+
+def get_smart_field_ordinals(
+    col: Collection, prompts_map: PromptMap
+) -> Dict[int, Tuple[str, List[Tuple[int, str]]]]:
+    """mid -> (note type name, [(ordinal, name)] of its smart fields), for note types that have any."""
+    ordinals = {}
+    for name, note_type_map in prompts_map["note_types"].items():
+        model = col.models.by_name(name)
+        if not model:
+            continue
+        fields = [
+            (field["ord"], field["name"])
+            for field in model["flds"]
+            if field["name"] in note_type_map["fields"]
+        ]
+        if fields:
+            ordinals[model["id"]] = (name, fields)
+    return ordinals
+
+
+def find_missing_note_ids(col: Collection, prompts_map: PromptMap) -> List[NoteId]:
+    """Notes with at least one empty smart field. One query per note type, on field ordinals."""
+    note_ids: List[NoteId] = []
+    for mid, (_, fields) in get_smart_field_ordinals(col, prompts_map).items():
+        empty = " or ".join(f"field_at_index(flds, {ord}) = ''" for ord, _ in fields)
+        note_ids.extend(
+            col.db.list(f"select id from notes where mid = ? and ({empty})", mid)  # type: ignore[union-attr]
+        )
+    return note_ids
+
+
+def find_stale_note_ids(
+    col: Collection, engine: Engine, store: FingerprintStore
+) -> List[NoteId]:
+    """Notes with a smart field whose inputs or prompt changed since it was generated.
+
+    Only fields of notes modified since are re-rendered to check; a changed prompt makes them stale outright."""
+    prompts_map = engine.config.prompts_map
+    ordinals = get_smart_field_ordinals(col, prompts_map)
+    if not ordinals:
+        return []
+
+    prompts = []
+    for mid, (name, fields) in ordinals.items():
+        for _, field in fields:
+            prompt = engine.get_prompt_fingerprint(name, field)
+            if prompt:
+                prompts.append((mid, field, prompt[:FINGERPRINT_LENGTH]))
+
+    notes = [
+        (note_id, mid, mod)
+        for note_id, mid, mod in col.db.all(  # type: ignore[union-attr]
+            f"select id, mid, mod from notes where mid in {ids2str(ordinals.keys())}"
+        )
+    ]
+    mods = {note_id: mod for note_id, _, mod in notes}
+    candidates = store.get_candidates(notes, prompts)
+
+    stale = {note_id for note_id, _, _, prompt_changed in candidates if prompt_changed}
+    to_check = [c for c in candidates if c[0] not in stale]
+    records = {
+        record.id: record
+        for record in read_note_records(
+            col, list({NoteId(c[0]) for c in to_check}), prompts_map
+        )
+    }
+
+    fresh = []
+    for note_id, field, fingerprint, _ in to_check:
+        record = records.get(NoteId(note_id))
+        # An emptied field is missing, not stale
+        if not record or not record.get(field):
+            continue
+        if engine.get_fingerprint(record, field)[:FINGERPRINT_LENGTH] != fingerprint:
+            stale.add(note_id)
+        else:
+            fresh.append((mods[note_id], note_id, field))
+
+    # Edited, but not in a way that matters; no need to check them again until the next edit
+    store.touch(fresh)
+    return [NoteId(note_id) for note_id in sorted(stale)]
+
+
+def get_status_text(
+    engine: Engine, store: Union[FingerprintStore, None], note: NoteLike
+) -> str:
+    """A short summary of the note's smart fields, for the browser column."""
+    field_prompts = engine.get_field_prompts(note)
+    if not field_prompts:
+        return ""
+
+    missing = [field for field in field_prompts if field in note and not note[field]]
+    fingerprints = store.get_for_note(note.id) if store else {}
+    stale = [
+        field
+        for field, fingerprint in fingerprints.items()
+        if field in field_prompts
+        and field in note
+        and note[field]
+        and engine.get_fingerprint(note, field)[:FINGERPRINT_LENGTH] != fingerprint
+    ]
+
+    parts = []
+    if missing:
+        parts.append(f"{len(missing)} missing")
+    if stale:
+        parts.append(f"{len(stale)} stale")
+    return ", ".join(parts) or "✓"
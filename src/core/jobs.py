@@ -0,0 +1,55 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+"""Compact per-field job state for batches, so a big batch doesn't hold on to much per note."""
+
+from typing import Literal, Union
+
+from anki.notes import NoteId
+
+# unchanged: generated, but the same as what the field already had
+FieldStatus = Literal["pending", "generated", "unchanged", "failed", "skipped"]
+
+
+class FieldJob:
+    """Generating one smart field of one note. Holds the note's id rather than the note."""
+
+    __slots__ = ("note_id", "field", "status", "attempts", "result", "error")
+
+    def __init__(self, note_id: NoteId, field: str) -> None:
+        self.note_id = note_id
+        # The field name from prompts_map, shared between every job for that field
+        self.field = field
+        self.status: FieldStatus = "pending"
+        # Requests made for it; cache and speculation hits don't count
+        self.attempts = 0
+        self.result: Union[str, None] = None
+        self.error: Union[BaseException, None] = None
+
+    def succeed(self, response: str, changed: bool = True) -> None:
+        self.status = "generated" if changed else "unchanged"
+        self.result = response
+
+    def fail(self, error: BaseException) -> None:
+        self.status = "failed"
+        self.error = error
+
+    def skip(self) -> None:
+        self.status = "skipped"
@@ -0,0 +1,83 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import threading
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, Union
+
+MAX_SAMPLES = 1000
+
+
+class Metrics:
+    """In-process counters and latency samples. Thread safe; the add-on runs requests on several threads."""
+
+    def __init__(self, max_samples: int = MAX_SAMPLES) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._samples: Dict[str, Deque[float]] = defaultdict(
+            lambda: deque(maxlen=max_samples)
+        )
+
+    def incr(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name: str, value: float) -> None:
+        """Records a sample (e.g. a latency in seconds). Only the most recent samples are kept."""
+        with self._lock:
+            self._samples[name].append(value)
+
+    def count(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def num_samples(self, name: str) -> int:
+        with self._lock:
+            return len(self._samples.get(name, ()))
+
+    def percentile(self, name: str, p: float) -> Union[float, None]:
+        """p in [0, 1]. None if there are no samples yet."""
+        with self._lock:
+            samples = sorted(self._samples.get(name, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            names = list(self._samples.keys())
+
+        summaries = {}
+        for name in names:
+            summaries[name] = {
+                "count": self.num_samples(name),
+                "p50": self.percentile(name, 0.5),
+                "p90": self.percentile(name, 0.9),
+                "p99": self.percentile(name, 0.99),
+            }
+        return {"counters": counters, "samples": summaries}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._samples.clear()
+
+
+metrics = Metrics()
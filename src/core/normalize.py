@@ -0,0 +1,101 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Cleans field values up before they go into a prompt. Pure string functions, no anki.
+
+Fields hold editor HTML (<div>, <br>, inline styles), entities and media references, none of
+which tell the model anything but all of which cost tokens and make otherwise identical
+prompts miss the cache."""
+
+import functools
+import html
+import re
+
+# Whole elements whose contents are never text
+HIDDEN_ELEMENT_PATTERN = re.compile(
+    r"<(style|script)\b[^>]*>.*?</\1\s*>", re.IGNORECASE | re.DOTALL
+)
+# [sound:...] is how Anki references audio; images and video are tags, so go with the rest
+SOUND_PATTERN = re.compile(r"\[sound:[^\]]*\]")
+# Tags that end a line when rendered; everything else is inline. Anki's editor writes them in
+# lowercase, and IGNORECASE makes this several times slower.
+BLOCK_TAG_PATTERN = re.compile(r"<(?:br|/?(?:div|p|li|tr|h[1-6]|blockquote))\b[^>]*>")
+TAG_PATTERN = re.compile(r"<[^>]*>")
+
+# Normalized values of recently rendered fields are kept, since a note renders the same source
+# field once for every smart field that references it. Long ones aren't, to bound the memory.
+NORMALIZED_CACHE_SIZE = 1024
+NORMALIZED_CACHE_MAX_LENGTH = 10_000
+
+# Roughly one token each: a space and a short word or a piece of a long one, up to 3 digits (as
+# GPT tokenizers split them), or any other single character (punctuation, CJK). There's no
+# tokenizer to ask without a dependency; this errs towards overcounting.
+ESTIMATED_TOKEN_PATTERN = re.compile(r" ?(?:[A-Za-z]{1,6}|[0-9]{1,3}|\S)|\s")
+TRUNCATION_MARKER = "…"
+
+
+def normalize_field(value: str) -> str:
+    """The text a field shows, without markup or media, on as few lines and spaces as it takes."""
+    if len(value) > NORMALIZED_CACHE_MAX_LENGTH:
+        return _normalize_field(value)
+    return _normalize_field_cached(value)
+
+
+def _normalize_field(value: str) -> str:
+    # Each step only runs if there's anything for it to do; plain text skips straight to the end
+    if "[sound:" in value:
+        value = SOUND_PATTERN.sub("", value)
+    if "<" in value:
+        if "<s" in value or "<S" in value:
+            value = HIDDEN_ELEMENT_PATTERN.sub("", value)
+        value = BLOCK_TAG_PATTERN.sub("\n", value)
+        value = TAG_PATTERN.sub("", value)
+    if "&" in value:
+        value = html.unescape(value)
+
+    # split() takes any whitespace run, &nbsp; included, and drops it from the ends
+    lines = (" ".join(line.split()) for line in value.split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+_normalize_field_cached = functools.lru_cache(maxsize=NORMALIZED_CACHE_SIZE)(
+    _normalize_field
+)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cuts text to about max_tokens tokens, at a word boundary where there's one nearby."""
+    # Every token is at least a character
+    if len(text) <= max_tokens:
+        return text
+
+    end = 0
+    for i, match in enumerate(ESTIMATED_TOKEN_PATTERN.finditer(text)):
+        if i == max_tokens:
+            break
+        end = match.end()
+    else:
+        return text
+
+    cut = text[:end]
+    # Don't leave half a word, unless that throws away a lot (e.g. text without spaces)
+    space = max(cut.rfind(" "), cut.rfind("\n"))
+    if space > len(cut) * 0.8:
+        cut = cut[:space]
+    return cut.rstrip() + TRUNCATION_MARKER
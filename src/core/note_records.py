@@ -0,0 +1,130 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Bulk note reading straight from the collection database, for batches.
+
+Reads only id, mid, flds and mod, and keeps only the fields smart prompts use. Full Note
+objects are only built at write time, for notes that actually changed."""
+
+from typing import Any, Dict, Iterator, List, Mapping, Sequence, Set
+
+from anki.collection import Collection
+from anki.notes import Note, NoteId
+from anki.utils import ids2str
+
+from .config import PromptMap
+from .prompts import get_prompt_fields_lower
+
+# Note ids per query
+READ_CHUNK_SIZE = 10_000
+
+
+class NoteRecord(Mapping[str, str]):
+    """A lightweight stand-in for Note holding just the fields smart prompts read or write.
+
+    Supports the parts of Note's interface the engine uses: indexing, note_type() and id.
+    Fields set on it are tracked in `changed` so they can be applied to the real note later."""
+
+    __slots__ = ("id", "mid", "mod", "note_type_name", "fields", "changed")
+
+    def __init__(
+        self, id: NoteId, mid: int, mod: int, note_type_name: str, fields: Dict[str, str]
+    ) -> None:
+        self.id = id
+        self.mid = mid
+        self.mod = mod
+        self.note_type_name = note_type_name
+        self.fields = fields
+        self.changed: Dict[str, str] = {}
+
+    def note_type(self) -> Dict[str, Any]:
+        return {"id": self.mid, "name": self.note_type_name}
+
+    def __getitem__(self, key: str) -> str:
+        return self.fields[key]
+
+    def __setitem__(self, key: str, value: str) -> None:
+        self.fields[key] = value
+        self.changed[key] = value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.fields)
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+
+def get_needed_fields(prompts_map: PromptMap, note_type: str, field_names: Sequence[str]) -> Set[int]:
+    """Ordinals of the note type's smart fields and the fields their prompts reference."""
+    note_type_map = prompts_map["note_types"].get(note_type)
+    if not note_type_map:
+        return set()
+
+    targets = set(note_type_map["fields"].keys())
+    referenced: Set[str] = set()
+    for prompt in note_type_map["fields"].values():
+        referenced.update(get_prompt_fields_lower(prompt))
+
+    return {
+        ord
+        for ord, name in enumerate(field_names)
+        if name in targets or name.lower() in referenced
+    }
+
+
+def read_note_records(
+    col: Collection, note_ids: Sequence[NoteId], prompts_map: PromptMap
+) -> List[NoteRecord]:
+    """Reads notes as NoteRecords, in note_ids order. Ids that no longer exist are left out."""
+    # mid -> (note type name, [(ord, field name)] needed)
+    note_types: Dict[int, Any] = {}
+    records: Dict[int, NoteRecord] = {}
+
+    for i in range(0, len(note_ids), READ_CHUNK_SIZE):
+        chunk = note_ids[i : i + READ_CHUNK_SIZE]
+        rows = col.db.all(  # type: ignore[union-attr]
+            f"select id, mid, flds, mod from notes where id in {ids2str(chunk)}"
+        )
+        for id, mid, flds, mod in rows:
+            if mid not in note_types:
+                model = col.models.get(mid)
+                field_names = [f["name"] for f in model["flds"]] if model else []
+                name = model["name"] if model else ""
+                needed = get_needed_fields(prompts_map, name, field_names)
+                note_types[mid] = (name, [(o, field_names[o]) for o in sorted(needed)])
+
+            name, needed_fields = note_types[mid]
+            values = flds.split("\x1f")
+            fields = {field: values[o] for o, field in needed_fields if o < len(values)}
+            records[id] = NoteRecord(NoteId(id), mid, mod, name, fields)
+
+    return [records[id] for id in note_ids if id in records]
+
+
+def materialize_notes(col: Collection, records: Sequence[NoteRecord]) -> List[Note]:
+    """Loads the real notes for records that changed and applies the changes, ready for update_notes."""
+    notes = []
+    for record in records:
+        if not record.changed:
+            continue
+        note = col.get_note(record.id)
+        for field, value in record.changed.items():
+            note[field] = value
+        notes.append(note)
+    return notes
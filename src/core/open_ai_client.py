@@ -0,0 +1,279 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import random
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Union
+
+from .budget import usage_sink
+from .circuit_breaker import CircuitBreaker
+from .config import (
+    REQUEST_OPTIONS,
+    EngineConfig,
+    FieldOptions,
+    Lane,
+    get_lane_timeouts,
+)
+from .deadline import Deadline
+from .metrics import Metrics, metrics as default_metrics
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+
+# Don't hedge off a percentile until we've seen this many requests for the model in the lane
+MIN_HEDGE_SAMPLES = 20
+# Fraction of hedge-eligible requests left unhedged, to measure what hedging buys
+HEDGE_CONTROL_RATE = 0.05
+
+# Called each time the circuit breaker lets a request through, so whoever set it can count what was sent
+on_request_sent: ContextVar[Union[Callable[[], None], None]] = ContextVar(
+    "on_request_sent", default=None
+)
+
+
+class OpenAIClient:
+    """Client for OpenAI's chat API."""
+
+    def __init__(
+        self,
+        config: EngineConfig,
+        api_base: str = OPENAI_API_BASE,
+        metrics: Metrics = default_metrics,
+    ):
+        self.config = config
+        # Overridable so headless runs can point at a local stand-in
+        self.api_base = api_base.rstrip("/")
+        self.metrics = metrics
+        self.circuit_breaker = CircuitBreaker(
+            config.circuit_breaker_threshold, config.circuit_breaker_cool_down
+        )
+
+    async def async_get_chat_response(
+        self,
+        prompt: str,
+        lane: Lane = "batch",
+        deadline: Union[Deadline, None] = None,
+        options: Union[FieldOptions, None] = None,
+        system_prompt: Union[str, None] = None,
+    ) -> str:
+        """Gets a chat response from OpenAI's chat API. This method can throw; the caller should handle with care.
+
+        Times out per the lane's connect/read timeouts, and never runs past the deadline
+        (which defaults to the lane's own). Options override the model and generation parameters.
+        The system prompt, if any, goes ahead of the prompt as its own message."""
+        deadline = deadline or Deadline(get_lane_timeouts(self.config, lane)["deadline"])
+        options = options or {}
+
+        if lane == "batch":
+            return await self._request(prompt, lane, deadline, options, system_prompt)
+
+        start = time.monotonic()
+        if self.config.hedge_interactive_requests:
+            msg = await self._hedged_request(
+                prompt, lane, deadline, options, system_prompt
+            )
+        else:
+            msg = await self._request(prompt, lane, deadline, options, system_prompt)
+        self.metrics.observe("latency.interactive", time.monotonic() - start)
+        return msg
+
+    def get_model(self, options: Union[FieldOptions, None] = None) -> str:
+        """The model a request with these options goes to."""
+        return (options or {}).get("model") or self.config.openai_model
+
+    async def _hedged_request(
+        self,
+        prompt: str,
+        lane: Lane,
+        deadline: Deadline,
+        options: FieldOptions,
+        system_prompt: Union[str, None],
+    ) -> str:
+        """If the request is slower than the model's usual tail latency, fire a duplicate and take
+        whichever returns first. Hedges are capped at hedge_max_rate of interactive requests."""
+        start = time.monotonic()
+
+        # Losing requests are cancelled, so their latency is never known. A small control group
+        # that's never hedged gives an honest baseline to compare against.
+        if random.random() < HEDGE_CONTROL_RATE:
+            msg = await self._request(prompt, lane, deadline, options, system_prompt)
+            self.metrics.observe("latency.unhedged", time.monotonic() - start)
+            return msg
+
+        # Off this lane's own latency: batch requests queue under load, and would push it up
+        latency = f"latency.{lane}.{self.get_model(options)}"
+        hedge_after = None
+        # Only count requests that could have been hedged, or warm-up loosens the cap
+        if self.metrics.num_samples(latency) >= MIN_HEDGE_SAMPLES:
+            self.metrics.incr("hedge.eligible")
+            hedge_after = self.metrics.percentile(latency, self.config.hedge_percentile)
+
+        primary = asyncio.ensure_future(
+            self._request(prompt, lane, deadline, options, system_prompt)
+        )
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=hedge_after)
+            if not done and self._can_hedge():
+                self.metrics.incr("hedge.fired")
+                pending.add(
+                    asyncio.ensure_future(
+                        self._request(prompt, lane, deadline, options, system_prompt)
+                    )
+                )
+
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                winner = done.pop()
+                # If the first one back failed, the other might still succeed
+                if winner.exception() and pending:
+                    continue
+
+                if winner is not primary and not winner.exception():
+                    self.metrics.incr("hedge.won")
+                self.metrics.observe("latency.hedged", time.monotonic() - start)
+                return winner.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise Exception("Unreachable")
+
+    def _can_hedge(self) -> bool:
+        eligible = self.metrics.count("hedge.eligible")
+        fired = self.metrics.count("hedge.fired")
+        return fired < eligible * self.config.hedge_max_rate
+
+    async def _request(
+        self,
+        prompt: str,
+        lane: Lane,
+        deadline: Deadline,
+        options: FieldOptions,
+        system_prompt: Union[str, None],
+    ) -> str:
+        # Imported on first request to keep it out of Anki's startup
+        import aiohttp
+
+        deadline.check()
+        self.circuit_breaker.before_request(self.config.openai_api_key)
+        on_sent = on_request_sent.get()
+        if on_sent:
+            on_sent()
+        timeouts = get_lane_timeouts(self.config, lane)
+        timeout = aiohttp.ClientTimeout(
+            total=deadline.remaining(),
+            sock_connect=timeouts["connect"],
+            sock_read=timeouts["read"],
+        )
+
+        model = self.get_model(options)
+        messages = [{"role": "user", "content": prompt}]
+        # First, so it's part of the prefix every request for this note type shares
+        if system_prompt:
+            messages.insert(0, {"role": "system", "content": system_prompt})
+        body: Dict[str, Any] = {"model": model, "messages": messages}
+        for param in REQUEST_OPTIONS:
+            if param in options:
+                body[param] = options[param]  # type: ignore[literal-required]
+
+        start = time.monotonic()
+
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.post(
+                    f"{self.api_base}/chat/completions",
+                    headers={
+                        "Authorization": f"Bearer {self.config.openai_api_key}",
+                    },
+                    json=body,
+                ) as response:
+                    if response.status >= 400:
+                        await _raise_for_status(response)
+                    resp = await response.json()
+                    msg: str = resp["choices"][0]["message"]["content"]
+        except BaseException as e:
+            if isinstance(e, asyncio.TimeoutError):
+                self.metrics.incr(f"timeouts.{lane}")
+            self.circuit_breaker.record_failure(e)
+            raise
+
+        self.circuit_breaker.record_success()
+        self.metrics.observe(f"latency.{lane}.{model}", time.monotonic() - start)
+        self._record_usage(resp.get("usage") or {})
+        return msg
+
+    def _record_usage(self, usage: Dict[str, Any]) -> None:
+        self.metrics.incr("requests")
+        self.metrics.incr("tokens.prompt", usage.get("prompt_tokens", 0))
+        self.metrics.incr("tokens.completion", usage.get("completion_tokens", 0))
+        # Prompt tokens OpenAI served from its prompt cache: cheaper, and quicker to first token
+        details = usage.get("prompt_tokens_details") or {}
+        self.metrics.incr("tokens.cached", details.get("cached_tokens", 0))
+        sink = usage_sink.get()
+        if sink is not None:
+            sink.append(usage)
+
+
+async def _raise_for_status(response: Any) -> None:
+    """Like raise_for_status, but with OpenAI's error code (e.g. insufficient_quota) as the message
+    so callers can tell a systemic failure from a transient one."""
+    import aiohttp
+
+    code = None
+    try:
+        error = (await response.json(content_type=None)).get("error") or {}
+        code = error.get("code") or error.get("type")
+    except Exception:
+        pass
+
+    raise aiohttp.ClientResponseError(
+        response.request_info,
+        response.history,
+        status=response.status,
+        message=code or response.reason or "",
+        headers=response.headers,
+    )
+
+
+def get_hedging_report(metrics: Metrics = default_metrics) -> Dict[str, Any]:
+    """What hedging bought (tail latency vs. the unhedged control group) and what it cost (extra requests)."""
+    hedged_p99 = metrics.percentile("latency.hedged", 0.99)
+    unhedged_p99 = metrics.percentile("latency.unhedged", 0.99)
+    eligible = metrics.count("hedge.eligible")
+    fired = metrics.count("hedge.fired")
+
+    return {
+        "interactive_requests": eligible,
+        "hedges_fired": fired,
+        "hedges_won": metrics.count("hedge.won"),
+        "hedge_rate": fired / eligible if eligible else 0.0,
+        "p99_seconds": hedged_p99,
+        "unhedged_p99_seconds": unhedged_p99,
+        "p99_improvement_seconds": (
+            unhedged_p99 - hedged_p99
+            if unhedged_p99 is not None and hedged_p99 is not None
+            else None
+        ),
+        # Every hedge re-sends the whole prompt
+        "extra_requests": fired,
+    }
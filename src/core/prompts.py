@@ -0,0 +1,206 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Pure prompt helpers: field lookup, validation and rendering. No aqt, no mw."""
+
+import re
+from typing import Any, Callable, Dict, Iterable, Mapping, Sequence, Union
+
+from .config import FieldOptions, PromptMap
+from .normalize import normalize_field, truncate_to_tokens
+
+# {{Field?}} may be empty; any other referenced field has to be filled in before generating.
+# Groups are the field name and the optional marker, if any.
+FIELD_REFERENCE_PATTERN = re.compile(r"\{\{(.+?)(\?)?\}\}")
+# The same, just the field name; findall is quicker without the tuples
+FIELD_NAME_PATTERN = re.compile(r"\{\{(.+?)\??\}\}")
+# Tags and non-breaking spaces the editor leaves behind in a field that looks empty
+EMPTY_HTML_PATTERN = re.compile(r"<[^>]*>|&nbsp;")
+
+
+def to_lowercase_dict(d: Mapping[str, Any]) -> Dict[str, Any]:
+    """Converts a dictionary to lowercase keys"""
+    return {k.lower(): v for k, v in d.items()}
+
+
+def get_prompts(prompts_map: PromptMap) -> Dict[str, Dict[str, str]]:
+    """Gets the prompts map. Does not lowercase anything."""
+    return {
+        note_type: {k: v for k, v in m["fields"].items()}
+        for note_type, m in prompts_map["note_types"].items()
+    }
+
+
+def get_field_options(
+    prompts_map: PromptMap, note_type: str, field: str
+) -> FieldOptions:
+    """Generation options for a smart field; empty if it uses the defaults."""
+    note_type_map = prompts_map.get("note_types", {}).get(note_type)
+    if not note_type_map:
+        return {}
+    return note_type_map.get("options", {}).get(field, {})
+
+
+def get_system_prompt(prompts_map: PromptMap, note_type: str) -> Union[str, None]:
+    """The note type's system prompt; None if it doesn't have one."""
+    note_type_map = prompts_map.get("note_types", {}).get(note_type)
+    if not note_type_map:
+        return None
+    return note_type_map.get("system_prompt") or None
+
+
+def get_smart_fields_search(query: str, prompts_map: PromptMap) -> Union[str, None]:
+    """Restricts an Anki search to note types that have smart fields. None if there are no smart fields."""
+    note_types = " OR ".join(
+        f'"note:{name}"' for name in prompts_map["note_types"].keys()
+    )
+    if not note_types:
+        return None
+    return f"({query}) ({note_types})" if query else f"({note_types})"
+
+
+def get_missing_fields_search(prompts_map: PromptMap) -> Union[str, None]:
+    """Anki search for notes with at least one empty smart field. None if there are no smart fields."""
+    clauses = []
+    for note_type, note_type_map in prompts_map["note_types"].items():
+        fields = " OR ".join(f'"{field}:"' for field in note_type_map["fields"])
+        if fields:
+            clauses.append(f'("note:{note_type}" ({fields}))')
+    return " OR ".join(clauses) or None
+
+
+def get_sorted_field_names(note_type: Mapping[str, Any]) -> Sequence[str]:
+    return [field["name"] for field in sorted(note_type["flds"], key=lambda x: x["ord"])]
+
+
+def is_ai_field(
+    current_field_num: Union[int, None],
+    note_type: Union[Mapping[str, Any], None],
+    prompts_map: PromptMap,
+) -> Union[str, None]:
+    """Helper to determine if the current field is an AI field. Returns the non-lowercased field name if it is."""
+    # SNEAKY: current_field_num can be 0
+    if not note_type or current_field_num is None:
+        return None
+
+    # Sort dem fields and get their names
+    sorted_fields = get_sorted_field_names(note_type)
+    current_field = sorted_fields[current_field_num].lower()
+
+    prompts_for_card = to_lowercase_dict(
+        get_prompts(prompts_map).get(note_type["name"], {})
+    )
+
+    is_ai = bool(prompts_for_card.get(current_field, None))
+    return sorted_fields[current_field_num] if is_ai else None
+
+
+def get_prompt_fields_lower(prompt: str):
+    """Every field the prompt references, required or optional."""
+    return [field.lower() for field in FIELD_NAME_PATTERN.findall(prompt)]
+
+
+def get_required_fields_lower(prompt: str) -> Sequence[str]:
+    """Fields the prompt references that aren't marked optional."""
+    fields = FIELD_REFERENCE_PATTERN.findall(prompt)
+    return [field.lower() for field, optional in fields if not optional]
+
+
+def get_missing_required_fields(
+    prompt: str, note: Mapping[str, str]
+) -> Sequence[str]:
+    """Required fields that are empty on the note. Generating with them would just waste a request."""
+    note_fields = to_lowercase_dict(note)
+    return [
+        field
+        for field in dict.fromkeys(get_required_fields_lower(prompt))
+        if is_empty(note_fields.get(field, ""))
+    ]
+
+
+def is_empty(value: str) -> bool:
+    return not EMPTY_HTML_PATTERN.sub("", value).strip()
+
+
+def prompt_has_error(
+    prompt: str,
+    note_fields: Iterable[str],
+    existing_prompts: Mapping[str, str],
+    target_field: Union[str, None] = None,
+) -> Union[str, None]:
+    """Checks if a prompt has an error. Returns the error message if there is one."""
+    note_fields_lower = {field.lower() for field in note_fields}
+    prompt_fields = get_prompt_fields_lower(prompt)
+    existing_fields = to_lowercase_dict(existing_prompts)
+
+    # Check for fields that aren't in the card
+    for prompt_field in prompt_fields:
+        if prompt_field not in note_fields_lower:
+            return f"Invalid field in prompt: {prompt_field}"
+        if prompt_field in existing_fields:
+            return f"Can't reference other smart fields ({prompt_field}) in the prompt. (...yet 😈)"
+
+    # Can't reference itself
+    if target_field and target_field.lower() in prompt_fields:
+        return "Cannot reference the target field in the prompt."
+
+    return None
+
+
+def interpolate_prompt(
+    prompt: str, note: Mapping[str, str], options: Union[FieldOptions, None] = None
+) -> str:
+    """Fills in {{field}} references from a note (or any field name -> value mapping).
+    Values are normalized first, unless the smart field's options turn that off."""
+    options = options or {}
+    # field.lower() -> value map, to make this whole process case insensitive
+    all_note_fields = to_lowercase_dict(note)
+
+    normalize = options.get("normalize_inputs", True)
+    max_tokens = options.get("max_input_tokens")
+
+    def get_value(field: str) -> str:
+        value: str = all_note_fields.get(field, "")
+        if normalize:
+            value = normalize_field(value)
+        if max_tokens:
+            value = truncate_to_tokens(value, max_tokens)
+        return value
+
+    if options.get("prompt_layout") == "static_prefix":
+        return layout_static_prefix(prompt, get_value)
+
+    # Sub values in prompt; optional or not, an empty field is just left blank
+    prompt = FIELD_REFERENCE_PATTERN.sub(lambda x: get_value(x.group(1).lower()), prompt)
+
+    print("Processed prompt: ", prompt)
+    return prompt
+
+
+def layout_static_prefix(prompt: str, get_value: Callable[[str], str]) -> str:
+    """The prompt with its references left in, followed by each referenced field's value.
+    Everything up to the values is the same for every note, so it's a cacheable prefix."""
+    # field.lower() -> the name as the prompt writes it
+    names = {name.lower(): name for name, _ in FIELD_REFERENCE_PATTERN.findall(prompt)}
+    template = FIELD_REFERENCE_PATTERN.sub(lambda x: "{{" + x.group(1) + "}}", prompt)
+    values = "\n".join(f"{name}: {get_value(field)}" for field, name in names.items())
+
+    prompt = f"{template}\n\n{values}"
+    print("Processed prompt: ", prompt)
+    return prompt
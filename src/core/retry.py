@@ -0,0 +1,91 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import random
+from typing import Awaitable, Callable, TypeVar, Union
+
+from .circuit_breaker import get_fatal_error_class
+from .deadline import Deadline, DeadlineExceeded
+
+T = TypeVar("T")
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RetryPolicy:
+    """Retries transient failures (rate limits, 5xx, dropped connections) with jittered exponential backoff."""
+
+    def __init__(
+        self, max_attempts: int = 4, base_delay: float = 1.0, max_delay: float = 30.0
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, e: BaseException) -> bool:
+        import aiohttp
+
+        if isinstance(e, DeadlineExceeded) or get_fatal_error_class(e):
+            return False
+        if isinstance(e, aiohttp.ClientResponseError):
+            return e.status in RETRYABLE_STATUSES
+        return isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+    def get_delay(self, attempt: int, e: BaseException) -> float:
+        """Seconds to wait before the next attempt. Honors Retry-After if the server sent one."""
+        retry_after = _get_retry_after(e)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+
+        # Full jitter: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    async def run(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        deadline: Union[Deadline, None] = None,
+        expected_attempt_seconds: float = 0.0,
+    ) -> T:
+        """Runs fn, retrying transient failures. Won't start an attempt that can't finish before the deadline."""
+        attempt = 0
+        while True:
+            try:
+                return await fn()
+            except Exception as e:
+                attempt += 1
+                if attempt >= self.max_attempts or not self.should_retry(e):
+                    raise
+                delay = self.get_delay(attempt, e)
+                if deadline and delay + expected_attempt_seconds > deadline.remaining():
+                    print(f"Not retrying {type(e).__name__}: no time left before the deadline")
+                    raise
+                print(f"Retrying after {type(e).__name__} (attempt {attempt}) in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+
+def _get_retry_after(e: BaseException) -> Union[float, None]:
+    import aiohttp
+
+    if not isinstance(e, aiohttp.ClientResponseError) or not e.headers:
+        return None
+    try:
+        return float(e.headers.get("Retry-After", ""))
+    except ValueError:
+        return None
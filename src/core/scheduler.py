@@ -0,0 +1,264 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, nullcontext
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Sequence,
+    TypeVar,
+    Union,
+)
+
+from .budget import BudgetTracker
+from .metrics import Metrics, metrics as default_metrics
+
+T = TypeVar("T")
+
+Job = Callable[[], Awaitable[T]]
+
+DEFAULT_INITIAL_CONCURRENCY = 4
+DEFAULT_MAX_CONCURRENCY = 64
+# Latency is judged against the median of this many recent requests, so the baseline follows
+# a lasting change (longer prompts, bigger max_tokens) instead of holding on to old ones
+LATENCY_WINDOW = 50
+# Too few samples to judge a spike by
+MIN_LATENCY_SAMPLES = 10
+
+
+def is_overload_error(e: BaseException) -> bool:
+    """Errors that mean we're sending too much: rate limits, overloaded servers, timeouts."""
+    import aiohttp
+
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status in (429, 503)
+    return isinstance(e, asyncio.TimeoutError)
+
+
+class AdaptiveLimiter:
+    """AIMD limit on in-flight requests, à la TCP congestion control.
+
+    Each success grows the limit by 1/limit (so about +1 per round trip). A 429, timeout or
+    latency spike halves it, at most once per cool-down so a burst of errors from the same
+    window only counts once. Not tied to an event loop, so it can outlive asyncio.run().
+
+    A spike is against the median latency of recent requests, which spikes go into too.
+    """
+
+    def __init__(
+        self,
+        initial: float = DEFAULT_INITIAL_CONCURRENCY,
+        min_limit: float = 1,
+        max_limit: float = DEFAULT_MAX_CONCURRENCY,
+        decrease_factor: float = 0.5,
+        latency_spike_factor: float = 2.5,
+    ) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.initial = self.limit = max(min_limit, min(max_limit, initial))
+        self.decrease_factor = decrease_factor
+        self.latency_spike_factor = latency_spike_factor
+
+        self.in_flight = 0
+        # Callers run on different threads and event loops (a batch, the editor, background
+        # generation), so waiters are thread safe futures and the state is behind a lock
+        self._lock = threading.Lock()
+        self._waiters: Deque["Future[None]"] = deque()
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._baseline_latency: Union[float, None] = None
+        self._last_decrease = 0.0
+        # Whether OpenAI pushed back (429, 503, timeouts), not just latency rising
+        self._overloaded = False
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self._acquire()
+        try:
+            yield
+        finally:
+            self._release()
+
+    def on_success(self, latency: float) -> None:
+        with self._lock:
+            spike = (
+                self._baseline_latency is not None
+                and latency > self._baseline_latency * self.latency_spike_factor
+            )
+            self._latencies.append(latency)
+            if len(self._latencies) >= MIN_LATENCY_SAMPLES:
+                self._baseline_latency = sorted(self._latencies)[len(self._latencies) // 2]
+
+            if spike:
+                self._decrease()
+                return
+
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._wake()
+
+    def on_overload(self) -> None:
+        with self._lock:
+            self._overloaded = True
+            self._decrease()
+
+    def get_learned_limit(self) -> Union[int, None]:
+        """The limit to start the next session at; None if there's too little to go on. Latency
+        spikes only hold this session back: they depend as much on prompts and max_tokens as on load."""
+        with self._lock:
+            if self._baseline_latency is None:
+                return None
+            if self._overloaded:
+                return int(self.limit)
+            return int(max(self.limit, self.initial))
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        cool_down = max(1.0, self._baseline_latency or 0)
+        if now - self._last_decrease < cool_down:
+            return
+
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        print(f"Overloaded, reducing concurrency to {int(self.limit)}")
+
+    async def _acquire(self) -> None:
+        while True:
+            with self._lock:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter: "Future[None]" = Future()
+                self._waiters.append(waiter)
+            try:
+                # Resolved through the waiting loop, whichever thread releases the slot
+                await asyncio.wrap_future(waiter)
+            finally:
+                with self._lock:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+
+    def _release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self._wake()
+
+    def _wake(self) -> None:
+        """Wakes as many waiters as there are free slots. Call with the lock held."""
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            # Skips waiters cancelled meanwhile, and stops them being cancelled once woken
+            if waiter.set_running_or_notify_cancel():
+                waiter.set_result(None)
+                free -= 1
+
+
+class Scheduler:
+    """Runs batch jobs concurrently. Jobs are optionally bounded; requests are bounded per model by an AdaptiveLimiter,
+    and by spend if there's a budget."""
+
+    def __init__(
+        self,
+        max_in_flight: Union[int, None] = None,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        metrics: Metrics = default_metrics,
+        budget: Union[BudgetTracker, None] = None,
+    ) -> None:
+        self.max_in_flight = max_in_flight
+        self.max_concurrency = max_concurrency
+        self.metrics = metrics
+        self.budget = budget
+        self.limiters: Dict[str, AdaptiveLimiter] = {}
+
+    def get_limiter(
+        self, model: str, initial: Union[float, None] = None
+    ) -> AdaptiveLimiter:
+        if model not in self.limiters:
+            self.limiters[model] = AdaptiveLimiter(
+                initial=initial or DEFAULT_INITIAL_CONCURRENCY,
+                max_limit=self.max_concurrency,
+            )
+        return self.limiters[model]
+
+    def learned_limits(self) -> Dict[str, int]:
+        """The limit each model settled on, to seed the next session with."""
+        limits = {
+            model: limiter.get_learned_limit() for model, limiter in self.limiters.items()
+        }
+        return {model: limit for model, limit in limits.items() if limit is not None}
+
+    async def run_request(
+        self,
+        model: str,
+        initial: Union[float, None],
+        fn: Job[T],
+        note_type: Union[str, None] = None,
+    ) -> T:
+        """Runs a single request under the model's adaptive limit, feeding back how it went.
+
+        With a budget, waits its turn past a soft limit and raises BudgetExceededError at a hard
+        one; what the request spent counts towards note_type's budget."""
+        if self.budget:
+            await self.budget.wait(note_type)
+
+        limiter = self.get_limiter(model, initial)
+        async with limiter.slot():
+            # Spent while waiting for the slot
+            if self.budget:
+                self.budget.check(note_type)
+
+            start = time.monotonic()
+            try:
+                with self.budget.track(model, note_type) if self.budget else nullcontext():
+                    result = await fn()
+            except Exception as e:
+                if is_overload_error(e):
+                    limiter.on_overload()
+                raise
+            limiter.on_success(time.monotonic() - start)
+            self.metrics.observe(f"concurrency.{model}", limiter.limit)
+            return result
+
+    async def run(self, jobs: Sequence[Job[T]]) -> List[Union[T, BaseException]]:
+        """Runs every job, returning results (or the exception each job raised) in job order.
+
+        A pool of workers (max_in_flight, or max_concurrency without one) takes jobs in turn, so a
+        job's coroutine only exists while it runs, rather than the whole batch waiting on a semaphore."""
+        results: List[Any] = [None] * len(jobs)
+        remaining = iter(enumerate(jobs))
+
+        async def worker() -> None:
+            for i, job in remaining:
+                try:
+                    results[i] = await job()
+                except Exception as e:
+                    results[i] = e
+
+        num_workers = min(self.max_in_flight or self.max_concurrency, len(jobs))
+        await asyncio.gather(*[worker() for _ in range(num_workers)])
+        return results
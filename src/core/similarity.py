@@ -0,0 +1,283 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Near-duplicate response lookup: finds an earlier response whose inputs were nearly the same.
+
+Inputs are canonicalized (no markup, case, punctuation or extra whitespace) and hashed as
+character 3-grams. A MinHash signature of the hashes, bucketed by bands (locality sensitive
+hashing), finds the few entries worth comparing, however many there are; candidates are then
+compared by their 3-gram hashes themselves, so a reused response really was for inputs that
+similar. A threshold of 1 needs the canonical inputs to match exactly. Runs entirely locally;
+optionally persisted alongside the response cache."""
+
+import hashlib
+import heapq
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Sequence, Set, Tuple, Union
+
+from .normalize import normalize_field
+
+# Signature length, split into BANDS bands of ROWS values each. Entries sharing any band are
+# compared; at these sizes a pair 80% similar shares one 98% of the time, 50% similar 40%.
+SIGNATURE_SIZE = 32
+SIGNATURE_BYTES = SIGNATURE_SIZE * 4
+BANDS = 8
+BAND_BYTES = SIGNATURE_BYTES // BANDS
+SHINGLE_SIZE = 3
+# 3-gram hashes kept per entry to compare by: all of them for inputs up to about this many
+# characters. Longer inputs keep the smallest (a bottom-k sketch), within a percent or two.
+MAX_SHINGLES = 1024
+DIGEST_SIZE = 16
+# Added per bin skipped when an empty bin borrows its neighbour's value, so borrowed values
+# don't collide with the neighbour's own
+DENSIFY_OFFSET = 0x9E3779B1
+MAX_HASH = 0xFFFFFFFF
+
+# About 1.4kb each for short inputs, so 140mb or so when full. Lookups stay well under a
+# millisecond when full.
+MAX_ENTRIES = 100_000
+
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]+")
+
+
+def canonicalize(text: str) -> str:
+    """What's left of text once differences that don't change its meaning are taken out."""
+    text = PUNCTUATION_PATTERN.sub(" ", normalize_field(text).lower())
+    return " ".join(text.split())
+
+
+def get_hashes(text: str) -> Set[int]:
+    """Hashes of a canonicalized text's character 3-grams. crc32 rather than hash(), so they're
+    the same from run to run."""
+    padded = f" {text} "
+    return {
+        zlib.crc32(padded[i : i + SHINGLE_SIZE].encode())
+        for i in range(max(len(padded) - SHINGLE_SIZE + 1, 1))
+    }
+
+
+def make_sketch(inputs: Sequence[str]) -> Tuple[bytes, bytes, bytes]:
+    """A sketch of the inputs: (a digest of their canonical text, to tell identical inputs by;
+    their MinHash signature, to find candidates by; their 3-gram hashes, to compare candidates by)."""
+    # Canonical values have no line breaks left, so they can't run into each other
+    text = "\n".join(canonicalize(value) for value in inputs)
+    hashes = get_hashes(text)
+    shingles = (
+        sorted(hashes)
+        if len(hashes) <= MAX_SHINGLES
+        else heapq.nsmallest(MAX_SHINGLES, hashes)
+    )
+    return (
+        hashlib.blake2b(text.encode(), digest_size=DIGEST_SIZE).digest(),
+        make_signature(hashes),
+        array("I", shingles).tobytes(),
+    )
+
+
+def make_signature(hashes: Set[int]) -> bytes:
+    """MinHash signature of a text's 3-gram hashes.
+
+    The hashes are split into SIGNATURE_SIZE bins by their low bits, keeping each bin's minimum
+    (one permutation hashing); bins nothing landed in borrow from the next bin that has a value."""
+    bins = [MAX_HASH] * SIGNATURE_SIZE
+    for h in hashes:
+        i = h % SIGNATURE_SIZE
+        if h < bins[i]:
+            bins[i] = h
+
+    if MAX_HASH in bins:
+        original = bins[:]
+        # Twice round backwards, so every empty bin has passed the next filled one, circularly
+        next_filled = 0
+        for k in range(2 * SIGNATURE_SIZE - 1, -1, -1):
+            i = k % SIGNATURE_SIZE
+            if original[i] != MAX_HASH:
+                next_filled = k
+            elif k < SIGNATURE_SIZE:
+                distance = next_filled - k
+                bins[i] = (
+                    original[next_filled % SIGNATURE_SIZE] + distance * DENSIFY_OFFSET
+                ) & MAX_HASH
+
+    return array("I", bins).tobytes()
+
+
+def get_similarity(a: bytes, b: bytes) -> float:
+    """Jaccard similarity of the 3-gram hashes of two sketches. Exact unless either input was
+    long enough to be cut to MAX_SHINGLES; then estimated from the smallest hashes of both."""
+    x = set(array("I", a))
+    y = set(array("I", b))
+    if len(x) < MAX_SHINGLES and len(y) < MAX_SHINGLES:
+        return len(x & y) / len(x | y)
+    union = sorted(x | y)[:MAX_SHINGLES]
+    return sum(1 for h in union if h in x and h in y) / len(union)
+
+
+class SimilarResponses:
+    """Responses indexed by the inputs they were generated from, for reuse on nearly the same inputs.
+
+    Entries are grouped by scope (a smart field's prompt, model and options): only responses to
+    the same question are ever reused. Holds the most recent max_entries. Thread safe: a batch and
+    background generation share it."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, path: Union[str, None] = None):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Entry id -> (scope id, digest, signature, 3-gram hashes, response), oldest first
+        self._entries: "OrderedDict[int, Tuple[int, bytes, bytes, bytes, str]]" = OrderedDict()
+        # Band key -> entry id, or ids if more than one landed there. Most buckets hold one
+        # entry, and a list each would take several times the memory.
+        self._buckets: Dict[int, Union[int, List[int]]] = {}
+        self._scopes: Dict[str, int] = {}
+        self._next_id = 0
+        self._db: Union[sqlite3.Connection, None] = None
+        self._lock = threading.Lock()
+
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "create table if not exists similar_entries (scope text not null, digest blob not null, "
+                "signature blob not null, shingles blob not null, response text not null, primary key (scope, digest))"
+            )
+            self._load()
+
+    def find(
+        self, scope: str, inputs: Sequence[str], threshold: float
+    ) -> Union[str, None]:
+        """The response for the most similar inputs in scope, if they're at least threshold similar.
+        At 1 or more, only for the same canonical inputs."""
+        # Scopes are only ever added, so this needs no lock
+        scope_id = self._scopes.get(scope)
+        if scope_id is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        digest, signature, shingles = make_sketch(inputs)
+        with self._lock:
+            best: Union[int, None] = None
+            best_similarity = threshold
+            for entry_id in self._get_candidates(scope_id, signature):
+                entry_scope, entry_digest, _, entry_shingles, _ = self._entries[entry_id]
+                if entry_scope != scope_id:
+                    continue
+                if entry_digest == digest:
+                    best = entry_id
+                    break
+                if threshold >= 1:
+                    continue
+                similarity = get_similarity(shingles, entry_shingles)
+                if similarity >= best_similarity:
+                    best, best_similarity = entry_id, similarity
+
+            if best is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(best)
+            return self._entries[best][4]
+
+    def add(self, scope: str, inputs: Sequence[str], response: str) -> None:
+        digest, signature, shingles = make_sketch(inputs)
+        with self._lock:
+            self._add(scope, digest, signature, shingles, response)
+            if self._db:
+                self._db.execute(
+                    "insert or replace into similar_entries (scope, digest, signature, shingles, response) values (?, ?, ?, ?, ?)",
+                    (scope, digest, signature, shingles, response),
+                )
+                self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+    def _add(
+        self, scope: str, digest: bytes, signature: bytes, shingles: bytes, response: str
+    ) -> None:
+        scope_id = self._scopes.setdefault(scope, len(self._scopes))
+        # The same inputs again replace the old response
+        for entry_id in self._get_candidates(scope_id, signature):
+            entry_scope, entry_digest, _, _, _ = self._entries[entry_id]
+            if entry_scope == scope_id and entry_digest == digest:
+                self._remove(entry_id)
+                break
+
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (scope_id, digest, signature, shingles, response)
+        for key in self._get_band_keys(scope_id, signature):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                self._buckets[key] = entry_id
+            elif isinstance(bucket, int):
+                self._buckets[key] = [bucket, entry_id]
+            else:
+                bucket.append(entry_id)
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_id: int) -> None:
+        scope_id, _, signature, _, _ = self._entries.pop(entry_id)
+        for key in self._get_band_keys(scope_id, signature):
+            bucket = self._buckets.get(key)
+            if isinstance(bucket, list):
+                bucket.remove(entry_id)
+                if len(bucket) == 1:
+                    self._buckets[key] = bucket[0]
+            elif bucket == entry_id:
+                del self._buckets[key]
+
+    def _get_candidates(self, scope_id: int, signature: bytes) -> List[int]:
+        candidates: List[int] = []
+        for key in self._get_band_keys(scope_id, signature):
+            bucket = self._buckets.get(key)
+            if isinstance(bucket, int):
+                candidates.append(bucket)
+            elif bucket:
+                candidates.extend(bucket)
+        return list(dict.fromkeys(candidates))
+
+    def _get_band_keys(self, scope_id: int, signature: bytes) -> List[int]:
+        return [
+            hash((scope_id, band, signature[band * BAND_BYTES : (band + 1) * BAND_BYTES]))
+            for band in range(BANDS)
+        ]
+
+    def _load(self) -> None:
+        if not self._db:
+            return
+        rows = self._db.execute(
+            "select scope, digest, signature, shingles, response from similar_entries order by rowid desc limit ?",
+            (self.max_entries,),
+        ).fetchall()
+        for scope, digest, signature, shingles, response in reversed(rows):
+            self._add(scope, digest, signature, shingles, response)
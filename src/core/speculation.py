@@ -0,0 +1,101 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Dict, Hashable, Tuple, Union
+
+MAX_SPECULATIONS = 100
+SPECULATION_TTL_SECONDS = 10 * 60
+
+
+class SpeculationStore:
+    """Responses generated ahead of time, before anyone asks for them (e.g. when a source field loses focus).
+
+    Keyed like the response cache, so a speculation is only used if the prompt it was made from
+    still matches. Each is taken at most once. A slot (note + target field) has at most one
+    speculation: starting a new one cancels the stale one. Thread safe, since speculations and
+    the requests that take them run on different threads and event loops."""
+
+    def __init__(
+        self, max_entries: int = MAX_SPECULATIONS, ttl: float = SPECULATION_TTL_SECONDS
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self._lock = threading.Lock()
+        # key -> (future, started at)
+        self._entries: "OrderedDict[str, Tuple[Future[str], float]]" = OrderedDict()
+        # slot -> (key, loop and task doing the work)
+        self._slots: Dict[Hashable, Tuple[str, Any, "asyncio.Task[Any]"]] = {}
+
+    def begin(self, slot: Hashable, key: str) -> "Union[Future[str], None]":
+        """Registers a speculation for key from the calling task. Returns None if there's already one for key."""
+        with self._lock:
+            self._expire()
+            if key in self._entries:
+                return None
+
+            stale = self._slots.pop(slot, None)
+            if stale:
+                stale_key, loop, task = stale
+                print("Cancelling stale speculation")
+                self._entries.pop(stale_key, None)
+                try:
+                    loop.call_soon_threadsafe(task.cancel)
+                except RuntimeError:
+                    # Its loop already finished
+                    pass
+
+            future: "Future[str]" = Future()
+            self._entries[key] = (future, time.monotonic())
+            current = asyncio.current_task()
+            if current:
+                self._slots[slot] = (key, asyncio.get_running_loop(), current)
+            while len(self._entries) > self.max_entries:
+                _, (oldest, _) = self._entries.popitem(last=False)
+                oldest.cancel()
+            return future
+
+    def finish(self, slot: Hashable, key: str) -> None:
+        with self._lock:
+            if slot in self._slots and self._slots[slot][0] == key:
+                del self._slots[slot]
+
+    def take(self, key: str) -> "Union[Future[str], None]":
+        """Removes and returns the speculation for key (maybe still running), if there is one."""
+        with self._lock:
+            self._expire()
+            entry = self._entries.pop(key, None)
+            if not entry or entry[0].cancelled():
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self._entries:
+            key, (future, started) = next(iter(self._entries.items()))
+            if now - started < self.ttl:
+                return
+            del self._entries[key]
+            future.cancel()
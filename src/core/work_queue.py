@@ -0,0 +1,82 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import heapq
+import itertools
+from typing import Dict, List, Tuple, Union
+
+# Lower runs first
+PRIORITY_NORMAL = 0
+PRIORITY_BACKFILL = 1
+
+
+class WorkQueue:
+    """Note ids waiting for background generation, most urgent first.
+
+    Ordered by priority, then by `order` (e.g. how soon the note's cards are due). A note is only
+    queued once: pushing it again keeps whichever of the two places is more urgent."""
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[int, float, int, int]] = []
+        self._entries: Dict[int, Tuple[int, float]] = {}
+        self._counter = itertools.count()
+
+    def push(self, note_id: int, priority: int, order: float = 0.0) -> None:
+        current = self._entries.get(note_id)
+        if current and current <= (priority, order):
+            return
+        # The old heap entry goes stale and is skipped when popped
+        self._entries[note_id] = (priority, order)
+        heapq.heappush(self._heap, (priority, order, next(self._counter), note_id))
+
+    def pop(self, max_priority: Union[int, None] = None) -> Union[int, None]:
+        """Removes and returns the most urgent note id, or None if there isn't one at max_priority or better."""
+        self._drop_stale()
+        if not self._heap:
+            return None
+        priority, _, _, note_id = self._heap[0]
+        if max_priority is not None and priority > max_priority:
+            return None
+
+        heapq.heappop(self._heap)
+        del self._entries[note_id]
+        return note_id
+
+    def peek_priority(self) -> Union[int, None]:
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def count(self, priority: int) -> int:
+        return sum(1 for p, _ in self._entries.values() if p == priority)
+
+    def discard(self, note_id: int) -> None:
+        self._entries.pop(note_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, note_id: int) -> bool:
+        return note_id in self._entries
+
+    def _drop_stale(self) -> None:
+        while self._heap:
+            priority, order, _, note_id = self._heap[0]
+            if self._entries.get(note_id) == (priority, order):
+                return
+            heapq.heappop(self._heap)
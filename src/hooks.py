@@ -22,9 +22,10 @@ Setup the hooks for the Anki plugin
 """
 
 import logging
-from typing import List, Any, Tuple
+from typing import Callable, Dict, List, Any, Sequence, Tuple
 from aqt import (
     QAction,
+    QInputDialog,
     QKeySequence,
     QMenu,
     gui_hooks,
@@ -33,24 +34,39 @@ from aqt import (
     browser,
     QKeySequence,
 )
-from anki.notes import Note
-from anki.cards import Card
-
-from .ui.changelog import (
-    perform_update_check,
-)
+from anki.collection import BrowserColumns
+from anki.notes import Note, NoteId
+from anki.cards import Card, CardId
+from aqt.browser.table import CellRow, SearchContext
 
 from .ui.ui_utils import show_message_box
 from .ui.sparkle import Sparkle
 from .processor import Processor
+from .background import BackgroundGenerator
+from .core.field_status import (
+    find_missing_note_ids,
+    find_stale_note_ids,
+    get_search_terms,
+    get_status_text,
+    replace_search_terms,
+)
 
 from .prompts import is_ai_field
-from .ui.addon_options_dialog import AddonOptionsDialog
 
 from .utils import bump_usage_counter, check_for_api_key
 from .config import config
 
-from .sentry import sentry, with_sentry
+from .sentry import (
+    get_sentry,
+    init_sentry_in_background,
+    report_exception,
+    with_sentry,
+)
+
+# How long after the main window is up to run startup work Anki doesn't need (update check, Sentry)
+DEFERRED_STARTUP_MS = 3000
+
+SMART_FIELDS_COLUMN = "smart_notes_status"
 
 
 def with_processor(fn):
@@ -69,6 +85,9 @@ def with_processor(fn):
 @with_sentry
 @with_processor  # type: ignore
 def on_options(processor: Processor):
+    # Dialogs are imported when first opened, not at startup
+    from .ui.addon_options_dialog import AddonOptionsDialog
+
     dialog = AddonOptionsDialog(config, processor)
     dialog.exec()
 
@@ -121,7 +140,7 @@ def add_editor_top_button(processor: Processor, buttons: List[str], e: editor.Ed
 
         set_button_disabled()
 
-        def on_success(did_change: bool):
+        def on_success(did_change: List[str]):
             set_button_enabled()
 
             if not did_change:
@@ -130,7 +149,7 @@ def add_editor_top_button(processor: Processor, buttons: List[str], e: editor.Ed
             # New notes have note id 0
             if note.id:
                 # Only update note if it's already in the database
-                mw.col.update_note(note)
+                processor.writer.write(note, did_change)
             editor.loadNote()
 
         processor.process_note(
@@ -138,6 +157,7 @@ def add_editor_top_button(processor: Processor, buttons: List[str], e: editor.Ed
             overwrite_fields=True,
             on_success=on_success,
             on_failure=lambda _: set_button_enabled(),
+            lane="editor",
         )
 
     button = e.addButton(
@@ -165,22 +185,69 @@ def on_browser_context(processor: Processor, browser: browser.Browser, menu: QMe
     menu.addSeparator()
     menu.addAction(item)
 
-    # TODO: should show # succeess and failed
-    notes = browser.selected_notes()
+    search_item = QAction("✨ Generate Smart Fields for Search...", menu)
+    menu.addAction(search_item)
 
-    def on_success(updated: List[Note], errors: List[Note]) -> None:
-        if not len(updated) and len(errors):
-            show_message_box("All notes failed. Most likely hit OpenAI rate limit.")
-        elif len(errors):
-            show_message_box(
-                f"Processed {len(updated)} notes successfully. {len(errors)} notes failed. Most likely hit a rate limit."
-            )
-        else:
-            show_message_box(f"Processed {len(updated)} notes successfully.")
+    def on_success(updated: int, failed: int, unchanged: int) -> None:
+        show_batch_result(processor, updated, failed, unchanged)
 
+    # Look up the selection when clicked, not every time the menu opens
     item.triggered.connect(
-        lambda: processor.process_notes_with_progress(notes, on_success)
+        lambda: processor.process_notes_with_progress(
+            browser.selected_notes(), on_success
+        )
+    )
+    search_item.triggered.connect(
+        lambda: on_generate_for_search(processor, browser, on_success)
+    )
+
+
+def on_generate_for_search(
+    processor: Processor,
+    browser: browser.Browser,  # type: ignore
+    on_success: Callable[[int, int, int], None],
+) -> None:
+    query, ok = QInputDialog.getText(
+        browser,
+        "Generate Smart Fields",
+        "Generate smart fields for every note matching this search:",
+        text=browser.current_search(),
     )
+    if ok:
+        processor.process_search_with_progress(query, on_success)
+
+
+def show_batch_result(
+    processor: Processor, updated: int, failed: int, unchanged: int = 0
+) -> None:
+    open_error = processor.client.circuit_breaker.get_open_error()
+    budget_error = processor.budget.last_error
+    if budget_error:
+        paused = len(processor.budget.ledger.get_paused())
+        later = (
+            "the background backfill will finish them once the budget allows"
+            if config.backfill_enabled
+            else "generate them again once the budget allows"
+        )
+        show_message_box(
+            f"Paused after {updated} notes: {budget_error.args[0]}. {paused} notes were left for later; {later}."
+        )
+    elif failed and open_error:
+        show_message_box(
+            f"Stopped after {updated} notes: {open_error.args[0]}. {failed} notes were not processed."
+        )
+    elif not updated and failed:
+        show_message_box("All notes failed. Most likely hit OpenAI rate limit.")
+    elif failed:
+        show_message_box(
+            f"Updated {updated} notes. {failed} notes had fields that failed, most likely from a rate limit. Run it again to fill in just the missing fields."
+        )
+    elif unchanged:
+        show_message_box(
+            f"Processed {updated} notes successfully. {unchanged} more already had the same values and weren't rewritten."
+        )
+    else:
+        show_message_box(f"Processed {updated} notes successfully.")
 
 
 @with_sentry
@@ -196,10 +263,17 @@ def on_main_window(processor: Processor):
     mw.form.menuTools.addAction(options_action)
     # TODO: not working for some reason
     mw.addonManager.setConfigAction(__name__, on_options(processor))
-    perform_update_check()
 
-    if sentry:
-        sentry.configure_scope()
+    # Nothing else is needed for Anki to start, so wait until the main window has settled
+    mw.progress.single_shot(DEFERRED_STARTUP_MS, on_startup_idle, False)
+
+
+@with_sentry
+def on_startup_idle() -> None:
+    from .ui.changelog import perform_update_check
+
+    init_sentry_in_background()
+    perform_update_check()
 
 
 # TODO: do I need a profile_will_close thing here?
@@ -241,7 +315,7 @@ def on_review(processor: Processor, card: Card):
 
     note = card.note()
 
-    def on_success(did_change: bool):
+    def on_success(did_change: List[str]):
         if not did_change:
             return
 
@@ -251,9 +325,11 @@ def on_review(processor: Processor, card: Card):
 
         print("Did update card on review...")
 
-        mw.col.update_note(note)
-        card.load()
-        Sparkle()
+        def on_written() -> None:
+            card.load()
+            Sparkle()
+
+        processor.writer.write(note, did_change, on_written)
 
         # NOTE: Calling this inside processor causes a crash with
         # Suppressing invocation of -[NSApplication runModalSession:]. -[NSApplication runModalSession:] cannot run inside a transaction begin/commit pair, or inside a transaction commit. Consider switching to an asynchronous equivalent.
@@ -275,15 +351,124 @@ def cleanup() -> None:
     #   File "logging", line 1066, in flush
     # RuntimeError: wrapped C/C++ object of type ErrorHandler has been deleted
 
+    sentry = get_sentry()
+    if sentry:
+        sentry.end_session()
+
     logger = logging.getLogger("sentry_sdk.errors")
     logger.handlers.clear()
 
 
+def setup_background_hooks(background: BackgroundGenerator) -> None:
+    def on_activity(*args: Any) -> None:
+        background.on_user_activity()
+
+    gui_hooks.reviewer_did_show_question.append(on_activity)
+    gui_hooks.editor_did_load_note.append(on_activity)
+    gui_hooks.editor_did_fire_typing_timer.append(on_activity)
+    gui_hooks.add_cards_did_add_note.append(background.on_note_added)
+    gui_hooks.operation_did_execute.append(background.on_operation)
+    def on_main_window() -> None:
+        if mw:
+            mw.progress.single_shot(DEFERRED_STARTUP_MS, background.start, False)
+
+    gui_hooks.main_window_did_init.append(on_main_window)
+    gui_hooks.profile_will_close.append(background.stop)
+
+
+# Not with_sentry: this is a filter, and must return `changed` even if speculating fails
+@with_processor  # type: ignore
+def on_editor_unfocus_field(
+    processor: Processor, changed: bool, note: Note, field_idx: int
+) -> bool:
+    try:
+        if changed and config.speculative_generation:
+            processor.speculate(note, note.keys()[field_idx])
+    except Exception as e:
+        print(f"Error speculating: {e}")
+        report_exception(e)
+    return changed
+
+
+# Not with_sentry: a failed search should show up in the browser like any other bad search
+@with_processor  # type: ignore
+def on_browser_will_search(processor: Processor, ctx: SearchContext) -> None:
+    """Handles smart:missing and smart:stale, by swapping them for the notes they match."""
+    terms = get_search_terms(ctx.search)
+    if not terms or not mw or not mw.col.db:
+        return
+
+    # Judged against the prompts as they are now
+    processor.refresh_config()
+    matches: Dict[str, Sequence[NoteId]] = {}
+    for term in terms:
+        if term == "missing":
+            matches[term] = find_missing_note_ids(
+                mw.col, processor.engine_config.prompts_map
+            )
+        elif processor.writer.fingerprints:
+            matches[term] = find_stale_note_ids(
+                mw.col, processor.engine, processor.writer.fingerprints
+            )
+
+    # Anki runs the rest of the search, and sorts it, as usual
+    ctx.search = replace_search_terms(ctx.search, matches)
+
+
+def on_browser_did_fetch_columns(columns: Dict[str, BrowserColumns.Column]) -> None:
+    columns[SMART_FIELDS_COLUMN] = BrowserColumns.Column(
+        key=SMART_FIELDS_COLUMN,
+        cards_mode_label="Smart Fields",
+        notes_mode_label="Smart Fields",
+        sorting_cards=BrowserColumns.SORTING_NONE,
+        sorting_notes=BrowserColumns.SORTING_NONE,
+        uses_cell_font=False,
+        alignment=BrowserColumns.ALIGNMENT_CENTER,
+        cards_mode_tooltip="Smart fields that are missing, or stale since their inputs or prompt changed",
+        notes_mode_tooltip="Smart fields that are missing, or stale since their inputs or prompt changed",
+    )
+
+
+@with_processor  # type: ignore
+def on_browser_did_fetch_row(
+    processor: Processor,
+    item_id: int,
+    is_note: bool,
+    row: CellRow,
+    active_columns: List[str],
+) -> None:
+    if SMART_FIELDS_COLUMN not in active_columns or not mw:
+        return
+
+    try:
+        note = (
+            mw.col.get_note(NoteId(item_id))
+            if is_note
+            else mw.col.get_card(CardId(item_id)).note()
+        )
+        text = get_status_text(processor.engine, processor.writer.fingerprints, note)
+    except Exception as e:
+        report_exception(e)
+        text = ""
+    row.cells[active_columns.index(SMART_FIELDS_COLUMN)].text = text
+
+
 @with_sentry
-def setup_hooks(processor: Processor):
+def setup_hooks(processor: Processor, background: BackgroundGenerator):
     gui_hooks.browser_will_show_context_menu.append(on_browser_context(processor))
     gui_hooks.editor_did_init_buttons.append(add_editor_top_button(processor))
     gui_hooks.editor_will_show_context_menu.append(on_editor_context(processor))
     gui_hooks.reviewer_did_show_question.append(on_review(processor))
+    gui_hooks.editor_did_unfocus_field.append(on_editor_unfocus_field(processor))
     gui_hooks.main_window_did_init.append(on_main_window(processor))
     gui_hooks.profile_will_close.append(cleanup)
+    # The writer resolves conflicts with notes open in an editor, so it needs to know about them
+    gui_hooks.editor_did_load_note.append(processor.writer.on_editor_did_load_note)
+    gui_hooks.profile_did_open.append(processor.writer.on_profile_did_open)
+    gui_hooks.profile_will_close.append(processor.writer.on_profile_will_close)
+    gui_hooks.profile_did_open.append(processor.on_profile_did_open)
+    gui_hooks.profile_will_close.append(processor.on_profile_will_close)
+    gui_hooks.browser_will_search.append(on_browser_will_search(processor))
+    gui_hooks.browser_did_fetch_columns.append(on_browser_did_fetch_columns)
+    gui_hooks.browser_did_fetch_row.append(on_browser_did_fetch_row(processor))
+    setup_background_hooks(background)
@@ -19,15 +19,19 @@
 
 from .config import Config
 
-from .open_ai_client import OpenAIClient
+from .core.open_ai_client import OpenAIClient
 from .processor import Processor
+from .background import BackgroundGenerator
 from .hooks import setup_hooks
 
 # TODO: sort imports...
 
 
 config = Config()
-client = OpenAIClient(config)
-processor = Processor(client, config)
+# Refreshed at the start of each operation
+engine_config = config.snapshot()
+client = OpenAIClient(engine_config)
+processor = Processor(client, config, engine_config)
+background = BackgroundGenerator(processor)
 
-setup_hooks(processor)
+setup_hooks(processor, background)
@@ -17,29 +17,64 @@
  along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-import aiohttp
+"""Qt adapter around the core engine: runs it off the main thread and reports back to the UI."""
+
 from aqt import editor
-from typing import Sequence, Callable, Union, List, Tuple, Any
+from typing import Sequence, Callable, Dict, Set, Union, List, Tuple, Any
 
 from anki.notes import Note, NoteId
 from aqt import editor, mw
 from aqt.operations import QueryOp
 
 from .ui.ui_utils import show_message_box
-from .prompts import interpolate_prompt
 from .utils import bump_usage_counter, check_for_api_key
-from .open_ai_client import OpenAIClient
+from .core.budget import BudgetExceededError, BudgetTracker
+from .core.circuit_breaker import CircuitOpenError
+from .core.config import FieldOptions, Lane, StaticConfig
+from .core.engine import Engine
+from .core.field_status import get_fingerprints_path
+from .core.jobs import FieldJob
+from .core.note_records import NoteRecord, read_note_records
+from .core.open_ai_client import OpenAIClient
+from .core.prompts import get_missing_required_fields, get_smart_fields_search
+from .core.scheduler import Scheduler
 from .config import Config
-from .sentry import sentry
+from .sentry import get_sentry, report_exception, reporting_batch
+from .writer import NoteWriter
 
 import asyncio
 
+# Notes loaded and generated at a time in a batch
+NOTE_WINDOW_SIZE = 500
+# Wait this long after a source field changes before speculating, in case it changes again
+SPECULATION_DEBOUNCE_MS = 600
+
 
 class Processor:
-    def __init__(self, client: OpenAIClient, config: Config):
+    def __init__(self, client: OpenAIClient, config: Config, engine_config: StaticConfig):
         self.client = client
         self.config = config
+        # What the engine, client and budget read: a snapshot of config, shared by all three
+        self.engine_config = engine_config
+        self.budget = BudgetTracker(engine_config)
+        self.engine = Engine(
+            client, engine_config, scheduler=Scheduler(budget=self.budget)
+        )
+        self.writer = NoteWriter(self.engine)
         self.req_in_progress = False
+        self._speculation_counts: Dict[Tuple[int, str], int] = {}
+
+    def on_profile_did_open(self) -> None:
+        # Alongside the fingerprints, so the headless runner spends from the same daily budget
+        if mw and mw.col:
+            self.budget.open(get_fingerprints_path(mw.col.path))
+
+    def on_profile_will_close(self) -> None:
+        self.budget.close()
+
+    def refresh_config(self) -> None:
+        """Re-reads config for the engine. Once per operation, so edits apply from the next one."""
+        self.engine_config.refresh_from(self.config.snapshot())
 
     def ensure_no_req_in_progress(self) -> bool:
         if self.req_in_progress:
@@ -59,24 +94,24 @@ class Processor:
     ) -> None:
 
         bump_usage_counter()
+        self.refresh_config()
 
-        if not self.ensure_no_req_in_progress():
+        prompt = (self.engine.get_field_prompts(note) or {}).get(target_field_name)
+        missing = get_missing_required_fields(prompt, note) if prompt else []  # type: ignore[arg-type]
+        if missing:
+            show_message_box(
+                f"Fill in {missing[0]} first: {target_field_name}'s prompt needs it. Write it as {{{{{missing[0]}?}}}} to allow it to be empty."
+            )
             return
 
-        async def async_process_single_field(
-            note: Note, target_field_name: str
-        ) -> None:
-            print("IN PROCESS SINGLE FIELD")
-            prompt = self.config.get_prompt(note.note_type()["name"], target_field_name)  # type: ignore[index]
-            prompt = interpolate_prompt(prompt, note)
-            response = await self.client.async_get_chat_response(prompt)
-            note[target_field_name] = response
+        if not self.ensure_no_req_in_progress():
+            return
 
-        def on_success() -> None:
+        def on_success(changed: List[str]) -> None:
             # Only update note if it's already in the database
             self._reqlinquish_req_in_progress()
-            if note.id and mw:
-                mw.col.update_note(note)
+            if changed and note.id:
+                self.writer.write(note, changed)
             editor.loadNote()
 
         def on_failure(e: Exception) -> None:
@@ -84,17 +119,48 @@ class Processor:
             self._reqlinquish_req_in_progress()
 
         run_async_in_background(
-            lambda: async_process_single_field(note, target_field_name),
-            lambda _: on_success(),
+            lambda: self.engine.process_field(note, target_field_name),
+            on_success,
             on_failure,
         )
 
     def process_notes_with_progress(
         self,
         note_ids: Sequence[NoteId],
-        on_success: Union[Callable[[List[Note], List[Note]], None], None],
+        on_success: Union[Callable[[int, int, int], None], None],
+    ) -> None:
+        """Processes notes in the background with a progress bar, batching into a single undo op.
+        on_success gets the number of notes updated, failed, and left unwritten because nothing changed."""
+        self._process_in_windows(lambda: note_ids, on_success)
+
+    def process_search_with_progress(
+        self, query: str, on_success: Union[Callable[[int, int, int], None], None]
     ) -> None:
-        """Processes notes in the background with a progress bar, batching into a single undo op"""
+        """Like process_notes_with_progress, for every note matching an Anki search that has smart fields.
+        The search runs in the background too."""
+
+        self.refresh_config()
+        search = get_smart_fields_search(query, self.engine_config.prompts_map)
+        if not search:
+            show_message_box(
+                "No smart fields configured. Add one in Tools > Smart Notes first."
+            )
+            return
+
+        def get_note_ids() -> Sequence[NoteId]:
+            if not mw:
+                return []
+            return mw.col.find_notes(search)
+
+        self._process_in_windows(get_note_ids, on_success)
+
+    def _process_in_windows(
+        self,
+        get_note_ids: Callable[[], Sequence[NoteId]],
+        on_success: Union[Callable[[int, int, int], None], None],
+    ) -> None:
+        """Reads, generates and writes notes a window at a time, so memory stays flat however many notes there are.
+        Notes are read in bulk as NoteRecords; full notes are only loaded to write the ones that changed."""
 
         bump_usage_counter()
 
@@ -102,6 +168,7 @@ class Processor:
             return
 
         print("Processing notes...")
+        self.refresh_config()
 
         if not check_for_api_key(self.config):
             return
@@ -109,70 +176,147 @@ class Processor:
         if not mw:
             return
 
-        async def wrapped_process_notes() -> Tuple[List[Note], List[Note]]:
-            notes = [mw.col.get_note(note_id) for note_id in note_ids]
-
-            # Sanity check that we actually have prompts for these note types
-            has_prompts = True
-            for note in notes:
-                note_type = note.note_type()
-                if not note_type:
-                    # Should never happen
-                    raise Exception("Error: no note type")
-
-                note_type_name = note_type["name"]
-                if note_type_name not in self.config.prompts_map.get("note_types", {}):
-                    print("Error: no prompts found for note type")
-                    has_prompts = False
-            if not has_prompts:
-                raise Exception("Not all selected note types have smart fields.")
-
-            # Run them all in parallel
-            tasks = []
-            for note in notes:
-                tasks.append(self._process_note(note))
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-
-            # Process errors
-            notes_to_update = []
-            failed = []
-            for i, result in enumerate(results):
-                if isinstance(result, Exception):
-                    print(f"Error processing note {note_ids[i]}: {result}")
-                    failed.append(notes[i])
-                else:
-                    notes_to_update.append(notes[i])
-
-            return (notes_to_update, failed)
-
-        def wrapped_on_success(res: Tuple[List[Note], List[Note]]) -> None:
-            updated, failed = res
-            mw.col.update_notes(updated)
+        def update_progress(done: int, total: int) -> None:
+            mw.progress.update(
+                label=f"Generating smart fields: {done}/{total} notes",
+                value=done,
+                max=total,
+            )
+
+        async def wrapped_process_notes() -> Tuple[int, int, int]:
+            note_ids = get_note_ids()
+            total = len(note_ids)
+            updated = 0
+            failed = 0
+            # Notes regenerated with exactly what they had, so not written. Counted here rather
+            # than from the shared metric, which background generation adds to as well
+            unchanged = 0
+            self.budget.start_run()
+
+            # A batch hitting a rate limit fails the same way thousands of times; report it once
+            with reporting_batch():
+                for i in range(0, total, NOTE_WINDOW_SIZE):
+                    # Out of budget: leave the rest for later rather than failing every one
+                    if self.budget.get_exceeded():
+                        self.budget.ledger.pause(note_ids[i:])
+                        break
+                    # The API key or quota is bad: the rest would fail one at a time
+                    if self.client.circuit_breaker.is_open():
+                        failed += total - i
+                        break
+
+                    window = note_ids[i : i + NOTE_WINDOW_SIZE]
+                    records = read_note_records(
+                        mw.col, window, self.engine_config.prompts_map
+                    )
+                    paused: Set[NoteId] = set()
+                    generated: Set[NoteId] = set()
+                    same: Set[NoteId] = set()
+
+                    def on_error(note: NoteRecord, e: BaseException) -> None:
+                        if isinstance(e, BudgetExceededError):
+                            paused.add(note.id)
+                        else:
+                            report_exception(e)
+
+                    def on_field_done(note: NoteRecord, job: FieldJob) -> None:
+                        if job.status == "generated":
+                            generated.add(note.id)
+                        elif job.status == "unchanged":
+                            same.add(note.id)
+
+                    notes_to_update, failed_notes = await self.engine.process_notes(
+                        records, on_error=on_error, on_field_done=on_field_done
+                    )
+                    updated += len(notes_to_update)
+                    unchanged += len(same - generated)
+                    failed += len([note for note in failed_notes if note.id not in paused])
+                    self.budget.ledger.unpause(
+                        [note_id for note_id in window if note_id not in paused]
+                    )
+                    self.budget.ledger.pause(list(paused))
+
+                    done = i + len(window)
+                    if notes_to_update:
+                        mw.taskman.run_on_main(
+                            lambda notes=notes_to_update: self.writer.write_all(notes)  # type: ignore[misc]
+                        )
+                    mw.taskman.run_on_main(
+                        lambda done=done: update_progress(done, total)  # type: ignore[misc]
+                    )
+
+            self.budget.end_run()
+            return (updated, failed, unchanged)
+
+        def wrapped_on_success(res: Tuple[int, int, int]) -> None:
+            updated, failed, unchanged = res
+            self.writer.end_batch()
+            self._save_concurrency_limits()
             self._reqlinquish_req_in_progress()
             if on_success:
-                on_success(updated, failed)
+                on_success(updated, failed, unchanged)
 
         def on_failure(e: Exception) -> None:
+            # The run went with the task that failed
+            self.writer.end_batch()
             self._reqlinquish_req_in_progress()
             show_message_box(f"Error: {e}")
 
+        # Every window's writes merge into one undo step
+        self.writer.start_batch()
         run_async_in_background(
             wrapped_process_notes, wrapped_on_success, on_failure, with_progress=True
         )
 
+    def speculate(self, note: Note, source_field: str) -> None:
+        """After source_field changes, generates the smart fields that depend on it in the background,
+        so ✨ or Add finds them ready. Debounced; never touches the note."""
+        if not mw or not self.engine.get_dependent_fields(note, source_field):
+            return
+
+        slot = (id(note), source_field)
+        count = self._speculation_counts.get(slot, 0) + 1
+        self._speculation_counts[slot] = count
+
+        def run() -> None:
+            # Changed again since; that change will speculate instead
+            if self._speculation_counts.get(slot) != count:
+                return
+            del self._speculation_counts[slot]
+            self.refresh_config()
+            run_async_in_background(
+                lambda: self.engine.speculate(note, source_field),
+                lambda _: None,
+                lambda e: print(f"Speculative generation failed: {e}"),
+                report_errors=False,
+            )
+
+        mw.progress.single_shot(SPECULATION_DEBOUNCE_MS, run, False)
+
+    def _save_concurrency_limits(self) -> None:
+        """Remembers the batch concurrency each model settled on, so the next session starts there."""
+        learned = self.engine.scheduler.learned_limits()
+        if learned:
+            self.config.concurrency_limits = {
+                **(self.config.concurrency_limits or {}),
+                **learned,
+            }
+
     # TODO: do I even need this method or can I just use the batch one?
     def process_note(
         self,
         note: Note,
         overwrite_fields: bool = False,
-        on_success: Callable[[bool], None] = lambda _: None,
+        on_success: Callable[[List[str]], None] = lambda _: None,
         on_failure: Union[Callable[[Exception], None], None] = None,
+        lane: Lane = "review",
     ):
-        """Process a single note, filling in fields with prompts from the user"""
+        """Process a single note, filling in fields with prompts from the user. on_success gets the fields that changed."""
         if not self.ensure_no_req_in_progress():
             return
+        self.refresh_config()
 
-        def wrapped_on_success(updated: bool) -> None:
+        def wrapped_on_success(updated: List[str]) -> None:
             self._reqlinquish_req_in_progress()
             on_success(updated)
 
@@ -185,63 +329,33 @@ class Processor:
         # NOTE: for some reason i can't run bump_usage_counter in this hook without causing a
         # an PyQT crash, so I'm running it in the on_success callback instead
         run_async_in_background(
-            lambda: self._process_note(note, overwrite_fields=overwrite_fields),
+            lambda: self.engine.process_note(
+                note, overwrite_fields=overwrite_fields, lane=lane
+            ),
             wrapped_on_success,
             wrapped_failure,
         )
 
-    async def _process_note(self, note: Note, overwrite_fields=False) -> bool:
-        """Process a single note, returns whether any fields were updated. Caller responsible for handling any exceptions."""
-        print(f"Processing note")
-        note_type = note.note_type()
-
-        if not note_type:
-            print("Error: no note type")
-            return False
-
-        note_type_name = note_type["name"]
-        field_prompts = self.config.prompts_map.get("note_types", {}).get(
-            note_type_name, None
-        )
-
-        if not field_prompts:
-            print("Error: no prompts found for note type")
-            return False
-
-        tasks = []
-
-        field_prompt_items = list(field_prompts["fields"].items())
-        for field, prompt in field_prompt_items:
-            # Don't overwrite fields that already exist
-            if (not overwrite_fields) and note[field]:
-                print(f"Skipping field: {field}")
-                continue
-
-            print(f"Processing field: {field}, prompt: {prompt}")
-
-            prompt = interpolate_prompt(prompt, note)
-
-            task = self.client.async_get_chat_response(prompt)
-            tasks.append(task)
-
-        # Maybe filled out already, if so return early
-        if not tasks:
-            return False
-
-        responses = await asyncio.gather(*tasks)
-        print("Responses: ", responses)
-        for i, response in enumerate(responses):
-            target_field = field_prompt_items[i][0]
-            note[target_field] = response
+    def _handle_failure(self, e: Exception) -> None:
+        import aiohttp
 
-        return True
+        # Explain what tripped the circuit rather than the circuit itself
+        if isinstance(e, CircuitOpenError) and isinstance(e.cause, Exception):
+            e = e.cause
 
-    def _handle_failure(self, e: Exception) -> None:
-        if isinstance(e, aiohttp.ClientResponseError):
+        if isinstance(e, asyncio.TimeoutError):
+            show_message_box(
+                "Smart Notes Error: OpenAI took too long to respond. Please try again."
+            )
+        elif isinstance(e, aiohttp.ClientResponseError):
             if e.status == 401:
                 show_message_box(
                     "Smart Notes Error: OpenAI returned 401, meaning there's an issue with your API key."
                 )
+            elif e.status == 429 and e.message == "insufficient_quota":
+                show_message_box(
+                    "Smart Notes error: your OpenAI quota is exhausted. Check your plan and billing details on OpenAI's website."
+                )
             elif e.status == 429:
                 show_message_box(
                     "Smart Notes error: OpenAI rate limit exceeded. Ensure you have a paid API key (this plugin will not work with free API tier). Wait a few minutes and try again."
@@ -254,10 +368,13 @@ class Processor:
         prompt: str,
         on_success: Callable[[str], None],
         on_failure: Union[Callable[[Exception], None], None] = None,
+        options: Union[FieldOptions, None] = None,
+        system_prompt: Union[str, None] = None,
     ):
 
         if not self.ensure_no_req_in_progress():
             return
+        self.refresh_config()
 
         def wrapped_on_success(response: str) -> None:
             self._reqlinquish_req_in_progress()
@@ -270,7 +387,9 @@ class Processor:
                 on_failure(e)
 
         run_async_in_background(
-            lambda: self.client.async_get_chat_response(prompt),
+            lambda: self.engine.get_response(
+                prompt, "editor", options=options, system_prompt=system_prompt
+            ),
             wrapped_on_success,
             wrapped_on_failure,
         )
@@ -281,14 +400,17 @@ def run_async_in_background(
     on_success: Callable[[Any], None],
     on_failure: Union[Callable[[Exception], None], None] = None,
     with_progress: bool = False,
+    report_errors: bool = True,
 ):
-    "Runs an async operation in the background and calls on_success when done."
+    """Runs an async operation in the background and calls on_success when done.
+    With report_errors off, errors go to on_failure only: no Sentry event and no error dialog."""
 
     if not mw:
         raise Exception("Error: mw not found in run_async_in_background")
 
     # Wrap for sentry error reporting
-    if sentry:
+    sentry = get_sentry()
+    if sentry and report_errors:
         op = sentry.wrap_async(op)
         on_success = sentry.wrap(on_success)
         if on_failure:
@@ -18,19 +18,19 @@
 """
 
 import os
+import queue
+import threading
+import time
+import traceback
+from contextlib import contextmanager
 from aqt import mw
-import sentry_sdk
-from sentry_sdk.session import Session
 import random
-from typing import Union, Callable, Any, Coroutine
+from typing import Union, Callable, Any, Coroutine, Dict, Iterator, List, Tuple
 
-from .ui.ui_utils import show_message_box
-
-from .ui.changelog import get_version
 from .. import env
 from .config import config
 
-dsn = os.getenv("SENTRY_DSN")
+# sentry_sdk and dotenv are imported on first use; Anki's startup shouldn't pay for them.
 
 
 def make_uuid() -> str:
@@ -41,6 +41,133 @@ def make_uuid() -> str:
     return "".join(uuid)
 
 
+# Identical errors outside a batch are only sent once per window
+DEDUPE_WINDOW_SECONDS = 60
+MAX_EVENTS_PER_MINUTE = 10
+SHUTDOWN_FLUSH_TIMEOUT_SECONDS = 2.0
+
+
+def get_fingerprint(e: BaseException) -> str:
+    """Errors with the same type, message and raising line are considered the same error."""
+    frames = traceback.extract_tb(e.__traceback__)
+    location = f"{frames[-1].filename}:{frames[-1].lineno}" if frames else ""
+    return f"{type(e).__name__}|{e}|{location}"
+
+
+class ErrorReporter:
+    """Sends Sentry events from a background thread so reporting never blocks the caller.
+
+    Events are sampled and rate limited. While a batch is running, identical errors are
+    grouped and sent once, with a count, when the batch ends."""
+
+    def __init__(
+        self, hub: Any, sample_rate: float, max_events_per_minute: int
+    ) -> None:
+        self.hub = hub
+        self.sample_rate = sample_rate
+        self.max_events_per_minute = max_events_per_minute
+        self.dropped = 0
+
+        self._queue: "queue.Queue[Union[Tuple[BaseException, int], threading.Event]]" = (
+            queue.Queue()
+        )
+        self._lock = threading.Lock()
+        self._batch_depth = 0
+        self._batch_groups: Dict[str, List[Any]] = {}
+        self._last_sent: Dict[str, float] = {}
+        self._sent_times: List[float] = []
+        self._thread: Union[threading.Thread, None] = None
+
+    def report(self, e: BaseException) -> None:
+        """Queues an exception for reporting. Safe to call from any thread; never blocks."""
+        if random.random() >= self.sample_rate:
+            return
+
+        fingerprint = get_fingerprint(e)
+        with self._lock:
+            if self._batch_depth:
+                group = self._batch_groups.setdefault(fingerprint, [e, 0])
+                group[1] += 1
+                return
+
+            now = time.monotonic()
+            if now - self._last_sent.get(fingerprint, -DEDUPE_WINDOW_SECONDS) < DEDUPE_WINDOW_SECONDS:
+                self.dropped += 1
+                return
+            self._last_sent[fingerprint] = now
+
+        self._enqueue(e, 1)
+
+    def start_batch(self) -> None:
+        with self._lock:
+            self._batch_depth += 1
+
+    def end_batch(self) -> None:
+        with self._lock:
+            self._batch_depth -= 1
+            if self._batch_depth:
+                return
+            groups = list(self._batch_groups.values())
+            self._batch_groups = {}
+
+        for e, count in groups:
+            self._enqueue(e, count)
+
+    def flush(self, timeout: float) -> bool:
+        """Waits up to timeout for queued events to be handed to Sentry. Only for shutdown."""
+        if not self._thread:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def _enqueue(self, e: BaseException, count: int) -> None:
+        if not self._thread:
+            self._thread = threading.Thread(
+                target=self._run, name="smart-notes-sentry", daemon=True
+            )
+            self._thread.start()
+        self._queue.put((e, count))
+
+    def _is_rate_limited(self) -> bool:
+        now = time.monotonic()
+        self._sent_times = [t for t in self._sent_times if now - t < 60]
+        if len(self._sent_times) >= self.max_events_per_minute:
+            return True
+        self._sent_times.append(now)
+        return False
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if isinstance(item, threading.Event):
+                client, _ = self.hub._stack[-1]
+                if client:
+                    client.flush()
+                item.set()
+                continue
+
+            e, count = item
+            if self._is_rate_limited():
+                self.dropped += count
+                continue
+
+            try:
+                self._send(e, count)
+            except Exception as send_error:
+                print(f"Sentry: failed to send event: {send_error}")
+
+    def _send(self, e: BaseException, count: int) -> None:
+        with self.hub.push_scope() as scope:
+            scope.fingerprint = [get_fingerprint(e)]
+            scope.set_extra("occurrences", count)
+            self.hub.capture_exception(e)
+
+        _, scope = self.hub._stack[-1]
+        if scope._session:
+            scope._session.update(status="crashed")
+
+
 # Based on
 # https://github.com/wandb/wandb/blob/2ff422b6e5f594c1e15ee03b60baba2e8a163f80/wandb/analytics/sentry.py
 class Sentry:
@@ -48,7 +175,17 @@ class Sentry:
 
     uuid: str
 
-    def __init__(self, dsn: str, release: str, uuid: str, env: str) -> None:
+    def __init__(
+        self,
+        dsn: str,
+        release: str,
+        uuid: str,
+        env: str,
+        sample_rate: float = 1.0,
+        max_events_per_minute: int = MAX_EVENTS_PER_MINUTE,
+    ) -> None:
+        import sentry_sdk
+
         print("Initializing sentry...")
         print(f"DSN: {dsn}, release: {release}, uuid: {uuid}, env: {env}")
         client = sentry_sdk.Client(
@@ -60,33 +197,27 @@ class Sentry:
         hub = sentry_sdk.Hub(client)
         self.hub = hub
         self.uuid = uuid
+        self.reporter = ErrorReporter(hub, sample_rate, max_events_per_minute)
         print("Sentry initialized...")
 
     def configure_scope(self) -> None:
         with self.hub.configure_scope() as scope:
             scope.user = {"id": self.uuid}
 
-        client, _ = self.hub._stack[-1]
+        # The client's transport sends the session in the background; no need to flush
         self._start_session()
-        if client:
-            client.flush()
 
     def end_session(self) -> None:
+        """Ends the session and gives queued events a bounded amount of time to send."""
         print("Sentry: ending session")
-        client, scope = self.hub._stack[-1]
-        session = scope._session
+        _, scope = self.hub._stack[-1]
 
-        if session is not None and client is not None:
+        if scope._session is not None:
             self.hub.end_session()
-            client.flush()
+        self.reporter.flush(SHUTDOWN_FLUSH_TIMEOUT_SECONDS)
 
     def capture_exception(self, e: Exception) -> None:
-        client, scope = self.hub._stack[-1]
-        if scope and client:
-            scope.capture_exception(e)
-            if scope._session:
-                scope._session.update(status="crashed")
-                client.flush()
+        self.reporter.report(e)
 
     def wrap_async(
         self, fn: Callable[..., Any]
@@ -112,7 +243,7 @@ class Sentry:
 
         return wrapped
 
-    def _get_session(self) -> Union[Session, None]:
+    def _get_session(self) -> Any:
         _, scope = self.hub._stack[-1]
         return scope._session
 
@@ -122,6 +253,8 @@ class Sentry:
             self.hub.start_session()
 
     def _show_error_message(self, e: Exception) -> None:
+        from .ui.ui_utils import show_message_box
+
         if not mw:
             return
         # Show the error message on the main thread
@@ -130,21 +263,77 @@ class Sentry:
         )
 
 
-def init_sentry() -> Union[Sentry, None]:
+def init_sentry(
+    release: Union[str, None], uuid: str, sample_rate: float
+) -> Union[Sentry, None]:
+    """Creates the Sentry client and starts a session. Imports sentry_sdk, so keep it off the main thread."""
+    global sentry
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
     dsn = os.getenv("SENTRY_DSN")
-    release = get_version()
     if not dsn or not release:
         print("Sentry: no sentry DSN or release")
         return None
 
+    new_sentry = Sentry(dsn, release, uuid, env.environment, sample_rate=sample_rate)
+    new_sentry.configure_scope()
+    sentry = new_sentry
+
+    return sentry
+
+
+def init_sentry_in_background() -> None:
+    """Initializes Sentry on a background thread. Errors before it's ready just aren't reported."""
+    from .ui.changelog import get_version
+
+    if not mw:
+        return
+
+    # Touch config on the main thread; writes go through the addon manager
+    release = get_version()
     if not config.uuid:
         config.uuid = make_uuid()
+    uuid = config.uuid
+    sample_rate = config.sentry_sample_rate
+    if sample_rate is None:
+        sample_rate = 1.0
+
+    def init() -> None:
+        try:
+            init_sentry(release, uuid, sample_rate)
+        except Exception as e:
+            print(f"Sentry: failed to initialize: {e}")
+
+    mw.taskman.run_in_background(init)
 
-    sentry = Sentry(dsn, release, config.uuid, env.environment)
 
+def get_sentry() -> Union[Sentry, None]:
+    """Sentry starts after the main window is up, so look it up at call time rather than importing it."""
     return sentry
 
 
+def report_exception(e: BaseException) -> None:
+    """Reports an exception without surfacing it to the user. Never blocks."""
+    if sentry:
+        sentry.reporter.report(e)
+
+
+@contextmanager
+def reporting_batch() -> Iterator[None]:
+    """Groups identical errors reported inside the block into one event each, with a count."""
+    reporter = sentry.reporter if sentry else None
+    if reporter:
+        reporter.start_batch()
+    try:
+        yield
+    finally:
+        if reporter:
+            reporter.end_batch()
+
+
 def with_sentry(fn: Callable[..., Any]) -> Callable[..., Any]:
     def wrapper(*args, **kwargs):
         if not sentry:
@@ -154,4 +343,4 @@ def with_sentry(fn: Callable[..., Any]) -> Callable[..., Any]:
     return wrapper
 
 
-sentry = init_sentry()
+sentry: Union[Sentry, None] = None
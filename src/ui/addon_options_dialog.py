@@ -39,7 +39,9 @@ from PyQt6.QtCore import Qt
 
 from ..processor import Processor
 
-from ..config import Config, OpenAIModels, PromptMap
+from ..config import Config
+from ..core.config import OpenAIModels, PromptMap
+from ..core.open_ai_client import get_hedging_report
 from .prompt_dialog import PromptDialog
 from .ui_utils import show_message_box
 
@@ -57,6 +59,10 @@ class AddonOptionsDialog(QDialog):
     restore_defaults: QPushButton
     edit_button: QPushButton
     generate_at_review: bool
+    generate_on_add: bool
+    speculative_generation: bool
+    hedge_interactive_requests: bool
+    backfill_enabled: bool
 
     def __init__(self, config: Config, processor: Processor):
         super().__init__()
@@ -64,6 +70,10 @@ class AddonOptionsDialog(QDialog):
         self.prompts_map = config.prompts_map
         self.openai_model = config.openai_model
         self.generate_at_review = config.generate_at_review
+        self.generate_on_add = config.generate_on_add
+        self.speculative_generation = config.speculative_generation
+        self.hedge_interactive_requests = config.hedge_interactive_requests
+        self.backfill_enabled = config.backfill_enabled
         self.config = config
         self.selected_row = None
 
@@ -189,6 +199,64 @@ class AddonOptionsDialog(QDialog):
             "Auto-generate fields at review time:", self.generate_at_review_button
         )
 
+        self.generate_on_add_button = QCheckBox()
+
+        def set_generate_on_add(checked: int):
+            self.generate_on_add = checked == 2
+
+        self.generate_on_add_button.stateChanged.connect(set_generate_on_add)
+        tab2_layout.addRow(
+            "Auto-generate fields for new and imported notes:",
+            self.generate_on_add_button,
+        )
+
+        self.speculative_generation_button = QCheckBox()
+
+        def set_speculative_generation(checked: int):
+            self.speculative_generation = checked == 2
+
+        self.speculative_generation_button.stateChanged.connect(
+            set_speculative_generation
+        )
+        tab2_layout.addRow(
+            "Start generating in the editor as soon as a field is filled in:",
+            self.speculative_generation_button,
+        )
+
+        self.hedge_button = QCheckBox()
+
+        def set_hedge_interactive_requests(checked: int):
+            self.hedge_interactive_requests = checked == 2
+
+        self.hedge_button.stateChanged.connect(set_hedge_interactive_requests)
+        tab2_layout.addRow(
+            "Retry slow editor and review requests early:", self.hedge_button
+        )
+        hedge_explanation = QLabel(
+            "Sends a duplicate request when a response is taking unusually long, and uses whichever finishes first. Faster in the worst case, at the cost of a few extra requests."
+        )
+        hedge_explanation.setWordWrap(True)
+        hedge_explanation.setFont(font)
+        tab2_layout.addRow(hedge_explanation)
+        tab2_layout.addRow(QLabel(self.get_hedging_stats()))
+        tab2_layout.addRow("", QLabel(""))
+
+        self.backfill_button = QCheckBox()
+
+        def set_backfill_enabled(checked: int):
+            self.backfill_enabled = checked == 2
+
+        self.backfill_button.stateChanged.connect(set_backfill_enabled)
+        tab2_layout.addRow(
+            "Fill in missing smart fields while Anki is idle:", self.backfill_button
+        )
+        backfill_explanation = QLabel(
+            f"Slowly generates empty smart fields in the background ({self.config.backfill_notes_per_minute:g} notes a minute), cards due soonest first, so they're ready before you review them. Pauses while you review or edit."
+        )
+        backfill_explanation.setWordWrap(True)
+        backfill_explanation.setFont(font)
+        tab2_layout.addRow(backfill_explanation)
+
         tab2.setLayout(tab2_layout)
         tabs.addTab(tab2, "Advanced")
 
@@ -208,8 +276,21 @@ class AddonOptionsDialog(QDialog):
         self.api_key_edit.setText(self.config.openai_api_key)
         self.models_combo_box.setCurrentText(self.openai_model)
         self.generate_at_review_button.setChecked(self.generate_at_review)
+        self.generate_on_add_button.setChecked(self.generate_on_add)
+        self.speculative_generation_button.setChecked(self.speculative_generation)
+        self.hedge_button.setChecked(self.hedge_interactive_requests)
+        self.backfill_button.setChecked(self.backfill_enabled)
         self.update_table()
 
+    def get_hedging_stats(self) -> str:
+        report = get_hedging_report()
+        if not report["interactive_requests"]:
+            return ""
+
+        p99 = report["p99_seconds"] or 0
+        improvement = report["p99_improvement_seconds"] or 0
+        return f"This session: p99 {p99:.1f}s ({improvement:.1f}s faster), {report['hedges_fired']:.0f} extra requests ({report['hedge_rate']:.0%})."
+
     def create_table(self) -> QTableWidget:
         table = QTableWidget(0, 3)
         table.setHorizontalHeaderLabels(["Note Type", "Target Field", "Prompt"])
@@ -301,6 +382,7 @@ class AddonOptionsDialog(QDialog):
         field = self.table.item(self.selected_row, 1).text()
         print(f"Removing {card_type}, {field}")
         self.prompts_map["note_types"][card_type]["fields"].pop(field)
+        self.prompts_map["note_types"][card_type].get("options", {}).pop(field, None)
         self.update_table()
 
     def on_accept(self) -> None:
@@ -308,6 +390,10 @@ class AddonOptionsDialog(QDialog):
         self.config.prompts_map = self.prompts_map
         self.config.openai_model = self.openai_model
         self.config.generate_at_review = self.generate_at_review
+        self.config.generate_on_add = self.generate_on_add
+        self.config.speculative_generation = self.speculative_generation
+        self.config.hedge_interactive_requests = self.hedge_interactive_requests
+        self.config.backfill_enabled = self.backfill_enabled
         self.accept()
 
     def on_reject(self) -> None:
@@ -322,4 +408,8 @@ class AddonOptionsDialog(QDialog):
         self.prompts_map = self.config.prompts_map
         self.openai_model = self.config.openai_model
         self.generate_at_review = self.config.generate_at_review
+        self.generate_on_add = self.config.generate_on_add
+        self.speculative_generation = self.config.speculative_generation
+        self.hedge_interactive_requests = self.config.hedge_interactive_requests
+        self.backfill_enabled = self.config.backfill_enabled
         self.update_ui()
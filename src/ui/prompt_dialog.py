@@ -17,35 +17,55 @@
  along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from typing import Callable, List, Union
+from typing import Callable, List, Union, get_args
 from ..processor import Processor
 
 from aqt import (
+    QCheckBox,
     QComboBox,
     QDialog,
     QDialogButtonBox,
+    QDoubleSpinBox,
+    QFormLayout,
     QLabel,
+    QLineEdit,
     QPushButton,
     QSizePolicy,
+    QSpinBox,
     QTextEdit,
     QTextOption,
     QVBoxLayout,
     Qt,
     mw,
 )
-from ..config import PromptMap
-from ..prompts import get_prompt_fields_lower, interpolate_prompt, prompt_has_error
+from ..config import config
+from ..core.config import FieldOptions, OpenAIModels, PromptMap
+from ..prompts import prompt_has_error
+from ..core.prompts import (
+    get_field_options,
+    get_prompt_fields_lower,
+    get_system_prompt,
+    interpolate_prompt,
+    to_lowercase_dict,
+)
 from .ui_utils import show_message_box
-from ..utils import get_fields, to_lowercase_dict
+from ..utils import get_fields
 
 
 explanation = """Write a "prompt" to help ChatGPT generate your target smart field.
 
-You may reference any other field via enclosing it in {{double curly braces}}. Valid fields are listed below for convenience.
+You may reference any other field via enclosing it in {{double curly braces}}. Valid fields are listed below for convenience. The smart field is only generated once those fields are filled in, unless they're marked optional: {{field?}}.
 
 Test out your prompt with the test button before saving it!
 """
 
+options_explanation = "Optional. Capping max tokens or using a faster model makes short fields (e.g. one-word translations) quicker and cheaper. Cleaning up inputs leaves formatting, images and audio out of the prompt; capping input tokens keeps long fields from blowing up the prompt. For fields with one right answer, like translations, batches can reuse the response to nearly identical inputs (1.00 means identical but for case, punctuation and formatting)."
+
+system_prompt_explanation = "Optional. Instructions sent ahead of every smart field on this card type, e.g. who the cards are for. Long ones are cheaper and quicker when they're identical from request to request; putting field values after the prompt helps with that too."
+
+MAX_TOKENS_LIMIT = 4096
+MAX_INPUT_TOKENS_LIMIT = 16000
+
 
 class PromptDialog(QDialog):
     prompt_text_box: QTextEdit
@@ -129,6 +149,7 @@ class PromptDialog(QDialog):
         font = self.valid_fields.font()
         font.setPointSize(10)
         self.valid_fields.setFont(font)
+        options_form = self.setup_options()
         self.update_valid_fields()
         self.update_prompt()
 
@@ -136,6 +157,7 @@ class PromptDialog(QDialog):
         layout.addWidget(prompt_label)
         layout.addWidget(self.prompt_text_box)
         layout.addWidget(self.valid_fields)
+        layout.addLayout(options_form)
         layout.addWidget(self.test_button)
         layout.addWidget(self.standard_buttons)
 
@@ -148,6 +170,123 @@ class PromptDialog(QDialog):
         # causing it to default select the first field in the list
         self.field_combo_box.currentTextChanged.connect(self.on_field_selected)
 
+    def setup_options(self) -> QFormLayout:
+        form = QFormLayout()
+
+        self.model_combo_box = QComboBox()
+        self.model_combo_box.addItem(f"Default ({config.openai_model})", None)
+        for model in get_args(OpenAIModels):
+            self.model_combo_box.addItem(model, model)
+
+        # The minimum value of each spin box means "not set"
+        self.max_tokens_spin_box = QSpinBox()
+        self.max_tokens_spin_box.setRange(0, MAX_TOKENS_LIMIT)
+        self.max_tokens_spin_box.setSpecialValueText("Default")
+
+        self.temperature_spin_box = QDoubleSpinBox()
+        self.temperature_spin_box.setRange(-0.1, 2.0)
+        self.temperature_spin_box.setSingleStep(0.1)
+        self.temperature_spin_box.setDecimals(1)
+        self.temperature_spin_box.setSpecialValueText("Default")
+
+        self.stop_edit = QLineEdit()
+        self.stop_edit.setPlaceholderText("Comma separated, \\n for a newline")
+
+        self.normalize_inputs_check_box = QCheckBox("Strip HTML, images and audio")
+
+        self.max_input_tokens_spin_box = QSpinBox()
+        self.max_input_tokens_spin_box.setRange(0, MAX_INPUT_TOKENS_LIMIT)
+        self.max_input_tokens_spin_box.setSpecialValueText("No limit")
+
+        self.static_prefix_check_box = QCheckBox("Put field values after the prompt")
+
+        self.similarity_spin_box = QDoubleSpinBox()
+        self.similarity_spin_box.setRange(0.49, 1.0)
+        self.similarity_spin_box.setSingleStep(0.05)
+        self.similarity_spin_box.setDecimals(2)
+        self.similarity_spin_box.setSpecialValueText("Off")
+
+        # Unlike the rest, this one is shared by every smart field on the note type
+        self.system_prompt_text_box = QTextEdit()
+        self.system_prompt_text_box.setAcceptRichText(False)
+        self.system_prompt_text_box.setMaximumHeight(80)
+        self.system_prompt_text_box.setPlaceholderText(system_prompt_explanation)
+
+        options_label = QLabel(options_explanation)
+        options_label.setWordWrap(True)
+        font = options_label.font()
+        font.setPointSize(10)
+        options_label.setFont(font)
+
+        form.addRow(options_label)
+        form.addRow("Model:", self.model_combo_box)
+        form.addRow("Max tokens:", self.max_tokens_spin_box)
+        form.addRow("Temperature:", self.temperature_spin_box)
+        form.addRow("Stop sequences:", self.stop_edit)
+        form.addRow("Clean up inputs:", self.normalize_inputs_check_box)
+        form.addRow("Max tokens per input:", self.max_input_tokens_spin_box)
+        form.addRow("Layout:", self.static_prefix_check_box)
+        form.addRow("Reuse responses for inputs this similar:", self.similarity_spin_box)
+        form.addRow("Card type's system prompt:", self.system_prompt_text_box)
+        return form
+
+    def get_options(self) -> FieldOptions:
+        options: FieldOptions = {}
+        model = self.model_combo_box.currentData()
+        if model:
+            options["model"] = model
+        if self.max_tokens_spin_box.value() > 0:
+            options["max_tokens"] = self.max_tokens_spin_box.value()
+        if self.temperature_spin_box.value() >= 0:
+            options["temperature"] = round(self.temperature_spin_box.value(), 1)
+        stop = [
+            seq.replace("\\n", "\n")
+            for seq in self.stop_edit.text().split(",")
+            if seq.strip()
+        ]
+        if stop:
+            # OpenAI allows at most 4
+            options["stop"] = stop[:4]
+        # On is the default, so only store it when it's off
+        if not self.normalize_inputs_check_box.isChecked():
+            options["normalize_inputs"] = False
+        if self.max_input_tokens_spin_box.value() > 0:
+            options["max_input_tokens"] = self.max_input_tokens_spin_box.value()
+        if self.static_prefix_check_box.isChecked():
+            options["prompt_layout"] = "static_prefix"
+        if self.similarity_spin_box.value() >= 0.5:
+            options["similarity_threshold"] = round(self.similarity_spin_box.value(), 2)
+        return options
+
+    def get_system_prompt(self) -> Union[str, None]:
+        return self.system_prompt_text_box.toPlainText().strip() or None
+
+    def update_options(self) -> None:
+        options: FieldOptions = {}
+        if self.selected_card_type and self.selected_field:
+            options = get_field_options(
+                self.prompts_map, self.selected_card_type, self.selected_field
+            )
+
+        index = self.model_combo_box.findData(options.get("model"))
+        self.model_combo_box.setCurrentIndex(max(index, 0))
+        self.max_tokens_spin_box.setValue(options.get("max_tokens", 0))
+        self.temperature_spin_box.setValue(options.get("temperature", -0.1))
+        self.stop_edit.setText(
+            ",".join(seq.replace("\n", "\\n") for seq in options.get("stop", []))
+        )
+        self.normalize_inputs_check_box.setChecked(
+            options.get("normalize_inputs", True)
+        )
+        self.max_input_tokens_spin_box.setValue(options.get("max_input_tokens", 0))
+        self.static_prefix_check_box.setChecked(
+            options.get("prompt_layout") == "static_prefix"
+        )
+        self.similarity_spin_box.setValue(options.get("similarity_threshold", 0.49))
+        self.system_prompt_text_box.setPlainText(
+            get_system_prompt(self.prompts_map, self.selected_card_type or "") or ""
+        )
+
     def get_card_types(self) -> List[str]:
         if not mw:
             return []
@@ -214,6 +353,7 @@ class PromptDialog(QDialog):
             .get(self.selected_field, "")
         )
         self.prompt_text_box.setText(prompt)
+        self.update_options()
 
     def on_text_changed(self):
         self.prompt = self.prompt_text_box.toPlainText()
@@ -238,7 +378,7 @@ class PromptDialog(QDialog):
             return
 
         sample_note = mw.col.get_note(sample_note_ids[0])
-        prompt = interpolate_prompt(self.prompt, sample_note)
+        prompt = interpolate_prompt(self.prompt, sample_note, self.get_options())  # type: ignore[arg-type]
         self.is_loading_prompt = True
         self.update_buttons()
 
@@ -267,7 +407,11 @@ class PromptDialog(QDialog):
             self.update_buttons()
 
         self.processor.get_chat_response(
-            prompt, on_success=on_success, on_failure=on_failure
+            prompt,
+            on_success=on_success,
+            on_failure=on_failure,
+            options=self.get_options(),
+            system_prompt=self.get_system_prompt(),
         )
 
     def update_valid_fields(self) -> None:
@@ -310,9 +454,20 @@ class PromptDialog(QDialog):
             )
             if not self.prompts_map["note_types"].get(self.selected_card_type):
                 self.prompts_map["note_types"][self.selected_card_type] = {"fields": {}}
-            self.prompts_map["note_types"][self.selected_card_type]["fields"][
-                self.selected_field
-            ] = self.prompt
+            note_type_map = self.prompts_map["note_types"][self.selected_card_type]
+            note_type_map["fields"][self.selected_field] = self.prompt
+
+            options = self.get_options()
+            if options:
+                note_type_map.setdefault("options", {})[self.selected_field] = options
+            else:
+                note_type_map.get("options", {}).pop(self.selected_field, None)
+
+            system_prompt = self.get_system_prompt()
+            if system_prompt:
+                note_type_map["system_prompt"] = system_prompt
+            else:
+                note_type_map.pop("system_prompt", None)
             self.on_accept_callback(self.prompts_map)
             self.accept()
 
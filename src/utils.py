@@ -17,20 +17,13 @@
  along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from typing import Dict, Any
 from aqt import mw
 from .config import config
 import os
 
-from .ui.rate_dialog import RateDialog
 from .ui.ui_utils import show_message_box
 
 
-def to_lowercase_dict(d: Dict[str, Any]) -> Dict[str, Any]:
-    """Converts a dictionary to lowercase keys"""
-    return {k.lower(): v for k, v in d.items()}
-
-
 def get_fields(note_type: str):
     """Gets the fields of a note type."""
     if not mw or not mw.col:
@@ -61,6 +54,8 @@ USES_BEFORE_RATE_DIALOG = 10
 def bump_usage_counter() -> None:
     config.times_used += 1
     if config.times_used > USES_BEFORE_RATE_DIALOG and not config.did_show_rate_dialog:
+        from .ui.rate_dialog import RateDialog
+
         config.did_show_rate_dialog = True
         dialog = RateDialog()
         dialog.exec()
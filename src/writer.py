@@ -0,0 +1,219 @@
+"""
+ Copyright (C) 2024 Michael Piazza
+
+ This file is part of Smart Notes.
+
+ Smart Notes is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ Smart Notes is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Notes.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+"""The one place generated fields are written back to the collection.
+
+Every generation path (review, the editor, batches, background generation) hands its notes to the
+NoteWriter, which coalesces them into a single update_notes call every FLUSH_INTERVAL_MS, rather
+than each path writing whenever it finishes. Notes open in an editor have the generated fields
+merged into the editor's copy, so the write and the editor's next save don't clobber each other.
+What each written field was generated from is recorded, for finding stale fields later.
+
+Main thread only."""
+
+import weakref
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+from anki.errors import InvalidInput, NotFoundError
+from anki.notes import Note, NoteId
+from aqt import editor, mw
+
+from .core.engine import Engine, NoteLike
+from .core.field_status import (
+    FingerprintStore,
+    get_fingerprints_path,
+    record_fingerprints,
+)
+from .core.metrics import Metrics
+from .core.note_records import NoteRecord
+
+FLUSH_INTERVAL_MS = 200
+UNDO_LABEL = "Generate Smart Fields"
+
+
+class PendingWrite:
+    __slots__ = ("note", "changes", "callbacks")
+
+    def __init__(self) -> None:
+        # The note to write, if the caller had a real one; otherwise it's loaded at flush
+        self.note: Union[Note, None] = None
+        # Field -> generated value
+        self.changes: Dict[str, str] = {}
+        self.callbacks: List[Callable[[], None]] = []
+
+
+class NoteWriter:
+    def __init__(self, engine: Engine, metrics: Union[Metrics, None] = None) -> None:
+        self.engine = engine
+        self.metrics = metrics or engine.client.metrics
+        self.pending: Dict[NoteId, PendingWrite] = {}
+        self.is_flush_scheduled = False
+        # Every editor that's loaded a note; closed ones drop out on their own
+        self.editors: "weakref.WeakSet[editor.Editor]" = weakref.WeakSet()
+        # While any batch is running, its writes go into one undo step, until the user does something undoable
+        self.batches = 0
+        self.batch_undo_entry: Union[int, None] = None
+        # Open while a profile is
+        self.fingerprints: Union[FingerprintStore, None] = None
+
+    def on_profile_did_open(self) -> None:
+        if mw and mw.col:
+            self.fingerprints = FingerprintStore(get_fingerprints_path(mw.col.path))
+
+    def on_profile_will_close(self) -> None:
+        # Don't lose generated fields still waiting to be written
+        self.flush()
+        if self.fingerprints:
+            self.fingerprints.close()
+            self.fingerprints = None
+
+    def on_editor_did_load_note(self, editor: editor.Editor) -> None:
+        self.editors.add(editor)
+
+    def write(
+        self,
+        note: NoteLike,
+        fields: Sequence[str] = (),
+        on_written: Union[Callable[[], None], None] = None,
+    ) -> None:
+        """Queues the note's generated fields for the next flush. on_written runs once they're saved.
+
+        fields are the ones generated, for a full note; a NoteRecord knows its own. The rest of a
+        full note may be stale next to the copy open in an editor, so only those are written."""
+        if isinstance(note, NoteRecord):
+            changes = note.changed
+        else:
+            changes = {field: note[field] for field in fields if field in note}
+
+        pending = self.pending.setdefault(note.id, PendingWrite())
+        pending.changes.update(changes)
+        if isinstance(note, Note):
+            pending.note = note
+        if on_written:
+            pending.callbacks.append(on_written)
+
+        self.metrics.observe("writer.queue_depth", len(self.pending))
+        self._schedule_flush()
+
+    def write_all(self, notes: Sequence[NoteLike]) -> None:
+        for note in notes:
+            self.write(note)
+
+    def start_batch(self) -> None:
+        self.batches += 1
+
+    def end_batch(self) -> None:
+        """Writes whatever the batch still has queued, closing its undo step once no batch is left."""
+        self.flush()
+        self.batches = max(self.batches - 1, 0)
+        if not self.batches:
+            self.batch_undo_entry = None
+
+    def queue_depth(self) -> int:
+        return len(self.pending)
+
+    def flush(self) -> None:
+        self.is_flush_scheduled = False
+        if not self.pending or not mw or not mw.col:
+            return
+
+        pending, self.pending = self.pending, {}
+        notes: List[Note] = []
+        # Each note written, with the generated fields written to it
+        written: List[Tuple[NoteLike, List[str]]] = []
+        editors_to_reload = []
+        callbacks: List[Callable[[], None]] = []
+
+        for note_id, write in pending.items():
+            callbacks.extend(write.callbacks)
+            open_editor = self.get_editor(note_id)
+
+            note = open_editor.note if open_editor and open_editor.note else write.note
+            if not note:
+                try:
+                    note = mw.col.get_note(note_id)
+                except NotFoundError:
+                    # Deleted since it was generated
+                    continue
+
+            # What the user is typing right now wins over what was generated
+            typing_in = None
+            if open_editor and open_editor.currentField is not None:
+                typing_in = list(note.keys())[open_editor.currentField]
+
+            changed_in_editor = False
+            fields = []
+            for field, value in write.changes.items():
+                if field == typing_in or field not in note:
+                    continue
+                fields.append(field)
+                if note[field] != value:
+                    note[field] = value
+                    changed_in_editor = open_editor is not None
+
+            notes.append(note)
+            written.append((note, fields))
+            if changed_in_editor:
+                editors_to_reload.append(open_editor)
+
+        if notes:
+            self._update_notes(notes)
+            if self.fingerprints:
+                record_fingerprints(mw.col, self.engine, self.fingerprints, written)
+        for open_editor in editors_to_reload:
+            if open_editor and open_editor.note:
+                open_editor.loadNoteKeepingFocus()
+        for callback in callbacks:
+            callback()
+
+        self.metrics.incr("writer.flushes")
+        self.metrics.incr("writer.notes_written", len(notes))
+
+    def get_editor(self, note_id: NoteId) -> Union[editor.Editor, None]:
+        """An editor showing this note, if there is one."""
+        for open_editor in self.editors:
+            if open_editor.note and open_editor.note.id == note_id:
+                return open_editor
+        return None
+
+    def _update_notes(self, notes: List[Note]) -> None:
+        if not mw:
+            return
+
+        # Merging folds every op since the entry into it, so only keep adding to the batch's
+        # entry while nothing else has been done since; otherwise start another one
+        undo_entry = self.batch_undo_entry
+        if undo_entry is None or mw.col.undo_status().last_step != undo_entry:
+            undo_entry = mw.col.add_custom_undo_entry(UNDO_LABEL)
+            self.batch_undo_entry = undo_entry if self.batches else None
+
+        mw.col.update_notes(notes)
+        try:
+            mw.col.merge_undo_entries(undo_entry)
+        except InvalidInput as e:
+            # The write stands, as an undo step of its own
+            print(f"Couldn't merge undo entries: {e}")
+            self.batch_undo_entry = None
+
+    def _schedule_flush(self) -> None:
+        if self.is_flush_scheduled or not mw:
+            return
+        self.is_flush_scheduled = True
+        mw.progress.single_shot(FLUSH_INTERVAL_MS, self.flush, False)